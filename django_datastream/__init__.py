@@ -1,14 +1,130 @@
 import importlib
+import os
+import threading
+import types
 
 from django.conf import settings
 from django.core import exceptions
 
-from datastream import Datastream
+try:
+    import mongoengine
+    from datastream.backends import mongodb
+except ImportError:
+    mongoengine = None
+    mongodb = None
+
+import datastream as datastream_api
+
+from . import dirty
+
+
+class Datastream(datastream_api.Datastream):
+    def append(self, stream_id, value, timestamp=None, check_timestamp=True, mark_dirty=True):
+        # Streams which are downsampled explicitly after appending do not have to be marked as dirty.
+        result = super(Datastream, self).append(stream_id, value, timestamp, check_timestamp)
+
+        if dirty.is_enabled() and mark_dirty:
+            dirty.mark(result['stream_id'])
+
+        return result
+
+    def append_multiple(self, datapoints, mark_dirty=True):
+        # Appends datapoints given as dicts with stream_id, value, and optional timestamp,
+        # like append. Every stream is marked as dirty only once, after its datapoints.
+        appended = set()
+        try:
+            for datapoint in datapoints:
+                result = self.append(datapoint['stream_id'], datapoint['value'], datapoint.get('timestamp', None), mark_dirty=False)
+                appended.add(result['stream_id'])
+        finally:
+            if dirty.is_enabled() and mark_dirty:
+                for stream_id in appended:
+                    dirty.mark(stream_id)
+
+
+# Connection settings (in seconds where applicable) which are translated to backend-specific settings.
+CONNECTION_SETTINGS = {
+    'pool_size': ('maxPoolSize', 1),
+    'connect_timeout': ('connectTimeoutMS', 1000),
+    'socket_timeout': ('socketTimeoutMS', 1000),
+    'wait_queue_timeout': ('waitQueueTimeoutMS', 1000),
+}
+
+
+class LazyDatastream(object):
+    # Initializes datastream (and connects to the database) on first use and again
+    # in a forked process, so that processes do not share connections.
+
+    def __init__(self, datastream_backend, datastream_backend_settings):
+        self._datastream_backend = datastream_backend
+        self._datastream_backend_settings = datastream_backend_settings
+        self._datastream = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _setup(self):
+        pid = os.getpid()
+        if self._datastream is not None and self._pid == pid:
+            return self._datastream
+
+        with self._lock:
+            if self._datastream is None:
+                self._datastream = init_datastream(self._datastream_backend, self._datastream_backend_settings)
+            elif self._pid != pid:
+                reconnect(self._datastream.backend)
+            self._pid = pid
+
+        return self._datastream
+
+    def __getattr__(self, name):
+        # Constants (like Granularity) do not need the backend.
+        attr = getattr(Datastream, name, None)
+        if attr is not None and not isinstance(attr, types.MethodType):
+            return attr
+
+        return getattr(self._setup(), name)
 
 
 datastream = None
 
 
+def get_backend_settings(backend_class, datastream_backend_settings):
+    backend_settings = dict(datastream_backend_settings)
+
+    for name, (backend_name, scale) in CONNECTION_SETTINGS.items():
+        if name not in backend_settings:
+            continue
+
+        if mongodb is None or not issubclass(backend_class, mongodb.Backend):
+            raise exceptions.ImproperlyConfigured("Datastream backend setting '%s' is supported only for the MongoDB datastream backend." % name)
+
+        value = backend_settings.pop(name)
+        if value is not None:
+            value = int(value * scale)
+        backend_settings[backend_name] = value
+
+    return backend_settings
+
+
+def reconnect(backend):
+    # Called in a forked process to replace database connections inherited from the parent process.
+
+    if mongodb is None or not isinstance(backend, mongodb.Backend):
+        return
+
+    # Not connected, a connection is made when needed.
+    if mongodb.DATABASE_ALIAS not in mongoengine.connection._connections:
+        return
+
+    database_name = mongoengine.connection.get_db(mongodb.DATABASE_ALIAS).name
+
+    # Inherited connections are dropped without closing them, because their sockets are still used by the parent process.
+    del mongoengine.connection._connections[mongodb.DATABASE_ALIAS]
+    mongoengine.connection._dbs.pop(mongodb.DATABASE_ALIAS, None)
+
+    backend._switch_database(database_name)
+
+
 def init_datastream(datastream_backend, datastream_backend_settings):
     backend = datastream_backend
 
@@ -25,10 +141,13 @@ def init_datastream(datastream_backend, datastream_backend_settings):
         except AttributeError:
             raise exceptions.ImproperlyConfigured("Module '%s' does not define a '%s' datastream backend" % (module, attr))
 
-        backend = cls(**datastream_backend_settings)
+        backend = cls(**get_backend_settings(cls, datastream_backend_settings))
+
+    if dirty.is_enabled() and not dirty.is_supported(backend):
+        raise exceptions.ImproperlyConfigured("DATASTREAM_DIRTY_TRACKING setting is supported only for the MongoDB datastream backend.")
 
     return Datastream(backend)
 
-# Load the backend as specified in configuration
+# Load the backend as specified in configuration, when it is first used
 if getattr(settings, 'DATASTREAM_BACKEND', None) is not None:
-    datastream = init_datastream(settings.DATASTREAM_BACKEND, getattr(settings, 'DATASTREAM_BACKEND_SETTINGS', {}))
+    datastream = LazyDatastream(settings.DATASTREAM_BACKEND, getattr(settings, 'DATASTREAM_BACKEND_SETTINGS', {}))
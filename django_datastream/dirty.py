@@ -0,0 +1,103 @@
+import datetime
+
+from django.conf import settings
+
+import pytz
+
+try:
+    import mongoengine
+    from datastream.backends import mongodb
+except ImportError:
+    mongoengine = None
+    mongodb = None
+
+import datastream
+
+COLLECTION_NAME = 'django_datastream.dirty_streams'
+
+# Datapoints inserted less than this many seconds ago are not yet downsampled by the backend.
+SAFETY_MARGIN = getattr(mongodb, 'DOWNSAMPLE_SAFETY_MARGIN', 0)
+
+# Dirty streams are stored as documents with the time when the stream was last marked
+# ("marked") and the time when it can be downsampled further ("due").
+
+
+def is_enabled():
+    # Track streams with new datapoints, so that "downsample --daemon" downsamples only them.
+    # Setting is read on every call, so that it can be changed in tests.
+    return getattr(settings, 'DATASTREAM_DIRTY_TRACKING', False)
+
+
+def is_supported(backend):
+    return mongodb is not None and isinstance(backend, mongodb.Backend)
+
+
+def get_collection():
+    return mongoengine.connection.get_db(mongodb.DATABASE_ALIAS)[COLLECTION_NAME]
+
+
+def ensure_indexes():
+    get_collection().create_index('due')
+
+
+def _now():
+    return datetime.datetime.now(pytz.utc)
+
+
+def _make_aware(timestamp):
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=pytz.utc)
+
+    return timestamp
+
+
+def mark(stream_id):
+    # Marks the stream to be downsampled as soon as possible.
+    now = _now()
+    get_collection().update({'_id': stream_id}, {'$max': {'marked': now}, '$min': {'due': now}}, upsert=True)
+
+
+def get_due(now):
+    # Returns IDs of dirty streams which can be downsampled further at the given time.
+    return [document['_id'] for document in get_collection().find({'due': {'$lte': now}}, {'_id': 1}).sort('due', 1)]
+
+
+def get_due_time(stream):
+    # Returns when the stream can be downsampled further, or None if all its datapoints have
+    # already been downsampled. The last interval of every granularity can be downsampled
+    # once it has ended and its datapoints are older than the safety margin.
+
+    if not stream.value_downsamplers or stream.latest_datapoint is None:
+        return None
+
+    latest_datapoint = _make_aware(stream.latest_datapoint)
+
+    due = None
+    for granularity in datastream.Granularity.values:
+        if granularity >= stream.highest_granularity:
+            continue
+
+        interval_end = granularity.round_timestamp(latest_datapoint) + datetime.timedelta(seconds=granularity.duration_in_seconds())
+
+        downsampled_until = (stream.downsampled_until or {}).get(granularity.name, None)
+        if downsampled_until is not None and _make_aware(downsampled_until) >= interval_end:
+            continue
+
+        granularity_due = interval_end + datetime.timedelta(seconds=SAFETY_MARGIN)
+        if due is None or granularity_due < due:
+            due = granularity_due
+
+    return due
+
+
+def reschedule(stream_id, processed_at, due):
+    # Stream is removed or its due time updated, but only if it has not been marked again
+    # while it was being processed.
+    if due is None:
+        get_collection().remove({'_id': stream_id, 'marked': {'$lte': processed_at}})
+    else:
+        get_collection().update({'_id': stream_id, 'marked': {'$lte': processed_at}}, {'$set': {'due': due}})
+
+
+def remove(stream_id):
+    get_collection().remove({'_id': stream_id})
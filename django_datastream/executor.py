@@ -0,0 +1,48 @@
+import threading
+
+from multiprocessing import pool as multiprocessing_pool
+
+from django.conf import settings
+
+# Number of threads in which API requests query the backend. At most this many queries are then
+# in flight in a process at once, other queries wait for a free thread. With None, requests
+# query the backend in their own threads, without a bound.
+BACKEND_THREADS = getattr(settings, 'DATASTREAM_BACKEND_THREADS', None)
+
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_pool():
+    # Thread pool is created lazily, so that it is created in the process
+    # which uses it (and not, for example, before forking worker processes).
+    global _pool
+
+    if BACKEND_THREADS is None:
+        return None
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = multiprocessing_pool.ThreadPool(BACKEND_THREADS)
+
+        return _pool
+
+
+def _call_in_pool(function, args, kwargs):
+    _local.in_pool = True
+    try:
+        return function(*args, **kwargs)
+    finally:
+        _local.in_pool = False
+
+
+def call(function, *args, **kwargs):
+    # Calls a function which queries the backend in the pool and waits for its result.
+    # Calls made from the pool itself are made directly, so that they cannot deadlock.
+
+    pool = get_pool()
+    if pool is None or getattr(_local, 'in_pool', False):
+        return function(*args, **kwargs)
+
+    return pool.apply(_call_in_pool, (function, args, kwargs))
@@ -0,0 +1,160 @@
+import collections
+import optparse
+import re
+import urlparse
+
+from django.conf import settings
+from django.core.management import base
+
+from django_datastream import datastream
+
+# Query operators which can be appended to tag filters, see StreamResource.get_object_list.
+QUERY_OPERATORS = (
+    'ne', 'lt', 'lte', 'gt', 'gte', 'not', 'in', 'nin', 'mod', 'all', 'size', 'exists',
+    'exact', 'iexact', 'contains', 'icontains', 'startswith', 'istartswith', 'endswith', 'iendswith', 'match',
+)
+
+# Operators which are matched with a regular expression which cannot use an index efficiently.
+SCAN_OPERATORS = ('iexact', 'contains', 'icontains', 'istartswith', 'endswith', 'iendswith')
+
+# Query string parameters of requests in a log file.
+re_query = re.compile(r'\?(\S+)')
+
+
+class Command(base.BaseCommand):
+    option_list = base.BaseCommand.option_list + (
+        optparse.make_option(
+            '--paths', '-p', action='store', type='string', dest='paths', default='',
+            help="Comma-separated tag paths to index, nested tags separated with '__' (i.e. 'title,visualization__type'). In addition to DATASTREAM_INDEXED_TAGS setting.",
+        ),
+        optparse.make_option(
+            '--log', '-l', action='append', type='string', dest='logs', default=[],
+            help="Request log file from which tag filters are learned and reported. Can be specified multiple times.",
+        ),
+        optparse.make_option(
+            '--min-requests', action='store', type='int', dest='min_requests', default=1,
+            help="Minimal number of requests with a filter in logs for its tag path to be indexed (default: 1).",
+        ),
+        optparse.make_option(
+            '--dry-run', action='store_true', dest='dry_run', default=False,
+            help="Only report, do not create any indexes.",
+        ),
+    )
+
+    help = "Create database indexes for tag paths used to filter streams."
+
+    def tag_path(self, filter_expr):
+        # Returns the tag path and the operator of a filter.
+        filter_bits = filter_expr.split('__')
+
+        if filter_bits and filter_bits[0] == 'tags':
+            filter_bits.pop(0)
+
+        operator = None
+        if len(filter_bits) > 1 and filter_bits[-1] in QUERY_OPERATORS:
+            operator = filter_bits.pop()
+
+        if not filter_bits or not all(filter_bits):
+            return None, None
+
+        return '.'.join(filter_bits), operator
+
+    def read_logs(self, logs):
+        # Returns counts of requests per (tag path, operator).
+        filters = collections.Counter()
+
+        for log in logs:
+            try:
+                with open(log, 'r') as f:
+                    for line in f:
+                        for query in re_query.findall(line):
+                            for filter_expr in set(key for key, value in urlparse.parse_qsl(query, keep_blank_values=True)):
+                                if not filter_expr.startswith('tags__'):
+                                    continue
+
+                                path, operator = self.tag_path(filter_expr)
+                                if path is not None:
+                                    filters[(path, operator)] += 1
+            except IOError, exception:
+                raise base.CommandError("Cannot read log file '%s': %s" % (log, exception))
+
+        return filters
+
+    def handle(self, *args, **options):
+        verbose = int(options.get('verbosity'))
+        logs = options.get('logs')
+        min_requests = options.get('min_requests')
+        dry_run = options.get('dry_run')
+
+        try:
+            from datastream.backends import mongodb
+        except ImportError:
+            mongodb = None
+
+        if datastream is None or mongodb is None or not isinstance(datastream.backend, mongodb.Backend):
+            raise base.CommandError("Indexes can be created only for the MongoDB datastream backend.")
+
+        paths = set()
+        for tag_path in list(getattr(settings, 'DATASTREAM_INDEXED_TAGS', [])) + options.get('paths').split(','):
+            if not tag_path:
+                continue
+
+            path, operator = self.tag_path(tag_path)
+            if path is None:
+                raise base.CommandError("Invalid tag path '%s'." % tag_path)
+            paths.add(path)
+
+        filters = self.read_logs(logs)
+
+        requests = collections.Counter()
+        for (path, operator), count in filters.items():
+            requests[path] += count
+
+        for path, count in requests.items():
+            if count >= min_requests:
+                paths.add(path)
+
+        collection = mongodb.Stream._get_collection()
+
+        # An index can be used for a tag path if it is the first key of the index.
+        indexed = set()
+        for index in collection.index_information().values():
+            indexed.add(index['key'][0][0])
+
+        for path in sorted(paths):
+            field = 'tags.%s' % path
+
+            if field in indexed:
+                if verbose > 1:
+                    self.stdout.write("Index for '%s' already exists.\n" % field)
+                continue
+
+            if dry_run:
+                self.stdout.write("Would create index for '%s'.\n" % field)
+                continue
+
+            collection.create_index([(field, 1)], background=True)
+            indexed.add(field)
+
+            if verbose > 0:
+                self.stdout.write("Created index for '%s'.\n" % field)
+
+        if dry_run:
+            # We report as if indexes would be created.
+            indexed.update('tags.%s' % path for path in paths)
+
+        scans = []
+        for (path, operator), count in sorted(filters.items(), key=lambda item: (-item[1], item[0])):
+            filter_expr = '__'.join(['tags'] + path.split('.') + ([operator] if operator else []))
+
+            if 'tags.%s' % path not in indexed:
+                scans.append((filter_expr, count, "no index"))
+            elif operator in SCAN_OPERATORS:
+                scans.append((filter_expr, count, "case-insensitive or substring match cannot use an index"))
+
+        if scans:
+            self.stdout.write("Filters which still use full collection scans:\n")
+            for filter_expr, count, reason in scans:
+                self.stdout.write("  %s (%d requests): %s\n" % (filter_expr, count, reason))
+        elif filters and verbose > 0:
+            self.stdout.write("All filters from logs can use an index.\n")
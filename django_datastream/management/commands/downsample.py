@@ -1,9 +1,202 @@
 import datetime
+import json
 import optparse
+import time
 
 from django.core.management import base
 
-from django_datastream import datastream
+import pytz
+
+from datastream import exceptions as datastream_exceptions
+
+from django_datastream import datastream, dirty, materialize, metrics, serializers, workers as datastream_workers
+
+STATS_FORMATS = ('text', 'json')
+
+# Seconds after which downsampling of a stream is retried by the daemon after an error.
+RETRY_INTERVAL = 60
+
+
+class DownsampleStats(object):
+    # Collects timings and counts of datapoints per stream and granularity, by
+    # instrumenting downsampling methods of the MongoDB backend instance. Those are
+    # private methods of the backend, so stats are supported only for it.
+    #
+    # Counts are not collected by the backend while downsampling, so they are obtained
+    # with additional queries after every granularity of a stream has been downsampled.
+    # They are approximate, because datapoints can be appended in the meantime, and
+    # they are collected only when requested, not to add load. Otherwise they are None.
+
+    def __init__(self, count_datapoints=False):
+        self.count_datapoints = count_datapoints
+        self.streams = {}
+
+    def get_stream(self, stream_id):
+        return self.streams.setdefault(stream_id, {
+            'time': 0.0,
+            'granularities': {},
+        })
+
+    def get_granularity(self, stream_id, granularity):
+        granularities = self.get_stream(stream_id)['granularities']
+        if granularity.name not in granularities:
+            granularities[granularity.name] = {
+                'time': 0.0,
+                'read': 0 if self.count_datapoints else None,
+                'written': 0 if self.count_datapoints else None,
+            }
+        return granularities[granularity.name]
+
+    def count(self, stream_id, granularity, start, end_exclusive):
+        return datastream.get_data(stream_id, granularity, start=start or datetime.datetime.min, end_exclusive=end_exclusive).count()
+
+    def install(self, backend):
+        downsample_check = backend._downsample_check
+        downsample = backend._downsample
+
+        def instrumented_downsample_check(stream, until_timestamp, return_datapoints):
+            start = time.time()
+            try:
+                return downsample_check(stream, until_timestamp, return_datapoints)
+            finally:
+                self.get_stream(str(stream.external_id))['time'] += time.time() - start
+
+        def instrumented_downsample(stream, granularity, until_timestamp, return_datapoints, locked_until):
+            stream_id = str(stream.external_id)
+            # Downsampling state is updated in place.
+            downsampled_until = getattr(stream.downsample_state.get(granularity.name, None), 'timestamp', None)
+
+            start = time.time()
+            try:
+                result = downsample(stream, granularity, until_timestamp, return_datapoints, locked_until)
+            finally:
+                stats = self.get_granularity(stream_id, granularity)
+                stats['time'] += time.time() - start
+
+            if self.count_datapoints:
+                # Datapoints are downsampled from the next higher granularity.
+                higher_granularity = datastream.Granularity.values[datastream.Granularity.values.index(granularity) - 1]
+                stats['read'] += self.count(stream_id, higher_granularity, downsampled_until, until_timestamp)
+                stats['written'] += self.count(stream_id, granularity, downsampled_until, until_timestamp)
+
+            return result
+
+        backend._downsample_check = instrumented_downsample_check
+        backend._downsample = instrumented_downsample
+
+    def uninstall(self, backend):
+        del backend._downsample_check
+        del backend._downsample
+
+    def update(self, streams):
+        self.streams.update(streams)
+
+    def add_lag(self, stream):
+        # Lag is the time between the newest datapoint and the end of downsampled datapoints
+        # of the highest downsampled granularity.
+        if not stream.value_downsamplers or stream.latest_datapoint is None or stream.highest_granularity == datastream.Granularity.values[-1]:
+            lag = 0.0
+        else:
+            granularity = datastream.Granularity.values[datastream.Granularity.values.index(stream.highest_granularity) + 1]
+            downsampled_until = (stream.downsampled_until or {}).get(granularity.name, None) or stream.earliest_datapoint
+            lag = max(total_seconds(stream.latest_datapoint - downsampled_until), 0.0)
+
+        self.get_stream(stream.id)['lag'] = lag
+
+    def sum_counts(self, stats, key):
+        if not self.count_datapoints:
+            return None
+
+        return sum(s[key] for s in stats)
+
+    def summary(self, elapsed):
+        streams = []
+        for stream_id, stats in self.streams.items():
+            stats = dict(stats, stream_id=stream_id)
+            stats['read'] = self.sum_counts(stats['granularities'].values(), 'read')
+            stats['written'] = self.sum_counts(stats['granularities'].values(), 'written')
+            streams.append(stats)
+
+        # The slowest streams first.
+        streams.sort(key=lambda stats: (-stats['time'], stats['stream_id']))
+
+        granularities = {}
+        for stats in streams:
+            for name, granularity_stats in stats['granularities'].items():
+                granularities.setdefault(name, []).append(granularity_stats)
+
+        for name, granularity_stats in granularities.items():
+            granularities[name] = {
+                'time': sum(stats['time'] for stats in granularity_stats),
+                'read': self.sum_counts(granularity_stats, 'read'),
+                'written': self.sum_counts(granularity_stats, 'written'),
+            }
+
+        lags = [stats['lag'] for stats in streams if 'lag' in stats]
+
+        total = {
+            'streams': len([stats for stats in streams if stats['granularities'] or stats['time']]),
+            'time': sum(stats['time'] for stats in streams),
+            'max_lag': max(lags) if lags else None,
+            'read': self.sum_counts(streams, 'read'),
+            'written': self.sum_counts(streams, 'written'),
+        }
+
+        return {
+            'time': elapsed,
+            'streams': streams,
+            'granularities': granularities,
+            'total': total,
+        }
+
+
+def total_seconds(delta):
+    return delta.days * 24 * 60 * 60 + delta.seconds + delta.microseconds / 1e6
+
+
+def format_counts(stats):
+    if stats['read'] is None:
+        return ""
+
+    return ", read %d, written %d" % (stats['read'], stats['written'])
+
+
+def downsample_partition(args):
+    # Returns IDs of downsampled streams and collected stats.
+    partition, workers, until, query_tags, stream_ids, collect_stats, count_datapoints = args
+
+    streams = []
+
+    if collect_stats:
+        stats = DownsampleStats(count_datapoints)
+        stats.install(datastream.backend)
+    else:
+        stats = None
+
+    def filter_stream(stream):
+        # Streams are MongoDB backend documents.
+        stream_id = str(stream.external_id)
+
+        if stream_ids is not None and stream_id not in stream_ids:
+            return False
+
+        if workers > 1 and datastream_workers.get_partition(stream_id, workers) != partition:
+            return False
+
+        streams.append(stream_id)
+        return True
+
+    try:
+        if workers > 1 or stream_ids is not None:
+            datastream.downsample_streams(query_tags=query_tags, until=until, filter_stream=filter_stream)
+        else:
+            datastream.downsample_streams(query_tags=query_tags, until=until)
+            streams = None
+    finally:
+        if stats is not None:
+            stats.uninstall(datastream.backend)
+
+    return streams, stats.streams if stats is not None else None
 
 
 class Command(base.BaseCommand):
@@ -12,6 +205,34 @@ class Command(base.BaseCommand):
             '--until', '-u', action='store', type='string', dest='until', default=None,
             help="Until when to downsample, format 'yyyy-mm-ddThh:mm:ss' (i.e. '2007-03-04T21:08:12')",
         ),
+        optparse.make_option(
+            '--materialize', '-m', action='store_true', dest='materialize', default=False,
+            help="Store pre-serialized blocks of downsampled datapoints into DATASTREAM_MATERIALIZE_CACHE cache.",
+        ),
+        optparse.make_option(
+            '--workers', '-w', action='store', type='int', dest='workers', default=1,
+            help="Number of worker processes between which streams are partitioned (default: 1).",
+        ),
+        optparse.make_option(
+            '--streams', '-s', action='store', type='string', dest='streams', default=None,
+            help="Comma-separated IDs of streams to downsample (default: all).",
+        ),
+        optparse.make_option(
+            '--tags', '-t', action='store', type='string', dest='tags', default=None,
+            help="Downsample only streams matching query tags, as JSON (i.e. '{\"title\": \"Stream 1\"}').",
+        ),
+        optparse.make_option(
+            '--daemon', '-d', action='store_true', dest='daemon', default=False,
+            help="After downsampling all pending streams, keep running and downsample streams with new datapoints. Requires DATASTREAM_DIRTY_TRACKING setting.",
+        ),
+        optparse.make_option(
+            '--stats', action='store', type='choice', choices=STATS_FORMATS, dest='stats', default=None,
+            help="Output timings per stream and granularity, and how much downsampling lags behind, as 'text' or 'json'.",
+        ),
+        optparse.make_option(
+            '--count-datapoints', action='store_true', dest='count_datapoints', default=False,
+            help="With stats, also output approximate counts of datapoints read and written, which require additional queries.",
+        ),
     )
 
     help = "Downsample all pending streams."
@@ -19,6 +240,13 @@ class Command(base.BaseCommand):
     def handle(self, *args, **options):
         verbose = int(options.get('verbosity'))
         until = options.get('until')
+        materialize_blocks = options.get('materialize')
+        workers = options.get('workers')
+        stream_ids = options.get('streams')
+        query_tags = options.get('tags')
+        daemon = options.get('daemon')
+        stats_format = options.get('stats')
+        count_datapoints = options.get('count_datapoints')
 
         if until:
             try:
@@ -30,10 +258,207 @@ class Command(base.BaseCommand):
             # To make sure is None and not empty string
             until = None
 
+        if workers < 1:
+            raise base.CommandError("Number of workers must be a positive integer.")
+
+        if stream_ids:
+            stream_ids = set(stream_id.strip() for stream_id in stream_ids.split(',') if stream_id.strip())
+        else:
+            stream_ids = None
+
+        if query_tags:
+            try:
+                query_tags = json.loads(query_tags)
+            except ValueError, exception:
+                raise base.CommandError("Invalid query tags: %s" % exception)
+
+            if not isinstance(query_tags, dict):
+                raise base.CommandError("Query tags must be a JSON object.")
+        else:
+            query_tags = None
+
+        if materialize_blocks and materialize.get_cache() is None:
+            raise base.CommandError("DATASTREAM_MATERIALIZE_CACHE setting is not configured.")
+
+        if daemon:
+            if not dirty.is_enabled():
+                raise base.CommandError("DATASTREAM_DIRTY_TRACKING setting is not enabled.")
+
+            if stream_ids is not None or query_tags is not None:
+                raise base.CommandError("Daemon downsamples all streams with new datapoints, streams cannot be selected.")
+
+        if workers > 1:
+            self.check_backend("Multiple workers are")
+
+        if stats_format is not None:
+            self.check_backend("Stats are")
+        elif count_datapoints:
+            raise base.CommandError("Counting datapoints requires stats.")
+
         if verbose > 1:
             self.stdout.write("Downsampling.\n")
 
-        datastream.downsample_streams(until=until)
+        partitions = [(partition, workers, until, query_tags, stream_ids, stats_format is not None, count_datapoints) for partition in range(workers)]
+
+        start = time.time()
+
+        if workers > 1:
+            results = datastream_workers.map(downsample_partition, partitions, workers)
+        else:
+            results = map(downsample_partition, partitions)
+
+        elapsed = time.time() - start
+
+        if verbose > 1:
+            for partition, (streams, stream_stats) in enumerate(results):
+                if streams is None:
+                    continue
+
+                self.stdout.write("Worker %d downsampled %d streams.\n" % (partition, len(streams)))
+
+        if stats_format is not None or metrics.METRICS:
+            stats = DownsampleStats(count_datapoints)
+            for streams, stream_stats in results:
+                if stream_stats is not None:
+                    stats.update(stream_stats)
+
+            for stream in datastream.find_streams(query_tags):
+                if stream_ids is not None and stream['stream_id'] not in stream_ids:
+                    continue
+
+                stats.add_lag(datastream.Stream(stream))
+
+            summary = stats.summary(elapsed)
+
+            if stats_format is not None:
+                self.write_stats(summary, stats_format)
+
+            if any(streams is None for streams, stream_stats in results):
+                count = None
+            else:
+                count = sum(len(streams) for streams, stream_stats in results)
+
+            metrics.set_downsample_run(time.time(), elapsed, count, summary['total']['max_lag'])
+
+        if materialize_blocks:
+            if verbose > 1:
+                self.stdout.write("Materializing.\n")
+
+            serializer = serializers.DatastreamSerializer()
+            for stream in datastream.find_streams(query_tags):
+                if stream_ids is not None and stream['stream_id'] not in stream_ids:
+                    continue
+
+                count = materialize.materialize_stream(datastream.Stream(stream), serializer)
+
+                if verbose > 1:
+                    self.stdout.write("Materialized %d blocks of stream '%s'.\n" % (count, stream['stream_id']))
+
+        if daemon:
+            self.run_daemon(verbose, materialize_blocks, stats_format, count_datapoints)
 
         if verbose > 1:
             self.stdout.write("Done.\n")
+
+    def write_stats(self, summary, stats_format):
+        if stats_format == 'json':
+            self.stdout.write(json.dumps(summary, sort_keys=True) + '\n')
+            return
+
+        for stats in summary['streams']:
+            lag = ", lag %.0f s" % stats['lag'] if 'lag' in stats else ""
+            self.stdout.write("Stream '%s': %.3f s%s%s\n" % (stats['stream_id'], stats['time'], format_counts(stats), lag))
+
+            for granularity in datastream.Granularity.values:
+                if granularity.name in stats['granularities']:
+                    granularity_stats = stats['granularities'][granularity.name]
+                    self.stdout.write("  %s: %.3f s%s\n" % (granularity.name, granularity_stats['time'], format_counts(granularity_stats)))
+
+        for granularity in datastream.Granularity.values:
+            if granularity.name in summary['granularities']:
+                granularity_stats = summary['granularities'][granularity.name]
+                self.stdout.write("Granularity '%s': %.3f s%s\n" % (granularity.name, granularity_stats['time'], format_counts(granularity_stats)))
+
+        total = summary['total']
+        max_lag = ", max lag %.0f s" % total['max_lag'] if total['max_lag'] is not None else ""
+        self.stdout.write("Total: %d streams in %.3f s (%.3f s downsampling)%s%s\n" % (total['streams'], summary['time'], total['time'], format_counts(total), max_lag))
+
+    def run_daemon(self, verbose, materialize_blocks, stats_format, count_datapoints):
+        # Streams with new datapoints are marked as dirty on append. New datapoints can be downsampled only
+        # when an interval ends, so we wake up at interval boundaries of the highest downsampled granularity
+        # and downsample only dirty streams which are due. There are no full scans of all streams.
+
+        dirty.ensure_indexes()
+
+        serializer = serializers.DatastreamSerializer() if materialize_blocks else None
+        interval = datastream.Granularity.Seconds10.duration_in_seconds()
+
+        if verbose > 1:
+            self.stdout.write("Downsampling streams with new datapoints.\n")
+
+        while True:
+            time.sleep(interval - time.time() % interval)
+
+            # Without stats, lags are still collected for metrics.
+            if stats_format is not None or metrics.METRICS:
+                stats = DownsampleStats(count_datapoints)
+            else:
+                stats = None
+
+            if stats_format is not None:
+                stats.install(datastream.backend)
+
+            start = time.time()
+            try:
+                count = self.downsample_dirty(serializer, stats)
+            finally:
+                if stats_format is not None:
+                    stats.uninstall(datastream.backend)
+
+            elapsed = time.time() - start
+            summary = stats.summary(elapsed) if stats is not None else None
+
+            if stats_format is not None and count:
+                self.write_stats(summary, stats_format)
+
+            if summary is not None:
+                metrics.set_downsample_run(time.time(), elapsed, count, summary['total']['max_lag'])
+
+            if verbose > 1 and count:
+                self.stdout.write("Downsampled %d streams.\n" % count)
+
+    def downsample_dirty(self, serializer=None, stats=None):
+        # Downsamples dirty streams which are due and returns their number.
+        now = datetime.datetime.now(pytz.utc)
+        stream_ids = dirty.get_due(now)
+
+        for stream_id in stream_ids:
+            try:
+                datastream.downsample_streams(query_tags={'stream_id': stream_id})
+                stream = datastream.Stream(datastream.get_tags(stream_id))
+            except datastream_exceptions.StreamNotFound:
+                dirty.remove(stream_id)
+                continue
+            except Exception, exception:
+                # We retry later.
+                self.stderr.write("Error downsampling stream '%s': %s\n" % (stream_id, exception))
+                dirty.reschedule(stream_id, now, now + datetime.timedelta(seconds=RETRY_INTERVAL))
+                continue
+
+            # Datapoints of derived streams are appended by the backend.
+            for derived_stream_id in getattr(stream, 'contributes_to', {}):
+                dirty.mark(derived_stream_id)
+
+            if serializer is not None:
+                materialize.materialize_stream(stream, serializer)
+
+            if stats is not None:
+                stats.add_lag(stream)
+
+            dirty.reschedule(stream_id, now, dirty.get_due_time(stream))
+
+        return len(stream_ids)
+
+    def check_backend(self, feature):
+        if not datastream_workers.is_supported():
+            raise base.CommandError("%s supported only for the MongoDB datastream backend." % feature)
@@ -1,9 +1,14 @@
+import calendar
 import datetime
+import hashlib
 import itertools
+import math
 import optparse
 import random
+import numbers
 import re
 import time
+import uuid
 
 from django.core.management import base
 
@@ -15,7 +20,14 @@ except ImportError:
 
 import pytz
 
-from django_datastream import datastream
+try:
+    import mongoengine
+    from datastream.backends import mongodb
+except ImportError:
+    mongoengine = None
+    mongodb = None
+
+from django_datastream import datastream, workers as datastream_workers
 
 re_float = r'[-+]?[0-9]*\.?[0-9]+'
 re_int = r'[-+]?\d+'
@@ -27,9 +39,24 @@ DEMO_SPAN = '2d'
 
 DEFAULT_NSTREAMS = 3
 DEFAULT_INTERVAL = 5 # seconds
+DEFAULT_BATCH_SIZE = 1000
 
+# Workload shapes for bulk mode. Value shapes apply to numeric streams, others change timestamps.
+VALUE_SHAPES = ('random', 'sine', 'walk')
+TIME_SHAPES = ('bursts', 'gaps', 'late')
 
-def random_graph(number_of_nodes, number_of_edges):
+SINE_PERIOD = 24 * 60 * 60 # seconds
+# Standard deviation of random walk steps, relative to the domain.
+WALK_STEP = 0.02
+# Probability that datapoints are appended every second during an interval.
+BURST_PROBABILITY = 0.02
+# Probability that a gap of 10 to 100 intervals without datapoints starts.
+GAP_PROBABILITY = 0.005
+# Probability that a datapoint arrives late, up to 10 intervals after later datapoints.
+LATE_PROBABILITY = 0.02
+
+
+def random_graph(number_of_nodes, number_of_edges, rng=random):
     # Produces a graph picked randomly out of the set of all graphs
     # with number_of_nodes nodes and number_of_edges edges. Based on
     # NetworkX gnm_random_graph.
@@ -55,8 +82,8 @@ def random_graph(number_of_nodes, number_of_edges):
 
     edges = set()
     while len(edges) < number_of_edges:
-        f = random.choice(nodes)
-        t = random.choice(nodes)
+        f = rng.choice(nodes)
+        t = rng.choice(nodes)
         if f == t or (f, t) in edges:
             continue
         else:
@@ -69,14 +96,194 @@ def random_graph(number_of_nodes, number_of_edges):
     return graph
 
 
+# Random functions get a random number generator (or the random module) as the first argument.
 TYPES = {
-    'int': (int, random.randint, '0,100'),
-    'float': (float, random.uniform, '0,100'),
-    'enum': (str, lambda *x: random.choice(x), 'a,b,c'),
-    'graph': (int, random_graph, '4,6'),
+    'int': (int, lambda rng, a, b: rng.randint(a, b), '0,100'),
+    'float': (float, lambda rng, a, b: rng.uniform(a, b), '0,100'),
+    'enum': (str, lambda rng, *x: rng.choice(x), 'a,b,c'),
+    'graph': (int, lambda rng, n, e: random_graph(n, e, rng), '4,6'),
 }
 
 
+def generate_values(rng, typ, domain, shapes, timestamps):
+    # Generates a value for every timestamp.
+
+    type_constructor, random_function, default_domain = TYPES[typ]
+    domain = [type_constructor(d) for d in (domain or default_domain).split(',')]
+
+    if typ not in ('int', 'float') or 'random' in shapes or not set(VALUE_SHAPES) & set(shapes):
+        for timestamp in timestamps:
+            yield random_function(rng, *domain)
+        return
+
+    low, high = domain
+    value = (low + high) / 2.0
+
+    for timestamp in timestamps:
+        if 'sine' in shapes:
+            phase = 2 * math.pi * (calendar.timegm(timestamp.utctimetuple()) % SINE_PERIOD) / SINE_PERIOD
+            value = low + (high - low) * (0.5 + 0.45 * math.sin(phase) + rng.uniform(-0.05, 0.05))
+        else:
+            value = value + rng.gauss(0, (high - low) * WALK_STEP)
+
+        value = min(max(value, low), high)
+
+        yield type_constructor(round(value)) if typ == 'int' else value
+
+
+def generate_timestamps(rng, shapes, span_from, span_to, interval):
+    # Generates timestamps of datapoints, in the order of their arrival, with a flag
+    # if the datapoint arrived late (after datapoints with later timestamps). The last
+    # datapoint is never late, so that the latest datapoint of the stream is correct.
+
+    # Pending late datapoints as (arrival, timestamp) pairs, sorted by arrival.
+    late = []
+    # The latest on-time timestamp is held back until the next one, so that late
+    # datapoints arriving after the end of the span can still be emitted before it.
+    held = None
+    state = {'latest': None}
+
+    def emit_late(t):
+        # Datapoints which were late, but no later datapoint has been emitted in the meantime, are not late.
+        if state['latest'] is not None and t < state['latest']:
+            return t, True
+
+        state['latest'] = t
+        return t, False
+
+    timestamp = span_from
+    while timestamp <= span_to:
+        if 'gaps' in shapes and rng.random() < GAP_PROBABILITY:
+            timestamp += datetime.timedelta(seconds=interval * rng.randint(10, 100))
+            continue
+
+        if 'bursts' in shapes and rng.random() < BURST_PROBABILITY:
+            timestamps = [timestamp + datetime.timedelta(seconds=second) for second in range(interval)]
+        else:
+            timestamps = [timestamp]
+
+        for t in timestamps:
+            if 'late' in shapes and rng.random() < LATE_PROBABILITY:
+                late.append((t + datetime.timedelta(seconds=interval * rng.randint(1, 10)), t))
+                late.sort()
+                continue
+
+            if held is not None:
+                state['latest'] = held
+                yield held, False
+
+            while late and late[0][0] <= t:
+                yield emit_late(late.pop(0)[1])
+
+            held = t
+
+        timestamp += datetime.timedelta(seconds=interval)
+
+    # Remaining late datapoints are emitted before the held datapoint if they are older,
+    # otherwise after it in the order of their timestamps, as on-time datapoints.
+    for arrival, t in late:
+        if held is not None and t < held:
+            yield emit_late(t)
+
+    if held is not None:
+        yield held, False
+
+    for t in sorted(t for arrival, t in late if held is None or t > held):
+        yield t, False
+
+
+def make_rng(*parts):
+    # Seeding with a string uses hash(), which differs between Python processes (with hash
+    # randomization) and platforms, so an integer seed is derived from the string instead.
+    return random.Random(int(hashlib.md5('-'.join(str(part) for part in parts)).hexdigest(), 16))
+
+
+def generate_datapoints(seed, stream_number, typ, domain, shapes, span_from, span_to, interval):
+    # Generates (timestamp, value, late) datapoints of a stream. The same seed and stream number
+    # generate the same datapoints, independently of other streams.
+
+    rng = make_rng(seed, stream_number)
+
+    datapoints, for_values = itertools.tee(generate_timestamps(rng, shapes, span_from, span_to, interval))
+
+    # Values use their own generator, so that they do not depend on timestamp shapes.
+    values = generate_values(
+        make_rng(seed, stream_number, 'values'), typ, domain, shapes,
+        (timestamp for timestamp, late in for_values),
+    )
+
+    return ((timestamp, value, late) for (timestamp, late), value in itertools.izip(datapoints, values))
+
+
+def insert_datapoints(stream, datapoints):
+    # Inserts (timestamp, value) datapoints into the highest granularity of a MongoDB backend
+    # stream with one write. Unlike append, it does not check or update stream metadata.
+    # Returns timestamps of inserted datapoints, as stored by the backend.
+
+    documents = []
+    for timestamp, value in datapoints:
+        if stream.value_type == 'numeric' and isinstance(value, numbers.Number):
+            value = stream.serialize_numeric_value(value)
+
+        documents.append({
+            '_id': datastream.backend._generate_object_id(timestamp),
+            'm': stream.id,
+            'v': value,
+        })
+
+    db = mongoengine.connection.get_db(mongodb.DATABASE_ALIAS)
+    getattr(db.datapoints, stream.highest_granularity.name).insert(documents, w=1)
+
+    return [document['_id'].generation_time for document in documents]
+
+
+def append_bulk(args):
+    # Appends generated datapoints of one stream and downsamples them. Returns the number of datapoints.
+    stream_id, stream_number, typ, domain, shapes, seed, span_from, span_to, interval, batch_size = args
+
+    datapoints = generate_datapoints(seed, stream_number, typ, domain, shapes, span_from, span_to, interval)
+
+    stream = None
+    if datastream_workers.is_supported():
+        stream = mongodb.Stream.objects.get(external_id=uuid.UUID(stream_id))
+
+        # Derived streams are updated only when appending to streams they are derived from.
+        if stream.contributes_to:
+            stream = None
+
+    count = 0
+    if stream is not None:
+        # With the MongoDB backend every batch is inserted with one write, and stream
+        # metadata is updated once at the end. The stream is downsampled below, so there
+        # is no need to record last datapoints or to mark it as dirty.
+        timestamps = [timestamp.replace(tzinfo=pytz.utc) for timestamp in (stream.earliest_datapoint, stream.latest_datapoint) if timestamp]
+        while True:
+            batch = [(timestamp, value) for timestamp, value, late in itertools.islice(datapoints, batch_size)]
+            if not batch:
+                break
+
+            inserted = insert_datapoints(stream, batch)
+            count += len(batch)
+
+            timestamps = [min(timestamps + inserted), max(timestamps + inserted)]
+
+        if timestamps:
+            mongodb.Stream._get_collection().update(
+                {'_id': stream.pk},
+                {'$set': {'earliest_datapoint': timestamps[0], 'latest_datapoint': timestamps[1]}},
+            )
+    else:
+        for timestamp, value, late in datapoints:
+            # Late datapoints are older than the latest datapoint. The stream is downsampled
+            # below, so there is no need to mark it as dirty.
+            datastream.append(stream_id, value, timestamp, check_timestamp=not late, mark_dirty=False)
+            count += 1
+
+    datastream.downsample_streams(query_tags={'stream_id': stream_id}, until=span_to)
+
+    return count
+
+
 class Command(base.BaseCommand):
     option_list = base.BaseCommand.option_list + (
         optparse.make_option(
@@ -107,6 +314,26 @@ class Command(base.BaseCommand):
             '--no-real-time', action='store_true', dest='norealtime', default=False,
             help="Just insert for the given time span without appending in real-time.",
         ),
+        optparse.make_option(
+            '--seed', action='store', type='int', dest='seed',
+            help="Seed for the random number generator, so that the same datapoints are generated every time.",
+        ),
+        optparse.make_option(
+            '--bulk', action='store_true', dest='bulk', default=False,
+            help="Generate datapoints for the given time span stream by stream, without real-time appending between them. With the MongoDB backend, datapoints are inserted in batches.",
+        ),
+        optparse.make_option(
+            '--shape', action='store', type='string', dest='shape', default='random',
+            help="Workload shape in bulk mode given as comma-separated values of %s (default: random)." % ", ".join("'%s'" % shape for shape in VALUE_SHAPES + TIME_SHAPES),
+        ),
+        optparse.make_option(
+            '--workers', '-w', action='store', type='int', dest='workers', default=1,
+            help="Number of worker processes appending to streams in bulk mode (default: 1).",
+        ),
+        optparse.make_option(
+            '--batch-size', action='store', type='int', dest='batch_size', default=DEFAULT_BATCH_SIZE,
+            help="Number of datapoints inserted with one write in bulk mode (default: %s)." % DEFAULT_BATCH_SIZE,
+        ),
     )
 
     help = "Regularly append dummy datapoints to streams."
@@ -139,6 +366,33 @@ class Command(base.BaseCommand):
         demo = options.get('demo')
         span = options.get('span')
         norealtime = options.get('norealtime')
+        seed = options.get('seed')
+        bulk = options.get('bulk')
+        shapes = (options.get('shape') or 'random').split(',')
+        workers = options.get('workers') or 1
+        batch_size = options.get('batch_size', DEFAULT_BATCH_SIZE)
+
+        for shape in shapes:
+            if shape not in VALUE_SHAPES + TIME_SHAPES:
+                raise base.CommandError("Unknown workload shape '%s'." % shape)
+
+        if not bulk and (shapes != ['random'] or workers != 1 or batch_size != DEFAULT_BATCH_SIZE):
+            raise base.CommandError("Workload shapes, workers, and batch size can be used only in bulk mode.")
+
+        if bulk and not span:
+            raise base.CommandError("Bulk mode requires a time span.")
+
+        if workers < 1:
+            raise base.CommandError("Number of workers must be a positive integer.")
+
+        if batch_size < 1:
+            raise base.CommandError("Batch size must be a positive integer.")
+
+        if workers > 1 and not datastream_workers.is_supported():
+            raise base.CommandError("Multiple workers are supported only with the MongoDB backend.")
+
+        if seed is not None:
+            random.seed(seed)
 
         if nstreams is None and types is None and not demo and flush:
             datastream.delete_streams()
@@ -251,18 +505,36 @@ class Command(base.BaseCommand):
                 td = span_to - span_from
                 self.stdout.write("Appending %d values from %s to %s.\n" % (((td.seconds + td.days * 24 * 3600) // interval * len(streams)), span_from, span_to))
 
-            while span_from <= span_to:
-                for stream_id, (typ, domain) in streams:
-                    type_constructor, random_function, default_domain = TYPES[typ]
-                    value = random_function(*[type_constructor(d) for d in (domain or default_domain).split(',')])
-                    datastream.append(stream_id, value, span_from)
+            if bulk:
+                if seed is None:
+                    seed = random.getrandbits(32)
 
-                span_from += datetime.timedelta(seconds=interval)
+                bulk_streams = [
+                    (stream_id, i, typ, domain, shapes, seed, span_from, span_to, interval, batch_size)
+                    for i, (stream_id, (typ, domain)) in enumerate(streams)
+                ]
 
-            if verbose > 1:
-                self.stdout.write("Done. Downsampling.\n")
+                if workers > 1:
+                    counts = datastream_workers.map(append_bulk, bulk_streams, workers)
+                else:
+                    counts = [append_bulk(args) for args in bulk_streams]
+
+                if verbose > 1:
+                    self.stdout.write("Done. Appended %d values.\n" % sum(counts))
+
+            else:
+                while span_from <= span_to:
+                    for stream_id, (typ, domain) in streams:
+                        type_constructor, random_function, default_domain = TYPES[typ]
+                        value = random_function(random, *[type_constructor(d) for d in (domain or default_domain).split(',')])
+                        datastream.append(stream_id, value, span_from)
+
+                    span_from += datetime.timedelta(seconds=interval)
+
+                if verbose > 1:
+                    self.stdout.write("Done. Downsampling.\n")
 
-            datastream.downsample_streams(until=span_to)
+                datastream.downsample_streams(until=span_to)
 
         if norealtime:
             return
@@ -273,7 +545,7 @@ class Command(base.BaseCommand):
         while True:
             for stream_id, (typ, domain) in streams:
                 type_constructor, random_function, default_domain = TYPES[typ]
-                value = random_function(*[type_constructor(d) for d in (domain or default_domain).split(',')])
+                value = random_function(random, *[type_constructor(d) for d in (domain or default_domain).split(',')])
 
                 if verbose > 1:
                     self.stdout.write("Appending value '%s' to stream '%s'.\n" % (value, stream_id))
@@ -0,0 +1,383 @@
+import calendar
+import datetime
+
+from django.conf import settings
+from django.core import cache as django_cache
+
+import pytz
+
+from datastream import api as datastream_api
+
+from . import datastream, metrics, serializers, timing
+
+# Number of granularity intervals in one block.
+BLOCK_SIZE = getattr(settings, 'DATASTREAM_MATERIALIZE_BLOCK_SIZE', 1000)
+
+# Maximum number of blocks used for one query. Longer time ranges are queried as usual.
+MAX_BLOCKS = getattr(settings, 'DATASTREAM_MATERIALIZE_MAX_BLOCKS', 100)
+
+# Time downsamplers whose values are inside the downsampled interval and can be used
+# to determine the interval of the datapoint.
+INTERVAL_TIME_DOWNSAMPLERS = ('first', 'mean', 'last')
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def get_cache():
+    # Django cache used to store pre-serialized blocks of downsampled datapoints.
+    # Setting is read on every call, so that it can be changed in tests.
+    cache_name = getattr(settings, 'DATASTREAM_MATERIALIZE_CACHE', None)
+    if cache_name is None:
+        return None
+
+    return django_cache.caches[cache_name]
+
+
+def _make_aware(timestamp):
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=pytz.utc)
+
+    return timestamp
+
+
+def _to_seconds(timestamp):
+    return calendar.timegm(timestamp.utctimetuple())
+
+
+def block_duration(granularity):
+    return granularity.duration_in_seconds() * BLOCK_SIZE
+
+
+def block_index(granularity, timestamp):
+    return _to_seconds(timestamp) // block_duration(granularity)
+
+
+def block_start(granularity, index):
+    return EPOCH + datetime.timedelta(seconds=index * block_duration(granularity))
+
+
+def get_block_key(stream_id, granularity, index, serializer, time_format):
+    return 'datastream:materialized:%s:%s:%s:%s:%d' % (stream_id, granularity.name, serializer.datetime_formatting, time_format, index)
+
+
+def get_count_key(stream_id, granularity, index):
+    # The number of datapoints in a block does not depend on how they are serialized.
+    return 'datastream:materialized:count:%s:%s:%d' % (stream_id, granularity.name, index)
+
+
+def is_block_closed(granularity, index, closed_until):
+    return block_start(granularity, index + 1) <= closed_until
+
+
+def interval_start(granularity, datapoint):
+    # Downsampled datapoints are stored at the start of their interval.
+    timestamp = datapoint['t']
+
+    if not isinstance(timestamp, dict):
+        return None
+
+    for downsampler in INTERVAL_TIME_DOWNSAMPLERS:
+        if datastream.TIME_DOWNSAMPLERS[downsampler] in timestamp:
+            return _to_seconds(granularity.round_timestamp(timestamp[datastream.TIME_DOWNSAMPLERS[downsampler]]))
+
+    return None
+
+
+def build_block(stream_id, granularity, index, serializer, time_format):
+    # Returns a list of (timestamp, serialized JSON) pairs for all datapoints in
+    # the block, or None if datapoints cannot be materialized.
+
+    block = []
+    for datapoint in datastream.get_data(
+        stream_id=stream_id,
+        granularity=granularity,
+        start=block_start(granularity, index),
+        end_exclusive=block_start(granularity, index + 1),
+    ):
+        timestamp = interval_start(granularity, datapoint)
+        if timestamp is None:
+            return None
+
+        block.append((timestamp, serializer.to_json(datapoint, {'time_format': time_format})))
+
+    return block
+
+
+def count_block(stream_id, granularity, index):
+    return datastream.get_data(
+        stream_id=stream_id,
+        granularity=granularity,
+        start=block_start(granularity, index),
+        end_exclusive=block_start(granularity, index + 1),
+    ).count()
+
+
+def store_blocks(cache, stream_id, granularity, blocks, serializer, time_format):
+    # Stores blocks, given as a dict of block indices and blocks, together with their counts.
+    values = {}
+    for index, block in blocks.items():
+        values[get_block_key(stream_id, granularity, index, serializer, time_format)] = block
+        values[get_count_key(stream_id, granularity, index)] = len(block)
+
+    if values:
+        cache.set_many(values, None)
+
+
+class MaterializedDatapoints(datastream_api.ResultsBase):
+    # Datapoints from blocks of (timestamp, serialized JSON) pairs, limited to the time range
+    # from start (inclusive) to end (exclusive), in seconds. Slicing reads only blocks which
+    # contain datapoints of the slice and returns a list of their serialized JSON, which is
+    # included directly into the output. To find the blocks, numbers of datapoints in blocks
+    # are stored separately, only blocks at the edges of the time range have to be read.
+
+    def __init__(self, stream_id, granularity, indices, start, end, reverse, serializer, time_format, closed_until):
+        self.stream_id = stream_id
+        self.granularity = granularity
+        self.indices = indices
+        self.start = start
+        self.end = end
+        self.reverse = reverse
+        self.serializer = serializer
+        self.time_format = time_format
+        self.closed_until = closed_until
+
+        self._blocks = {}
+        self._counts = None
+
+    def _is_whole(self, index):
+        # Is the whole block inside the time range.
+        return self.start <= _to_seconds(block_start(self.granularity, index)) and _to_seconds(block_start(self.granularity, index + 1)) <= self.end
+
+    def _load_blocks(self, indices):
+        # Returns blocks for given indices, only with datapoints inside the time range.
+
+        missing_indices = [index for index in indices if index not in self._blocks]
+
+        if missing_indices:
+            with timing.phase('materialized'):
+                self._read_blocks(missing_indices)
+
+        return [self._blocks[index] for index in indices]
+
+    def _read_blocks(self, indices):
+        cache = get_cache()
+        keys = dict((get_block_key(self.stream_id, self.granularity, index, self.serializer, self.time_format), index) for index in indices)
+        blocks = dict((keys[key], block) for key, block in cache.get_many(keys.keys()).items())
+
+        metrics.record_cache('materialized', len(blocks), len(keys) - len(blocks))
+
+        missing = {}
+        for index in indices:
+            if index in blocks:
+                continue
+
+            block = build_block(self.stream_id, self.granularity, index, self.serializer, self.time_format)
+            # Should not happen, streams without needed time downsamplers are not materialized.
+            assert block is not None
+
+            blocks[index] = block
+
+            # Only whole closed blocks are stored.
+            if is_block_closed(self.granularity, index, self.closed_until):
+                missing[index] = block
+
+        store_blocks(cache, self.stream_id, self.granularity, missing, self.serializer, self.time_format)
+
+        for index, block in blocks.items():
+            if not self._is_whole(index):
+                block = [(timestamp, datapoint) for timestamp, datapoint in block if self.start <= timestamp < self.end]
+            self._blocks[index] = block
+
+    def _get_counts(self):
+        # Numbers of datapoints inside the time range for all blocks, in time order.
+
+        if self._counts is not None:
+            return self._counts
+
+        counts = {}
+
+        # Blocks at the edges are only partially inside the time range, so they have to be read.
+        partial = [index for index in self.indices if not self._is_whole(index)]
+        for index, block in zip(partial, self._load_blocks(partial)):
+            counts[index] = len(block)
+
+        whole = [index for index in self.indices if index not in counts]
+        if whole:
+            with timing.phase('materialized'):
+                counts.update(self._read_counts(whole))
+
+        self._counts = [counts[index] for index in self.indices]
+        return self._counts
+
+    def _read_counts(self, indices):
+        cache = get_cache()
+        keys = dict((get_count_key(self.stream_id, self.granularity, index), index) for index in indices)
+        counts = dict((keys[key], count) for key, count in cache.get_many(keys.keys()).items())
+
+        missing = {}
+        for index in indices:
+            if index in counts:
+                continue
+
+            counts[index] = count_block(self.stream_id, self.granularity, index)
+
+            if is_block_closed(self.granularity, index, self.closed_until):
+                missing[get_count_key(self.stream_id, self.granularity, index)] = counts[index]
+
+        if missing:
+            cache.set_many(missing, None)
+
+        return counts
+
+    def count(self):
+        return sum(self._get_counts())
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def _get_range(self, first, last):
+        # Returns (timestamp, serialized JSON) pairs for datapoints from first to last (exclusive)
+        # position in time order.
+
+        indices = []
+        skip = None
+        position = 0
+        for index, count in zip(self.indices, self._get_counts()):
+            if position + count > first and position < last:
+                if skip is None:
+                    skip = first - position
+                indices.append(index)
+            position += count
+
+        datapoints = []
+        for block in self._load_blocks(indices):
+            datapoints.extend(block)
+
+        return datapoints[skip:skip + last - first] if indices else []
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            datapoints = self[key:key + 1] if key >= 0 else self[key:key + 1 or None]
+            if not datapoints:
+                raise IndexError("Datapoint index out of range")
+            return datapoints[0]
+
+        if key.step not in (None, 1):
+            raise ValueError("Slicing with a step is not supported")
+
+        if (key.start or 0) >= 0 and key.stop is not None and key.stop >= 0 and not self.reverse:
+            # The total count is not needed.
+            first, last = key.start or 0, key.stop
+        else:
+            first, last, step = key.indices(self.count())
+            if self.reverse:
+                count = self.count()
+                first, last = count - last, count - first
+
+        if last <= first:
+            return []
+
+        datapoints = self._get_range(first, last)
+
+        if self.reverse:
+            datapoints.reverse()
+
+        return [serializers.JSONString(datapoint) for timestamp, datapoint in datapoints]
+
+
+def get_closed_until(stream, granularity):
+    # Datapoints before this time do not change anymore.
+    downsampled_until = (getattr(stream, 'downsampled_until', None) or {}).get(granularity.name, None)
+    if downsampled_until is None:
+        return None
+
+    return _make_aware(downsampled_until)
+
+
+def materialize_stream(stream, serializer):
+    # Materializes all closed blocks of all downsampled granularities of the stream
+    # which are not yet materialized, in the default time format of the serializer.
+    # Returns the number of materialized blocks.
+
+    cache = get_cache()
+    if cache is None or stream.earliest_datapoint is None:
+        return 0
+
+    count = 0
+    for granularity in datastream.Granularity.values:
+        if granularity >= stream.highest_granularity:
+            continue
+
+        closed_until = get_closed_until(stream, granularity)
+        if closed_until is None:
+            continue
+
+        first = block_index(granularity, _make_aware(stream.earliest_datapoint))
+        # Only blocks which are whole before the closed time.
+        last = block_index(granularity, closed_until) - 1
+
+        for start in xrange(first, last + 1, MAX_BLOCKS):
+            indices = range(start, min(start + MAX_BLOCKS, last + 1))
+            keys = dict((get_block_key(stream.id, granularity, index, serializer, serializer.time_format), index) for index in indices)
+            existing = cache.get_many(keys.keys())
+
+            blocks = {}
+            for key, index in keys.items():
+                if key in existing:
+                    continue
+
+                block = build_block(stream.id, granularity, index, serializer, serializer.time_format)
+                if block is None:
+                    return count
+
+                blocks[index] = block
+
+            store_blocks(cache, stream.id, granularity, blocks, serializer, serializer.time_format)
+            count += len(blocks)
+
+    return count
+
+
+def get_datapoints(stream, params, serializer, time_format):
+    # Returns materialized datapoints for query params, or None if they cannot be
+    # used. Query params should be checked to be materializable by the caller.
+    # Blocks are read (and missing closed blocks materialized) only when sliced.
+
+    cache = get_cache()
+    if cache is None or stream.earliest_datapoint is None:
+        return None
+
+    # Without these datapoints cannot be assigned to blocks.
+    if not set(INTERVAL_TIME_DOWNSAMPLERS) & set(stream.time_downsamplers):
+        return None
+
+    granularity = params['granularity']
+
+    closed_until = get_closed_until(stream, granularity)
+    if closed_until is None:
+        return None
+
+    # Same semantics as the backend: start is rounded to the interval of the granularity.
+    if params['start_exclusive'] is not None:
+        start = _to_seconds(granularity.round_timestamp(_make_aware(params['start_exclusive']))) + 1
+    else:
+        start = _to_seconds(granularity.round_timestamp(max(_make_aware(params['start']), _make_aware(stream.earliest_datapoint))))
+
+    if params['end_exclusive'] is not None:
+        end = _to_seconds(_make_aware(params['end_exclusive']))
+    else:
+        end = _to_seconds(_make_aware(params['end'])) + 1
+
+    if end <= start:
+        return MaterializedDatapoints(stream.id, granularity, [], start, end, params['reverse'], serializer, time_format, closed_until)
+
+    first = start // block_duration(granularity)
+    last = (end - 1) // block_duration(granularity)
+
+    if last - first + 1 > MAX_BLOCKS:
+        return None
+
+    return MaterializedDatapoints(stream.id, granularity, range(first, last + 1), start, end, params['reverse'], serializer, time_format, closed_until)
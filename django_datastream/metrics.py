@@ -0,0 +1,311 @@
+import atexit
+import collections
+import threading
+import time
+
+from django.conf import settings
+from django.core import cache as django_cache, exceptions as django_exceptions
+from django.utils import crypto
+
+import datastream
+
+# Collect metrics of API requests and downsampling, exported in Prometheus text format.
+METRICS = getattr(settings, 'DATASTREAM_METRICS', False)
+
+# Django cache used to store metrics, so that they are shared between processes (web server
+# workers and the downsample command). It should support atomic increments (like memcached
+# or Redis). Required when metrics are enabled.
+METRICS_CACHE = getattr(settings, 'DATASTREAM_METRICS_CACHE', None)
+
+if METRICS and METRICS_CACHE is None:
+    raise django_exceptions.ImproperlyConfigured("DATASTREAM_METRICS_CACHE setting is required when DATASTREAM_METRICS is enabled.")
+
+# Counters are accumulated in every process and added to the cache at most every this many
+# seconds (and when the process exits), so that requests do not wait on the cache. With 0
+# they are added after every request.
+FLUSH_INTERVAL = getattr(settings, 'DATASTREAM_METRICS_FLUSH_INTERVAL', 10)
+
+# Metrics can be fetched by anyone, unless access is restricted to requests with this token in
+# "Authorization: Bearer <token>" header, or to staff users, or to both (either is then enough).
+METRICS_TOKEN = getattr(settings, 'DATASTREAM_METRICS_TOKEN', None)
+METRICS_STAFF_ONLY = getattr(settings, 'DATASTREAM_METRICS_STAFF_ONLY', False)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Resource views and their endpoint names in metrics.
+VIEW_ENDPOINTS = {
+    'dispatch_list': 'list',
+    'dispatch_detail': 'detail',
+    'get_multiple': 'multiple',
+    'get_schema': 'schema',
+    'append_datapoints': 'append',
+}
+ENDPOINTS = ('list', 'detail', 'multiple', 'schema', 'append')
+
+# Requests without datapoints have an empty granularity.
+GRANULARITIES = ('',) + tuple(granularity.name for granularity in datastream.Granularity.values)
+
+# Request phases (see timing module) which are backend calls.
+BACKEND_PHASES = ('tags', 'data', 'count', 'materialized')
+
+CACHES = ('response', 'materialized')
+CACHE_RESULTS = ('hit', 'miss')
+
+DOWNSAMPLE_GAUGES = (
+    ('datastream_downsample_last_run_timestamp_seconds', "Time when the last downsample run finished, in seconds since UNIX epoch."),
+    ('datastream_downsample_last_run_duration_seconds', "Duration of the last downsample run."),
+    ('datastream_downsample_last_run_streams', "Number of streams downsampled in the last downsample run, if known."),
+    ('datastream_downsample_max_lag_seconds', "Maximum time between the latest datapoint and the end of downsampled datapoints after the last downsample run."),
+)
+
+# Durations are stored as integer microseconds, so that they can be atomically incremented in a cache.
+MICROSECONDS = 1000000
+
+CACHE_KEY_PREFIX = 'datastream:metrics:'
+
+
+class CacheStore(object):
+    def __init__(self, cache):
+        self.cache = cache
+
+    def incr(self, key, delta=1):
+        key = CACHE_KEY_PREFIX + key
+
+        try:
+            self.cache.incr(key, delta)
+        except ValueError:
+            # Key does not exist yet. Adding is atomic, if it fails, somebody else has added it in the meantime.
+            if not self.cache.add(key, delta, None):
+                self.cache.incr(key, delta)
+
+    def incr_many(self, deltas):
+        for key, delta in deltas.items():
+            self.incr(key, delta)
+
+    def set_many(self, values):
+        self.cache.set_many(dict((CACHE_KEY_PREFIX + key, value) for key, value in values.items()), None)
+
+    def get_many(self, keys):
+        values = self.cache.get_many([CACHE_KEY_PREFIX + key for key in keys])
+        return dict((key[len(CACHE_KEY_PREFIX):], value) for key, value in values.items())
+
+
+def get_store():
+    return CacheStore(django_cache.caches[METRICS_CACHE])
+
+
+class Counters(object):
+    # Accumulates increments of counters in the process and adds them to the store in batches.
+
+    def __init__(self):
+        self.deltas = collections.defaultdict(int)
+        self.lock = threading.Lock()
+        self.flushed = time.time()
+
+    def add(self, deltas):
+        with self.lock:
+            for key, delta in deltas.items():
+                self.deltas[key] += delta
+
+            due = time.time() - self.flushed >= FLUSH_INTERVAL
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            deltas = self.deltas
+            self.deltas = collections.defaultdict(int)
+            self.flushed = time.time()
+
+        if deltas:
+            get_store().incr_many(deltas)
+
+
+_counters = Counters()
+
+
+def flush():
+    # Adds counters accumulated in this process to the store.
+    if not METRICS:
+        return
+
+    _counters.flush()
+
+
+atexit.register(flush)
+
+
+def series(name, **labels):
+    if not labels:
+        return name
+
+    return '%s{%s}' % (name, ','.join('%s="%s"' % (label, value) for label, value in sorted(labels.items())))
+
+
+def record_datapoints(request, granularity, count):
+    # Datapoints served by the request are reported when the request finishes. It should be called
+    # only from the thread handling the request.
+    if not METRICS:
+        return
+
+    request.__dict__['_datastream_granularity'] = granularity.name
+    request.__dict__['_datastream_datapoints'] = request.__dict__.get('_datastream_datapoints', 0) + count
+
+
+def record_served_datapoints(endpoint, granularity, count):
+    # Datapoints served after the request has finished, by streamed responses.
+    if not METRICS or not count:
+        return
+
+    _counters.add({series('datastream_datapoints_served_total', endpoint=endpoint, granularity=granularity.name): count})
+
+
+def record_cache(cache, hits, misses):
+    if not METRICS:
+        return
+
+    deltas = {}
+    if hits:
+        deltas[series('datastream_cache_requests_total', cache=cache, result='hit')] = hits
+    if misses:
+        deltas[series('datastream_cache_requests_total', cache=cache, result='miss')] = misses
+
+    _counters.add(deltas)
+
+
+def observe_request(request, view, duration, timing):
+    if not METRICS or view not in VIEW_ENDPOINTS:
+        return
+
+    endpoint = VIEW_ENDPOINTS[view]
+    granularity = request.__dict__.get('_datastream_granularity', '')
+    deltas = collections.defaultdict(int)
+
+    for bucket in LATENCY_BUCKETS:
+        if duration <= bucket:
+            break
+    else:
+        bucket = '+Inf'
+
+    deltas[series('datastream_http_request_duration_seconds_bucket', endpoint=endpoint, granularity=granularity, le=bucket)] += 1
+    deltas[series('datastream_http_request_duration_seconds_sum', endpoint=endpoint, granularity=granularity)] += int(duration * MICROSECONDS)
+
+    datapoints = request.__dict__.get('_datastream_datapoints', 0)
+    if datapoints:
+        deltas[series('datastream_datapoints_served_total', endpoint=endpoint, granularity=granularity)] += datapoints
+
+    if timing is not None:
+        for phase, (total, calls) in timing.phases.items():
+            if phase not in BACKEND_PHASES:
+                continue
+
+            deltas[series('datastream_backend_calls_total', phase=phase)] += calls
+            deltas[series('datastream_backend_call_seconds_total', phase=phase)] += int(total * MICROSECONDS)
+
+    _counters.add(deltas)
+
+
+def set_downsample_run(timestamp, duration, streams, max_lag):
+    if not METRICS:
+        return
+
+    values = zip([name for name, help_text in DOWNSAMPLE_GAUGES], (timestamp, duration, streams, max_lag))
+    get_store().set_many(dict((name, value) for name, value in values if value is not None))
+
+
+def is_authorized(request):
+    if METRICS_TOKEN is None and not METRICS_STAFF_ONLY:
+        return True
+
+    if METRICS_TOKEN is not None:
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        if authorization.startswith('Bearer ') and crypto.constant_time_compare(authorization[len('Bearer '):], METRICS_TOKEN):
+            return True
+
+    if METRICS_STAFF_ONLY:
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_active and user.is_staff:
+            return True
+
+    return False
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+
+    return '%d' % value
+
+
+def render():
+    # Returns all metrics in Prometheus text format. Counters of other processes are
+    # included as they were when those processes last added them to the store.
+
+    flush()
+
+    histograms = []
+    for endpoint in ENDPOINTS:
+        for granularity in GRANULARITIES:
+            labels = {'endpoint': endpoint, 'granularity': granularity}
+            buckets = [series('datastream_http_request_duration_seconds_bucket', le=bucket, **labels) for bucket in LATENCY_BUCKETS + ('+Inf',)]
+            histograms.append((labels, buckets, series('datastream_http_request_duration_seconds_sum', **labels)))
+
+    counters = [
+        ('datastream_datapoints_served_total', "Number of datapoints served.", [
+            series('datastream_datapoints_served_total', endpoint=endpoint, granularity=granularity) for endpoint in ENDPOINTS for granularity in GRANULARITIES
+        ], 1),
+        ('datastream_backend_calls_total', "Number of backend calls by request phase.", [
+            series('datastream_backend_calls_total', phase=phase) for phase in BACKEND_PHASES
+        ], 1),
+        ('datastream_backend_call_seconds_total', "Time spent in backend calls by request phase.", [
+            series('datastream_backend_call_seconds_total', phase=phase) for phase in BACKEND_PHASES
+        ], MICROSECONDS),
+        ('datastream_cache_requests_total', "Number of cache lookups by cache and result.", [
+            series('datastream_cache_requests_total', cache=cache, result=result) for cache in CACHES for result in CACHE_RESULTS
+        ], 1),
+    ]
+
+    keys = [name for name, help_text in DOWNSAMPLE_GAUGES]
+    for labels, buckets, sum_key in histograms:
+        keys.extend(buckets)
+        keys.append(sum_key)
+    for name, help_text, counter_keys, scale in counters:
+        keys.extend(counter_keys)
+
+    values = get_store().get_many(keys)
+
+    lines = [
+        '# HELP datastream_http_request_duration_seconds Latency of API requests by endpoint and granularity.',
+        '# TYPE datastream_http_request_duration_seconds histogram',
+    ]
+    for labels, buckets, sum_key in histograms:
+        count = sum(values.get(bucket, 0) for bucket in buckets)
+        if not count:
+            continue
+
+        # Buckets are stored separately and are cumulative only in the output.
+        cumulative = 0
+        for bucket, key in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+            cumulative += values.get(key, 0)
+            lines.append('%s %d' % (series('datastream_http_request_duration_seconds_bucket', le=bucket, **labels), cumulative))
+        lines.append('%s %s' % (series('datastream_http_request_duration_seconds_sum', **labels), _format_value(float(values.get(sum_key, 0)) / MICROSECONDS)))
+        lines.append('%s %d' % (series('datastream_http_request_duration_seconds_count', **labels), count))
+
+    for name, help_text, counter_keys, scale in counters:
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s counter' % name)
+        for key in counter_keys:
+            if key in values:
+                value = values[key] if scale == 1 else float(values[key]) / scale
+                lines.append('%s %s' % (key, _format_value(value)))
+
+    for name, help_text in DOWNSAMPLE_GAUGES:
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s gauge' % name)
+        if name in values:
+            lines.append('%s %s' % (name, _format_value(values[name])))
+
+    return '\n'.join(lines) + '\n'
@@ -1,7 +1,67 @@
+import base64
+import calendar
+import datetime
+import itertools
+import urllib
+
 from django.conf import settings
 
 from tastypie import exceptions, paginator
 
+import pytz
+
+import datastream
+
+from . import executor, timing
+
+CURSOR_NEXT = 'n'
+CURSOR_PREVIOUS = 'p'
+
+QUERY_COUNT = 'count'
+
+# Modes of counting total number of objects.
+COUNT_EXACT = 'true'
+COUNT_NONE = 'false'
+COUNT_ESTIMATE = 'estimate'
+
+# Time downsamplers whose values are inside the downsampled interval and can be used
+# to determine the interval of the datapoint, in the order of preference.
+CURSOR_TIME_DOWNSAMPLERS = ('first', 'mean', 'last')
+
+
+class InvalidCursor(exceptions.BadRequest):
+    pass
+
+
+def encode_cursor(direction, timestamp, skip):
+    # Cursor is opaque to the client. It contains the direction of pagination, the timestamp
+    # (with microseconds) of the boundary datapoint, and the number of datapoints at that
+    # timestamp which have already been returned in that direction.
+    return base64.urlsafe_b64encode('%s%d.%06d,%d' % (direction, calendar.timegm(timestamp.utctimetuple()), timestamp.microsecond, skip)).rstrip('=')
+
+
+def decode_cursor(cursor):
+    # Returns None for an empty cursor, which means the first page.
+    if not cursor:
+        return None
+
+    try:
+        decoded = base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4))
+        direction = decoded[0]
+        timestamp, skip = decoded[1:].split(',')
+        seconds, microseconds = timestamp.split('.')
+        seconds, microseconds, skip = int(seconds), int(microseconds), int(skip)
+        if not 0 <= microseconds < 1000000 or skip < 0:
+            raise ValueError
+        timestamp = datetime.datetime.fromtimestamp(seconds, pytz.utc).replace(microsecond=microseconds)
+    except (TypeError, ValueError, IndexError, OverflowError, UnicodeEncodeError):
+        raise InvalidCursor("Invalid cursor: '%s'" % cursor)
+
+    if direction not in (CURSOR_NEXT, CURSOR_PREVIOUS):
+        raise InvalidCursor("Invalid cursor: '%s'" % cursor)
+
+    return direction, timestamp, skip
+
 
 class Paginator(paginator.Paginator):
     # Tastypie paginator does not return any previous page if page start would
@@ -23,6 +83,10 @@ class Paginator(paginator.Paginator):
 
         return self._generate_uri(limit, offset - limit)
 
+    def get_count(self):
+        with timing.phase('count'):
+            return executor.call(super(Paginator, self).get_count)
+
     def page(self):
         page = super(Paginator, self).page()
 
@@ -39,6 +103,31 @@ class Paginator(paginator.Paginator):
 
 class BatchSizePaginator(Paginator):
     # This paginator optimizes batch size when using datastream.
+    #
+    # Counting all objects can be expensive, so with "count" set to "false" total
+    # count is not returned, and with "estimate" an estimate is returned, if the
+    # resource provides a function to estimate it (otherwise it is counted). In both
+    # cases we fetch one object more to know if there is a next page.
+
+    def __init__(self, request_data, objects, estimate_count=None, **kwargs):
+        super(BatchSizePaginator, self).__init__(request_data, objects, **kwargs)
+
+        self.estimate_count = estimate_count
+
+    def get_count_mode(self):
+        count_mode = self.request_data.get(QUERY_COUNT, COUNT_EXACT) or COUNT_EXACT
+
+        if count_mode not in (COUNT_EXACT, COUNT_NONE, COUNT_ESTIMATE):
+            raise exceptions.BadRequest("Invalid count '%s' provided. Please provide '%s', '%s', or '%s'." % (count_mode, COUNT_EXACT, COUNT_NONE, COUNT_ESTIMATE))
+
+        return count_mode
+
+    def get_estimated_count(self):
+        if self.estimate_count is None:
+            return self.get_count()
+
+        with timing.phase('count'):
+            return self.estimate_count()
 
     def get_slice(self, limit, offset):
         # Mostly just a copy of parent get_slice.
@@ -51,11 +140,77 @@ class BatchSizePaginator(Paginator):
 
         return self.objects[offset:offset + limit]
 
+    def read(self, objects):
+        # Objects are lazy, they are queried only when read.
+        return executor.call(list, objects)
+
+    def page(self):
+        count_mode = self.get_count_mode()
+
+        if count_mode == COUNT_EXACT:
+            return super(BatchSizePaginator, self).page()
+
+        limit = self.get_limit()
+        offset = self.get_offset()
+
+        if limit:
+            # We fetch one object more to know if there is a next page, so that we do not have to count.
+            objects = self.read(self.get_slice(limit + 1, offset))
+            more = len(objects) > limit
+            objects = objects[:limit]
+        else:
+            objects = self.get_slice(limit, offset)
+            more = False
+
+        meta = {
+            'offset': offset,
+            'limit': limit,
+            'previous': None,
+            'next': None,
+        }
+
+        if count_mode == COUNT_ESTIMATE:
+            if more:
+                # Estimate cannot be smaller than what we have seen.
+                meta['total_count'] = max(self.get_estimated_count(), offset + limit + 1)
+            elif limit and (objects or not offset):
+                # We have reached the end, so we know the exact count.
+                meta['total_count'] = offset + len(objects)
+            elif limit:
+                # We are past the end.
+                meta['total_count'] = min(self.get_estimated_count(), offset)
+            else:
+                meta['total_count'] = self.get_estimated_count()
+
+        if limit:
+            meta['previous'] = self.get_previous(limit, offset)
+            if more:
+                meta['next'] = self._generate_uri(limit, offset + limit)
+
+        return {
+            self.collection_name: objects,
+            'meta': meta,
+        }
+
 
 class DetailPaginator(BatchSizePaginator):
     # This paginator allows limit to be zero to return no results.
     # We are using it to paginate datapoints in the detail view and to
     # allow no datapoints to be requested, but to still get other fields.
+    #
+    # When "cursor" is present in the request, datapoints are paginated using a
+    # cursor instead of an offset. Cursor contains the timestamp of the boundary
+    # datapoint and the resource is expected to already limit datapoints to
+    # those from the cursor timestamp on (or up to it, see StreamResource.obj_get),
+    # so here we only skip datapoints at the cursor timestamp which have already
+    # been returned. Because of this the cost of every page is the same, no matter
+    # how deep into the datapoints it is.
+
+    def __init__(self, request_data, objects, granularity=None, reverse=False, **kwargs):
+        super(DetailPaginator, self).__init__(request_data, objects, **kwargs)
+
+        self.granularity = granularity
+        self.reverse = reverse
 
     def get_limit(self):
         # Mostly just a copy of parent get_limit, but using
@@ -90,3 +245,146 @@ class DetailPaginator(BatchSizePaginator):
         self.objects.batch_size(limit)
 
         return self.objects[offset:offset + limit]
+
+    def read(self, objects):
+        with timing.phase('data'):
+            return super(DetailPaginator, self).read(objects)
+
+    def get_cursor_timestamp(self, datapoint):
+        timestamp = datapoint.get('t', None)
+
+        if isinstance(timestamp, dict):
+            for downsampler in CURSOR_TIME_DOWNSAMPLERS:
+                if datastream.TIME_DOWNSAMPLERS[downsampler] in timestamp:
+                    timestamp = timestamp[datastream.TIME_DOWNSAMPLERS[downsampler]]
+                    break
+            else:
+                raise InvalidCursor("Cursor pagination requires one of time downsamplers: %s" % ', '.join(CURSOR_TIME_DOWNSAMPLERS))
+
+            # Downsampled datapoints are stored at the start of their interval.
+            if self.granularity is not None:
+                timestamp = self.granularity.round_timestamp(timestamp)
+
+        if timestamp is None:
+            raise InvalidCursor("Cursor pagination requires one of time downsamplers: %s" % ', '.join(CURSOR_TIME_DOWNSAMPLERS))
+
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=pytz.utc)
+
+        return timestamp
+
+    def is_forward(self, direction):
+        # Is pagination in the given direction forward in time.
+        return (direction == CURSOR_NEXT) != self.reverse
+
+    def skip_cursor(self, objects, cursor):
+        # Datapoints are queried inclusively from the cursor timestamp in the direction of the cursor,
+        # so we skip datapoints on the other side of the timestamp (the backend rounds the start of a
+        # query to the start of the interval) and datapoints at the timestamp which have already been
+        # returned. Only the beginning of datapoints is read to skip them.
+        direction, timestamp, skip = cursor
+        forward = self.is_forward(direction)
+
+        for datapoint in objects:
+            datapoint_timestamp = self.get_cursor_timestamp(datapoint)
+
+            if datapoint_timestamp < timestamp if forward else datapoint_timestamp > timestamp:
+                continue
+
+            if datapoint_timestamp == timestamp and skip > 0:
+                skip -= 1
+                continue
+
+            yield datapoint
+
+    def get_cursor(self, direction, objects, cursor):
+        # Returns the cursor for the page after (or before) given objects in the direction, where
+        # objects are in the order of the direction, so the boundary datapoint is the last one.
+        timestamp = self.get_cursor_timestamp(objects[-1])
+        skip = len([datapoint for datapoint in objects if self.get_cursor_timestamp(datapoint) == timestamp])
+
+        # If continuing in the same direction, datapoints at the timestamp skipped by the current
+        # cursor have been returned as well.
+        if cursor is not None and cursor[0] == direction and cursor[1] == timestamp:
+            skip += cursor[2]
+
+        return encode_cursor(direction, timestamp, skip)
+
+    def _generate_cursor_uri(self, limit, direction, objects, cursor_value):
+        if self.resource_uri is None:
+            return None
+
+        cursor = self.get_cursor(direction, objects, cursor_value)
+
+        try:
+            # QueryDict has a urlencode method that can handle multiple values for the same key
+            request_params = self.request_data.copy()
+            for key in ('limit', 'offset', 'cursor'):
+                if key in request_params:
+                    del request_params[key]
+            request_params.update({'limit': limit, 'cursor': cursor})
+            encoded_params = request_params.urlencode()
+        except AttributeError:
+            request_params = {}
+
+            for key, value in self.request_data.items():
+                if key in ('limit', 'offset', 'cursor'):
+                    continue
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                request_params[key] = value
+
+            request_params.update({'limit': limit, 'cursor': cursor})
+            encoded_params = urllib.urlencode(request_params)
+
+        return '%s?%s' % (self.resource_uri, encoded_params)
+
+    def cursor_page(self):
+        limit = self.get_limit()
+        cursor = decode_cursor(self.request_data.get('cursor', None))
+        backwards = cursor is not None and cursor[0] == CURSOR_PREVIOUS
+
+        if limit == 0:
+            # If explicitly zero, return nothing
+            objects = []
+            more = False
+        else:
+            # We fetch one datapoint more to know if there is another page, so that we do not have to count.
+            if cursor is None:
+                self.objects.batch_size(limit + 1)
+                objects = self.read(self.objects[0:limit + 1])
+            else:
+                self.objects.batch_size(limit + 1 + cursor[2])
+                objects = self.read(itertools.islice(self.skip_cursor(self.objects, cursor), limit + 1))
+            more = len(objects) > limit
+            objects = objects[:limit]
+
+        if backwards:
+            # Datapoints were fetched in the opposite order, from the cursor backwards.
+            objects.reverse()
+            has_previous, has_next = more, True
+        else:
+            has_previous, has_next = cursor is not None, more
+
+        meta = {
+            'limit': limit,
+            'previous': None,
+            'next': None,
+        }
+
+        if objects:
+            if has_previous:
+                meta['previous'] = self._generate_cursor_uri(limit, CURSOR_PREVIOUS, objects[::-1], cursor)
+            if has_next:
+                meta['next'] = self._generate_cursor_uri(limit, CURSOR_NEXT, objects, cursor)
+
+        return {
+            self.collection_name: objects,
+            'meta': meta,
+        }
+
+    def page(self):
+        if 'cursor' in self.request_data:
+            return self.cursor_page()
+
+        return super(DetailPaginator, self).page()
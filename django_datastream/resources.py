@@ -1,11 +1,27 @@
+import calendar
+import collections
 import datetime
+import functools
+import hashlib
+import json
+import numbers
+import threading
+import time
+
+from multiprocessing import pool as multiprocessing_pool
 
 from django import http
-from django.conf import settings
+from django.conf import settings, urls
+from django.core import cache as django_cache
+from django.utils import http as http_utils
+from django.views.decorators import csrf
+
+import pytz
 
 from tastypie import bundle as tastypie_bundle, exceptions, fields as tastypie_fields, http as tastypie_http, resources
+from tastypie.utils import mime, trailing_slash
 
-from . import datastream, fields, paginator as datastream_paginator, serializers
+from . import datastream, dirty, executor, fields, materialize, metrics, paginator as datastream_paginator, serializers, timing, visualization
 from datastream import api as datastream_api, exceptions as datastream_exceptions
 
 
@@ -21,6 +37,35 @@ class InvalidRange(exceptions.BadRequest):
     pass
 
 
+class InvalidMaxPoints(exceptions.BadRequest):
+    pass
+
+
+class InvalidVisualDownsample(exceptions.BadRequest):
+    pass
+
+
+class InvalidFields(exceptions.BadRequest):
+    pass
+
+
+class InvalidDatapoints(exceptions.BadRequest):
+    pass
+
+
+class InvalidTimeFormat(exceptions.BadRequest):
+    pass
+
+
+class StreamedResponse(Exception):
+    # Used to pass a streamed response through Tastypie dispatch, which replaces
+    # responses which are not instances of HttpResponse with an empty response.
+
+    def __init__(self, response):
+        super(StreamedResponse, self).__init__()
+        self.response = response
+
+
 QUERY_GRANULARITY = 'granularity'
 QUERY_START = 'start'
 QUERY_END = 'end'
@@ -30,6 +75,62 @@ QUERY_VALUE_DOWNSAMPLERS = 'value_downsamplers'
 QUERY_TIME_DOWNSAMPLERS = 'time_downsamplers'
 QUERY_REVERSE = 'reverse'
 QUERY_TAGS = 'tags'
+QUERY_CURSOR = 'cursor'
+QUERY_STREAMING = 'streaming'
+QUERY_MAX_POINTS = 'max_points'
+QUERY_VISUAL_DOWNSAMPLE = 'visual_downsample'
+QUERY_POINTS = 'points'
+QUERY_FIELDS = 'fields'
+QUERY_TIME_FORMAT = 'time_format'
+
+VISUAL_DOWNSAMPLE_METHODS = ('lttb', 'minmax')
+
+# Query parameters which do not change datapoints of the response, only what is reported
+# about them, so they are not part of ETags and response cache keys.
+PRESENTATION_QUERY_PARAMS = (timing.QUERY_SERVER_TIMING, datastream_paginator.QUERY_COUNT)
+
+# Fields of streams in the MongoDB backend which are needed to construct a stream, besides tags.
+MONGODB_STREAM_FIELDS = (
+    'external_id',
+    'value_downsamplers',
+    'downsample_state',
+    'highest_granularity',
+    'derived_from',
+    'contributes_to',
+    'pending_backprocess',
+    'earliest_datapoint',
+    'latest_datapoint',
+    'value_type',
+    'value_type_options',
+)
+
+# Number of threads used to fetch datapoints of multiple streams concurrently.
+MULTIPLE_THREADS = getattr(settings, 'DATASTREAM_MULTIPLE_THREADS', 8)
+
+_thread_pool = None
+_thread_pool_lock = threading.Lock()
+
+
+def get_thread_pool():
+    # Thread pool is created lazily, so that it is created in the process
+    # which uses it (and not, for example, before forking worker processes).
+    global _thread_pool
+
+    with _thread_pool_lock:
+        if _thread_pool is None:
+            _thread_pool = multiprocessing_pool.ThreadPool(MULTIPLE_THREADS)
+
+        return _thread_pool
+
+
+def get_response_cache():
+    # Django cache used to store serialized pages of datapoints for closed time ranges.
+    # Setting is read on every call, so that it can be changed in tests.
+    cache_name = getattr(settings, 'DATASTREAM_RESPONSE_CACHE', None)
+    if cache_name is None:
+        return None
+
+    return django_cache.caches[cache_name]
 
 
 class StreamsList(datastream_api.ResultsBase):
@@ -40,10 +141,14 @@ class StreamsList(datastream_api.ResultsBase):
         self.cursor.batch_size(batch_size)
 
     def count(self):
-        return self.cursor.count()
+        return executor.call(self.cursor.count)
 
     def __iter__(self):
-        for stream in self.cursor:
+        # Streams are queried only when read.
+        with timing.phase('tags'):
+            streams = executor.call(list, self.cursor)
+
+        for stream in streams:
             yield datastream.Stream(stream)
 
     def __getitem__(self, key):
@@ -55,6 +160,14 @@ class StreamsList(datastream_api.ResultsBase):
             raise TypeError
 
 
+class CachedPage(object):
+    # Page of datapoints read from the response cache, used in place of datapoints
+    # so that they are not queried at all.
+
+    def __init__(self, page):
+        self.page = page
+
+
 class BaseResource(resources.Resource):
     @staticmethod
     def value_to_list(params, field):
@@ -68,6 +181,10 @@ class BaseResource(resources.Resource):
 
         return value
 
+    @staticmethod
+    def value_to_boolean(params, field):
+        return params.get(field, '0').lower() in ('yes', 'true', 't', '1', 'y')
+
     def basic_filter_value_to_python(self, value):
         if value in ['true', 'True', True]:
             return True
@@ -98,6 +215,61 @@ class BaseResource(resources.Resource):
         response = super(BaseResource, self).error_response(request, errors, response_class)
         return self.add_cors_headers(response)
 
+    def wrap_view(self, view):
+        wrapper = super(BaseResource, self).wrap_view(view)
+
+        @csrf.csrf_exempt
+        @functools.wraps(wrapper)
+        def timed_wrapper(request, *args, **kwargs):
+            server_timing = timing.is_enabled(request)
+
+            if not server_timing and not metrics.METRICS:
+                return wrapper(request, *args, **kwargs)
+
+            # Streamed responses are serialized after the view returns, so their
+            # serialization is not included.
+            start = time.time()
+            with timing.activate(timing.Timing()) as request_timing:
+                with timing.phase('total'):
+                    response = wrapper(request, *args, **kwargs)
+
+            metrics.observe_request(request, view, time.time() - start, request_timing)
+
+            if server_timing:
+                response['Server-Timing'] = request_timing.header()
+
+            return response
+
+        return timed_wrapper
+
+    def _get_time_format(self, request):
+        time_format = request.GET.get(QUERY_TIME_FORMAT, None)
+        if time_format is None:
+            return self._meta.serializer.time_format
+
+        if time_format not in serializers.TIME_FORMATS:
+            raise InvalidTimeFormat("Invalid time format: '%s'" % time_format)
+
+        return time_format
+
+    def _get_serializer_options(self, request):
+        return {
+            'time_format': self._get_time_format(request),
+        }
+
+    def serialize(self, request, data, format, options=None):
+        options = options or {}
+
+        try:
+            options.update(self._get_serializer_options(request))
+        except InvalidTimeFormat:
+            # Error about the invalid time format itself is serialized with the default time format.
+            if not isinstance(data, dict) or 'error' not in data:
+                raise
+
+        with timing.phase('serialize'):
+            return super(BaseResource, self).serialize(request, data, format, options)
+
     # Copy of parent method_check, with call to add_cors_headers.
     def method_check(self, request, allowed=None):
         if allowed is None:
@@ -137,6 +309,8 @@ class StreamResource(BaseResource):
         detail_paginator_class = datastream_paginator.DetailPaginator
         detail_limit = getattr(settings, 'API_DETAIL_LIMIT_PER_PAGE', 100)
         max_detail_limit = 10000
+        max_streaming_detail_limit = getattr(settings, 'API_MAX_STREAMING_DETAIL_LIMIT', 1000000)
+        max_visual_downsample_datapoints = getattr(settings, 'API_MAX_VISUAL_DOWNSAMPLE_DATAPOINTS', 100000)
 
     # TODO: Set help text (improve field types/descriptions in the schema)
     id = tastypie_fields.CharField(attribute='id', null=False, blank=False, readonly=True, unique=True, help_text=None)
@@ -161,6 +335,11 @@ class StreamResource(BaseResource):
 
         return kwargs
 
+    def prepend_urls(self):
+        return [
+            urls.url(r'^(?P<resource_name>%s)/append%s$' % (self._meta.resource_name, trailing_slash()), self.wrap_view('append_datapoints'), name='api_append_datapoints'),
+        ]
+
     def get_object_list(self, request):
         query_tags = {}
 
@@ -180,7 +359,116 @@ class StreamResource(BaseResource):
                 parent_tag = parent_tag.setdefault(tag, {})
             parent_tag[filter_bits[-1]] = value
 
-        return StreamsList(datastream.find_streams(query_tags))
+        fields = self._get_fields(request)
+
+        streams = datastream.find_streams(query_tags)
+
+        if fields is not None:
+            streams = self._project_streams(streams, fields[1])
+
+        return StreamsList(streams)
+
+    def _get_fields(self, request):
+        # Returns names of requested fields and a list of requested tag paths,
+        # or None if all fields are requested.
+
+        if not request.GET.get(QUERY_FIELDS, None):
+            return None
+
+        field_names = set()
+        tag_paths = []
+        for field in self.value_to_list(request.GET, QUERY_FIELDS):
+            field_bits = field.split('__')
+            field_name = field_bits.pop(0)
+
+            if field_name not in self.fields or (field_bits and field_name != 'tags') or not all(field_bits):
+                raise InvalidFields("Invalid field: '%s'" % field)
+
+            field_names.add(field_name)
+
+            if field_name == 'tags':
+                # Empty path means all tags.
+                tag_paths.append(tuple(field_bits))
+
+        return field_names, tag_paths
+
+    def _project_streams(self, streams, tag_paths):
+        # Datastream API does not support projections, but with the MongoDB backend we can
+        # limit the query to the requested tags. Other backends return all fields.
+
+        queryset = getattr(streams, 'queryset', None)
+        if queryset is None or not hasattr(queryset, 'only'):
+            return streams
+
+        if () in tag_paths:
+            tags = ['tags']
+        else:
+            tags = ['tags.%s' % '.'.join(path) for path in tag_paths]
+
+        streams.queryset = queryset.only(*(MONGODB_STREAM_FIELDS + tuple(tags)))
+
+        return streams
+
+    def _project_tags(self, tags, tag_paths):
+        if () in tag_paths:
+            return tags
+
+        projected = {}
+        for path in tag_paths:
+            value = tags
+            for tag in path:
+                if not isinstance(value, dict) or tag not in value:
+                    break
+                value = value[tag]
+            else:
+                parent = projected
+                for tag in path[:-1]:
+                    parent = parent.setdefault(tag, {})
+                parent[path[-1]] = value
+
+        return projected
+
+    def full_dehydrate(self, bundle, for_list=False):
+        # Mostly just a copy of parent full_dehydrate, but in the list view
+        # dehydrating only fields requested with the fields query parameter.
+
+        fields = self._get_fields(bundle.request) if for_list else None
+
+        use_in = ['all', 'list' if for_list else 'detail']
+
+        # Dehydrate each field.
+        for field_name, field_object in self.fields.items():
+            # If it's not for use in this mode, skip
+            field_use_in = getattr(field_object, 'use_in', 'all')
+            if callable(field_use_in):
+                if not field_use_in(bundle):
+                    continue
+            else:
+                if field_use_in not in use_in:
+                    continue
+
+            # If it's not requested, skip
+            if fields is not None and field_name not in fields[0]:
+                continue
+
+            # A touch leaky but it makes URI resolution work.
+            if getattr(field_object, 'dehydrated_type', None) == 'related':
+                field_object.api_name = self._meta.api_name
+                field_object.resource_name = self._meta.resource_name
+
+            bundle.data[field_name] = field_object.dehydrate(bundle, for_list=for_list)
+
+            # Check for an optional method to do further dehydration.
+            method = getattr(self, "dehydrate_%s" % field_name, None)
+
+            if method:
+                bundle.data[field_name] = method(bundle)
+
+        if fields is not None and bundle.data.get('tags', None) is not None:
+            bundle.data['tags'] = self._project_tags(bundle.data['tags'], fields[1])
+
+        bundle = self.dehydrate(bundle)
+        return bundle
 
     def apply_sorting(self, obj_list, options=None):
         # TODO: Allow sorting (use ListQuerySet from django-tastypie-mongoengine? or provide API for that in datastream)
@@ -190,15 +478,410 @@ class StreamResource(BaseResource):
         return self.get_object_list(bundle.request)
 
     def alter_detail_data_to_serialize(self, request, data):
+        # Streamed responses are not held in the memory, so they can have more datapoints.
+        streamed = self._is_streamed(request)
+        if streamed:
+            max_limit = self._meta.max_streaming_detail_limit
+        else:
+            max_limit = self._meta.max_detail_limit
+
+        data, count = self._paginate_datapoints(request, data, max_limit, streamed)
+        metrics.record_datapoints(request, data.data['query_params']['granularity'], count or 0)
+
+        return data
+
+    def _paginate_datapoints(self, request, data, max_limit, streamed):
+        # Returns data with the page of datapoints and the number of datapoints in the page. For streamed
+        # responses datapoints are read only while they are serialized, so the number is then None and
+        # datapoints are counted by the serializer instead.
+
         data.data['query_params'] = self._get_query_params(request, data.obj)
 
-        paginator = self._meta.detail_paginator_class(request.GET, data.data['datapoints'], resource_uri=data.data['resource_uri'], limit=self._meta.detail_limit, max_limit=self._meta.max_detail_limit, collection_name='datapoints')
-        page = paginator.page()
+        if isinstance(data.data['datapoints'], CachedPage):
+            # Looked up in obj_get, before datapoints would be queried.
+            page = data.data['datapoints'].page
+            count = page.get('count', 0)
+            page = {
+                'datapoints': serializers.JSONString(page['datapoints']),
+                'meta': page['meta'],
+            }
+        else:
+            cache = get_response_cache()
+            cache_key = self._get_cache_key(request, data.obj, data.data['query_params']) if cache is not None else None
+
+            if isinstance(data.data['datapoints'], (visualization.DatapointsList, materialize.MaterializedDatapoints)):
+                # Already read, so counting is cheap.
+                estimate_count = None
+            else:
+                estimate_count = functools.partial(self._estimate_count, data.obj, data.data['query_params'])
+
+            request_data = request.GET
+            if cache_key is not None:
+                # Cached page is shared by requests which differ in presentation parameters, so they are not used
+                # in links. Datapoints of a cached time range do not change anymore, so they are counted exactly once.
+                request_data = request_data.copy()
+                for name in PRESENTATION_QUERY_PARAMS:
+                    request_data.pop(name, None)
+
+            paginator = self._meta.detail_paginator_class(request_data, data.data['datapoints'], granularity=data.data['query_params']['granularity'], reverse=data.data['query_params']['reverse'], estimate_count=estimate_count, resource_uri=data.data['resource_uri'], limit=self._meta.detail_limit, max_limit=max_limit, collection_name='datapoints')
+            page = paginator.page()
+
+            # Datapoints are read here, unless the response is streamed. They would be read
+            # during serialization anyway.
+            if isinstance(page['datapoints'], datastream_api.Datapoints) and (not streamed or cache_key is not None):
+                with timing.phase('data'):
+                    page['datapoints'] = executor.call(list, page['datapoints'])
+
+            if isinstance(page['datapoints'], datastream_api.Datapoints):
+                count = None
+            else:
+                count = len(page['datapoints'])
+
+            if cache_key is not None:
+                with timing.phase('serialize'):
+                    page['datapoints'] = serializers.JSONString(self._meta.serializer.to_json(page['datapoints'], self._get_serializer_options(request)))
+                cache.set(cache_key, {
+                    'datapoints': str(page['datapoints']),
+                    'meta': page['meta'],
+                    'count': count,
+                })
+            elif streamed:
+                # Streaming serializer counts datapoints it serializes.
+                count = None
 
         data.data['datapoints'] = page['datapoints']
         data.data.setdefault('meta', {}).update(page['meta'])
 
-        return data
+        return data, count
+
+    def dispatch(self, request_type, request, **kwargs):
+        try:
+            return super(StreamResource, self).dispatch(request_type, request, **kwargs)
+        except StreamedResponse, exception:
+            return exception.response
+
+    def get_detail(self, request, **kwargs):
+        # We support conditional requests. Only stream metadata is needed to determine
+        # if the response would be the same, so datapoints are not queried in that case.
+        stream = self._get_stream(request, kwargs[self._meta.detail_uri_name])
+        etag, last_modified = self._get_validators(request, stream)
+
+        if self._is_not_modified(request, etag, last_modified):
+            response = self.add_cors_headers(tastypie_http.HttpNotModified())
+        else:
+            response = super(StreamResource, self).get_detail(request, **kwargs)
+
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_utils.http_date(last_modified)
+
+        if response.streaming:
+            raise StreamedResponse(response)
+
+        return response
+
+    def _get_validators(self, request, stream):
+        # Response is fully determined by stream metadata and query parameters. Datapoints
+        # at the highest granularity change only when latest datapoint changes, and downsampled
+        # datapoints change only when stream is downsampled further.
+        validator = json.dumps([
+            stream.id,
+            stream.tags,
+            stream.earliest_datapoint,
+            stream.latest_datapoint,
+            getattr(stream, 'downsampled_until', None),
+            self._get_cache_params(request),
+            self.determine_format(request),
+        ], sort_keys=True, default=unicode)
+
+        etag = '"%s"' % hashlib.md5(validator).hexdigest()
+
+        # Last modification time is known only for the highest granularity.
+        last_modified = None
+        if stream.latest_datapoint is not None and self._get_query_params(request, stream)['granularity'] == stream.highest_granularity:
+            last_modified = calendar.timegm(stream.latest_datapoint.utctimetuple())
+
+        return etag, last_modified
+
+    def _is_not_modified(self, request, etag, last_modified):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+        if if_none_match is not None:
+            # If-None-Match has precedence over If-Modified-Since.
+            etags = [e.strip() for e in if_none_match.split(',')]
+            etags = [e[2:] if e.startswith('W/') else e for e in etags]
+            return '*' in etags or etag in etags
+
+        if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE', None)
+        if if_modified_since is not None and last_modified is not None:
+            if_modified_since = http_utils.parse_http_date_safe(if_modified_since)
+            return if_modified_since is not None and last_modified <= if_modified_since
+
+        return False
+
+    def get_multiple(self, request, **kwargs):
+        # Mostly just a copy of parent get_multiple, but returning full details with datapoints for
+        # every stream, with shared query parameters. Streams are fetched concurrently.
+
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        # Rip apart the list then iterate.
+        kwarg_name = '%s_list' % self._meta.detail_uri_name
+        obj_identifiers = kwargs.get(kwarg_name, '').split(';')
+        base_bundle = self.build_bundle(request=request)
+        request_timing = timing.get_current()
+
+        def get_detail(identifier):
+            with timing.activate(request_timing):
+                try:
+                    obj = self.obj_get(bundle=base_bundle, **{self._meta.detail_uri_name: identifier})
+                except exceptions.NotFound:
+                    return None
+
+                bundle = self.build_bundle(obj=obj, request=request)
+                bundle = self.full_dehydrate(bundle)
+                # Multiple streams are never streamed, so we always use the regular limit
+                # and datapoints are read already here, in the thread.
+                return self._paginate_datapoints(request, bundle, self._meta.max_detail_limit, False)
+
+        objects = []
+        not_found = []
+
+        for identifier, result in zip(obj_identifiers, get_thread_pool().map(get_detail, obj_identifiers, chunksize=1)):
+            if result is None:
+                not_found.append(identifier)
+            else:
+                bundle, count = result
+                # Counts are recorded here and not in threads, because they are stored in the request.
+                metrics.record_datapoints(request, bundle.data['query_params']['granularity'], count)
+                objects.append(bundle)
+
+        object_list = {
+            self._meta.collection_name: objects,
+        }
+
+        if len(not_found):
+            object_list['not_found'] = not_found
+
+        self.log_throttled_access(request)
+        return self.add_cors_headers(self.create_response(request, object_list))
+
+    def append_datapoints(self, request, **kwargs):
+        # Appends datapoints to multiple streams at once. Request body is a list of
+        # [stream_id, timestamp, value] items (or objects with these keys), as JSON or
+        # NDJSON (one item per line). Datapoints are grouped per stream and streams are
+        # appended to concurrently. Invalid items do not prevent appending other items.
+
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        try:
+            items = self.deserialize(request, request.body)
+        except (ValueError, exceptions.UnsupportedFormat), exception:
+            raise InvalidDatapoints("Invalid datapoints: %s" % exception)
+
+        if not isinstance(items, list):
+            raise InvalidDatapoints("Expected a list of datapoints.")
+
+        # By default resource is read-only and appending is not authorized.
+        self.authorized_create_detail(items, self.build_bundle(request=request))
+
+        errors = []
+        streams = collections.OrderedDict()
+
+        for index, item in enumerate(items):
+            try:
+                stream_id, timestamp, value = self._parse_datapoint(item)
+            except ValueError, exception:
+                errors.append({'index': index, 'error': unicode(exception)})
+                continue
+
+            streams.setdefault(stream_id, []).append((index, timestamp, value))
+
+        appended = 0
+        for stream_appended, stream_errors in get_thread_pool().map(self._append_stream_datapoints, streams.items(), chunksize=1):
+            appended += stream_appended
+            errors.extend(stream_errors)
+
+        errors.sort(key=lambda error: error['index'])
+
+        self.log_throttled_access(request)
+        return self.add_cors_headers(self.create_response(request, {
+            'appended': appended,
+            'errors': errors,
+        }))
+
+    def _parse_datapoint(self, item):
+        if isinstance(item, dict):
+            try:
+                stream_id = item['stream_id']
+                value = item['value']
+            except KeyError, exception:
+                raise ValueError("Missing '%s'." % exception.args[0])
+            timestamp = item.get('timestamp', None)
+        elif isinstance(item, list) and len(item) == 3:
+            stream_id, timestamp, value = item
+        else:
+            raise ValueError("Expected [stream_id, timestamp, value].")
+
+        if not isinstance(stream_id, basestring):
+            raise ValueError("Invalid stream ID: '%s'" % stream_id)
+
+        # Timestamps are in seconds since UNIX epoch, or null for the current time.
+        if timestamp is not None:
+            if not isinstance(timestamp, numbers.Real) or isinstance(timestamp, bool):
+                raise ValueError("Invalid timestamp: '%s'" % timestamp)
+
+            try:
+                timestamp = datetime.datetime.fromtimestamp(timestamp, pytz.utc)
+            except (ValueError, OverflowError):
+                raise ValueError("Invalid timestamp: '%s'" % timestamp)
+
+        return stream_id, timestamp, value
+
+    def _append_stream_datapoints(self, stream_datapoints):
+        # Appends datapoints of one stream and returns the number of appended
+        # datapoints and errors. Timestamps have to be monotonically increasing,
+        # so datapoints are appended in order, those without a timestamp last.
+
+        stream_id, datapoints = stream_datapoints
+        datapoints = sorted(datapoints, key=lambda datapoint: (datapoint[1] is None, datapoint[1], datapoint[0]))
+
+        appended = 0
+        errors = []
+
+        for i, (index, timestamp, value) in enumerate(datapoints):
+            try:
+                # The stream is marked as dirty once, below.
+                datastream.append(stream_id, value, timestamp, mark_dirty=False)
+            except (datastream_exceptions.StreamNotFound, datastream_exceptions.AppendToDerivedStreamNotAllowed), exception:
+                # Other datapoints of the stream would fail the same.
+                error = self._append_error(exception)
+                errors.extend({'index': index, 'error': error} for index, timestamp, value in datapoints[i:])
+                break
+            except (datastream_exceptions.DatastreamException, ValueError, TypeError), exception:
+                errors.append({'index': index, 'error': self._append_error(exception)})
+            else:
+                appended += 1
+
+        if appended and dirty.is_enabled():
+            dirty.mark(stream_id)
+
+        return appended, errors
+
+    def _append_error(self, exception):
+        return unicode(exception) or exception.__class__.__name__
+
+    def _get_cache_key(self, request, stream, params):
+        # Only pages of downsampled datapoints for a time range which has already been downsampled
+        # are cached. Such datapoints do not change anymore, so cache entries never have to be
+        # invalidated. Only JSON is cached, because we can include it directly into the output.
+
+        if self.determine_format(request) not in ('application/json', 'text/javascript'):
+            return None
+
+        if not self._is_closed_range(stream, params):
+            return None
+
+        key = json.dumps([
+            stream.id,
+            self._get_cache_params(request),
+            self.determine_format(request),
+            self._get_time_format(request),
+        ], sort_keys=True)
+
+        return 'datastream:response:%s' % hashlib.md5(key).hexdigest()
+
+    def _get_cache_params(self, request):
+        return sorted((name, values) for name, values in request.GET.lists() if name not in PRESENTATION_QUERY_PARAMS)
+
+    def _get_cached_page(self, request, stream):
+        # Returns the page from the response cache, or None if it is not cached.
+
+        cache = get_response_cache()
+        if cache is None:
+            return None
+
+        cache_key = self._get_cache_key(request, stream, self._get_query_params(request, stream))
+        if cache_key is None:
+            return None
+
+        page = cache.get(cache_key)
+        metrics.record_cache('response', int(page is not None), int(page is None))
+
+        if page is None:
+            return None
+
+        return CachedPage(page)
+
+    def _is_closed_range(self, stream, params):
+        # Is the time range of the query at a downsampled granularity already downsampled,
+        # so that its datapoints do not change anymore.
+
+        if params['granularity'] == stream.highest_granularity:
+            return False
+
+        downsampled_until = (getattr(stream, 'downsampled_until', None) or {}).get(params['granularity'].name, None)
+        if downsampled_until is None:
+            return False
+
+        downsampled_until = self._make_aware(downsampled_until)
+        if params['end'] is not None:
+            # End is inclusive.
+            return self._make_aware(params['end']) < downsampled_until
+        elif params['end_exclusive'] is not None:
+            return self._make_aware(params['end_exclusive']) <= downsampled_until
+        else:
+            return False
+
+    def _is_materializable(self, request, stream, params):
+        # Materialized blocks contain datapoints with all downsamplers, serialized as JSON.
+        # Other query parameters which change datapoints are not supported.
+
+        if self.determine_format(request) not in ('application/json', 'text/javascript'):
+            return False
+
+        if request.GET.get(QUERY_CURSOR, None) is not None or request.GET.get(QUERY_VISUAL_DOWNSAMPLE, None):
+            return False
+
+        if params['value_downsamplers'] is not None or params['time_downsamplers'] is not None:
+            return False
+
+        return self._is_closed_range(stream, params)
+
+    def _make_aware(self, timestamp):
+        if timestamp.tzinfo is None:
+            return timestamp.replace(tzinfo=pytz.utc)
+
+        return timestamp
+
+    def _is_streamed(self, request):
+        # Formats without streaming serialization are never streamed, even if requested.
+        desired_format = self.determine_format(request)
+
+        if not self._meta.serializer.supports_streaming(desired_format):
+            return False
+
+        return self.value_to_boolean(request.GET, QUERY_STREAMING) or self._meta.serializer.is_always_streamed(desired_format)
+
+    def create_response(self, request, data, response_class=http.HttpResponse, **response_kwargs):
+        # When requested (or for formats which are always streamed), detail response is
+        # streamed. Datapoints are then serialized in chunks as they are read from the
+        # backend, so that the whole response is never in the memory at once.
+        if isinstance(data, tastypie_bundle.Bundle) and response_class is http.HttpResponse and self._is_streamed(request):
+            desired_format = self.determine_format(request)
+            options = self._get_serializer_options(request)
+            # Datapoints are serialized after the request has been finished, so they are counted as they are serialized.
+            options['count_datapoints'] = functools.partial(metrics.record_served_datapoints, 'detail', data.data['query_params']['granularity'])
+            serialized = self._meta.serializer.serialize_stream(data, desired_format, options)
+
+            if serialized is not None:
+                return http.StreamingHttpResponse(serialized, content_type=mime.build_content_type(desired_format), **response_kwargs)
+
+        return super(StreamResource, self).create_response(request, data, response_class, **response_kwargs)
 
     def _get_query_params(self, request, stream):
         granularity = request.GET.get(QUERY_GRANULARITY, None)
@@ -256,7 +939,25 @@ class StreamResource(BaseResource):
         if not start and not start_exclusive:
             start = datetime.datetime.min
 
-        reverse = request.GET.get(QUERY_REVERSE, '0').lower() in ('yes', 'true', 't', '1', 'y')
+        max_points = None
+        if QUERY_MAX_POINTS in request.GET:
+            try:
+                max_points = int(request.GET.get(QUERY_MAX_POINTS))
+            except ValueError:
+                raise InvalidMaxPoints("Invalid maximum number of points: '%s'" % request.GET.get(QUERY_MAX_POINTS))
+
+            if max_points <= 0:
+                raise InvalidMaxPoints("Invalid maximum number of points: '%s'" % request.GET.get(QUERY_MAX_POINTS))
+
+        if request.GET.get(QUERY_VISUAL_DOWNSAMPLE, None) and self._meta.max_visual_downsample_datapoints is not None:
+            # All datapoints in the time range are read before they are visually downsampled.
+            max_points = min(max_points or self._meta.max_visual_downsample_datapoints, self._meta.max_visual_downsample_datapoints)
+
+        if max_points is not None:
+            # Explicitly requested granularity is the finest granularity which can be selected.
+            granularity = self._select_granularity(stream, min(granularity, stream.highest_granularity), max_points, start or start_exclusive, end or end_exclusive)
+
+        reverse = self.value_to_boolean(request.GET, QUERY_REVERSE)
 
         value_downsamplers = []
         for downsampler in request.GET.getlist(QUERY_VALUE_DOWNSAMPLERS, []):
@@ -301,28 +1002,153 @@ class StreamResource(BaseResource):
             'time_downsamplers': time_downsamplers,
         }
 
+    def _get_range_duration(self, stream, start, end):
+        # Duration of the time range in seconds, limited to the range of datapoints
+        # the stream has, so that open ranges are not estimated to be too long.
+        # Returns None if the stream has no datapoints.
+
+        if stream.earliest_datapoint is None or stream.latest_datapoint is None:
+            return None
+
+        earliest_datapoint = self._make_aware(stream.earliest_datapoint)
+        latest_datapoint = self._make_aware(stream.latest_datapoint)
+
+        start = max(self._make_aware(start), earliest_datapoint) if start is not None else earliest_datapoint
+        end = min(self._make_aware(end), latest_datapoint) if end is not None else latest_datapoint
+
+        return max((end - start).total_seconds(), 0)
+
+    def _expected_count(self, duration, granularity):
+        # We expect at most one datapoint per granularity interval.
+        return int(duration // granularity.duration_in_seconds()) + 1
+
+    def _select_granularity(self, stream, finest_granularity, max_points, start, end):
+        # Selects the finest granularity for which the expected number of datapoints in
+        # the time range fits into max_points. If none fits, the coarsest granularity is selected.
+
+        duration = self._get_range_duration(stream, start, end)
+        if duration is None:
+            return finest_granularity
+
+        granularities = [granularity for granularity in datastream.Granularity.values if granularity <= finest_granularity]
+        for granularity in granularities:
+            if self._expected_count(duration, granularity) <= max_points:
+                return granularity
+
+        return granularities[-1]
+
+    def _estimate_count(self, stream, params):
+        # Estimates the number of datapoints from the time range and granularity, without
+        # querying them. For the highest granularity this is an upper bound.
+
+        duration = self._get_range_duration(stream, params['start'] or params['start_exclusive'], params['end'] or params['end_exclusive'])
+        if duration is None:
+            return 0
+
+        return self._expected_count(duration, params['granularity'])
+
+    def _get_stream(self, request, stream_id):
+        # Stream metadata is stored on the request, so that it is fetched only once per request.
+        streams = request.__dict__.setdefault('_datastream_streams', {})
+
+        if stream_id not in streams:
+            try:
+                with timing.phase('tags'):
+                    streams[stream_id] = datastream.Stream(executor.call(datastream.get_tags, stream_id))
+            except datastream_exceptions.StreamNotFound:
+                raise exceptions.NotFound("Stream '%s' not found." % stream_id)
+
+        return streams[stream_id]
+
     def obj_get(self, bundle, **kwargs):
-        try:
-            stream = datastream.Stream(datastream.get_tags(kwargs['pk']))
-        except datastream_exceptions.StreamNotFound:
-            raise exceptions.NotFound("Stream '%s' not found." % kwargs['pk'])
+        stream = self._get_stream(bundle.request, kwargs['pk'])
 
         params = self._get_query_params(bundle.request, stream)
-
-        stream.datapoints = datastream.get_data(
-            stream_id=stream.id,
-            granularity=params['granularity'],
-            start=params['start'],
-            end=params['end'],
-            start_exclusive=params['start_exclusive'],
-            end_exclusive=params['end_exclusive'],
-            reverse=params['reverse'],
-            value_downsamplers=params['value_downsamplers'],
-            time_downsamplers=params['time_downsamplers'],
-        )
+        params = self._apply_cursor(bundle.request, params)
+
+        cached_page = self._get_cached_page(bundle.request, stream)
+        if cached_page is not None:
+            # Served from the response cache, so datapoints are not queried at all.
+            stream.datapoints = cached_page
+            return stream
+
+        datapoints = None
+        if materialize.get_cache() is not None and self._is_materializable(bundle.request, stream, params):
+            # Datapoints are read from pre-serialized blocks, if possible.
+            datapoints = materialize.get_datapoints(stream, params, self._meta.serializer, self._get_time_format(bundle.request))
+
+        if datapoints is None:
+            # Datapoints are queried only when read.
+            datapoints = datastream.get_data(
+                stream_id=stream.id,
+                granularity=params['granularity'],
+                start=params['start'],
+                end=params['end'],
+                start_exclusive=params['start_exclusive'],
+                end_exclusive=params['end_exclusive'],
+                reverse=params['reverse'],
+                value_downsamplers=params['value_downsamplers'],
+                time_downsamplers=params['time_downsamplers'],
+            )
+
+        stream.datapoints = datapoints
+
+        visual_downsample = self._get_visual_downsample_params(bundle.request)
+        if visual_downsample is not None:
+            # Datapoints are read while downsampling.
+            with timing.phase('data'):
+                stream.datapoints = executor.call(visualization.downsample, stream.datapoints, *visual_downsample, max_datapoints=self._meta.max_visual_downsample_datapoints)
 
         return stream
 
+    def _get_visual_downsample_params(self, request):
+        method = request.GET.get(QUERY_VISUAL_DOWNSAMPLE, None)
+        if not method:
+            return None
+
+        if method not in VISUAL_DOWNSAMPLE_METHODS:
+            raise InvalidVisualDownsample("Invalid visual downsampling method: '%s'" % method)
+
+        try:
+            points = int(request.GET.get(QUERY_POINTS, None))
+        except (TypeError, ValueError):
+            raise InvalidVisualDownsample("Invalid number of points: '%s'" % request.GET.get(QUERY_POINTS, None))
+
+        if points <= 0:
+            raise InvalidVisualDownsample("Invalid number of points: '%s'" % request.GET.get(QUERY_POINTS))
+
+        return method, points
+
+    def _apply_cursor(self, request, params):
+        # Limits the time range of the query to datapoints after (or before) the cursor.
+        # Returned params are used only for the query, query params in the response
+        # stay as they were requested, including the order of datapoints.
+
+        cursor = datastream_paginator.decode_cursor(request.GET.get(QUERY_CURSOR, None))
+        if cursor is None:
+            return params
+
+        # Datapoints at the cursor timestamp are included, the paginator skips those already returned.
+        direction, timestamp, skip = cursor
+        params = params.copy()
+
+        if (direction == datastream_paginator.CURSOR_NEXT) != params['reverse']:
+            # Forward in time.
+            params.update({
+                'start': timestamp,
+                'start_exclusive': None,
+                'reverse': False,
+            })
+        else:
+            # Backward in time.
+            params.update({
+                'end': timestamp,
+                'end_exclusive': None,
+                'reverse': True,
+            })
+
+        return params
+
     def obj_create(self, bundle, **kwargs):
         raise NotImplementedError
 
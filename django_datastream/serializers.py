@@ -1,16 +1,265 @@
+import calendar
+import csv
 import datetime
+import io
 import itertools
+import numbers
+import struct
 
+from django.conf import settings
+from django.core import exceptions as django_exceptions
 from django.utils import datetime_safe, feedgenerator, timezone
 
-from tastypie import serializers
+from tastypie import bundle as tastypie_bundle, exceptions, serializers
 
 import ujson
 
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
 import datastream
 
+# Number of datapoints serialized at once when streaming.
+STREAMING_CHUNK_SIZE = 500
+
+# Binary columnar format starts with this magic, followed by the length of the JSON
+# header as little-endian uint32, the JSON header itself, and then blocks of columns.
+BINARY_MAGIC = 'DSC1'
+BINARY_TIME_DTYPE = '<i8'
+BINARY_VALUE_DTYPE = '<f8'
+BINARY_STRUCT_FORMATS = {
+    BINARY_TIME_DTYPE: 'q',
+    BINARY_VALUE_DTYPE: 'd',
+}
+
+# Timestamps are serialized as formatted datetimes (see TASTYPIE_DATETIME_FORMATTING),
+# or as integer seconds or milliseconds since UNIX epoch.
+TIME_FORMATS = ('datetime', 'epoch', 'epoch_ms')
+TIME_FORMAT = getattr(settings, 'DATASTREAM_TIME_FORMAT', 'datetime')
+
+if TIME_FORMAT not in TIME_FORMATS:
+    raise django_exceptions.ImproperlyConfigured("DATASTREAM_TIME_FORMAT should be one of: %s" % ", ".join(TIME_FORMATS))
+
+
+class UnsupportedValue(exceptions.BadRequest):
+    pass
+
+
+class JSONString(str):
+    # In our ujson fork objects with the __json__ method are directly
+    # included in the output. We use this for already serialized data.
+    # See https://github.com/esnme/ultrajson/pull/157
+
+    __slots__ = ()
+
+    def __json__(self):
+        return self
+
+
+class EchoBuffer(object):
+    # A file-like object for csv writer which just returns the written value.
+
+    def write(self, value):
+        return value
+
 
 class DatastreamSerializer(serializers.Serializer):
+    content_types = dict(serializers.Serializer.content_types, binary='application/octet-stream', csv='text/csv', ndjson='application/x-ndjson')
+
+    # Formats which are always available, in addition to configured formats.
+    datastream_formats = ('binary', 'csv')
+
+    # Formats which are always streamed, because responses can be very large.
+    streaming_formats = ('binary', 'csv')
+
+    def __init__(self, *args, **kwargs):
+        self.time_format = kwargs.pop('time_format', None) or TIME_FORMAT
+
+        if self.time_format not in TIME_FORMATS:
+            raise ValueError("Invalid time format: '%s'" % self.time_format)
+
+        super(DatastreamSerializer, self).__init__(*args, **kwargs)
+
+        for format in self.datastream_formats:
+            if format not in self.formats and format in self.content_types:
+                self.formats = list(self.formats) + [format]
+                self.supported_formats.append(self.content_types[format])
+
+    def is_always_streamed(self, format):
+        for short_format in self.streaming_formats:
+            if format == self.content_types.get(short_format, None):
+                return True
+
+        return False
+
+    def _get_stream_method(self, format):
+        for short_format, long_format in self.content_types.items():
+            if format == long_format:
+                if hasattr(self, 'to_%s_stream' % short_format):
+                    return getattr(self, 'to_%s_stream' % short_format)
+
+        return None
+
+    def supports_streaming(self, format):
+        return self._get_stream_method(format) is not None
+
+    def serialize_stream(self, bundle, format='application/json', options=None):
+        # Similar to serialize, but returns an iterator over chunks of serialized
+        # data, or None if there is no streaming serialization for the format.
+
+        options = options or {}
+
+        method = self._get_stream_method(format)
+        if method is None:
+            return None
+
+        return method(bundle, options)
+
+    def _split_datapoints(self, data):
+        # Returns datapoints and the rest of the detail data.
+        data = data.data.copy()
+        datapoints = data.pop('datapoints', None)
+        return datapoints, data
+
+    def _chunks(self, iterable, size, options=None):
+        # If "count_datapoints" option is set, it is called with the number of items in every chunk.
+        count_datapoints = (options or {}).get('count_datapoints', None)
+
+        iterator = iter(iterable)
+        while True:
+            chunk = list(itertools.islice(iterator, size))
+            if not chunk:
+                return
+            if count_datapoints is not None:
+                count_datapoints(len(chunk))
+            yield chunk
+
+    def to_json_stream(self, data, options=None):
+        options = options or {}
+        options['to_json'] = True
+
+        if not isinstance(data, tastypie_bundle.Bundle) or data.data.get('datapoints', None) is None:
+            yield self.to_json(data, options)
+            return
+
+        datapoints, data = self._split_datapoints(data)
+
+        # We first serialize all other fields and then append datapoints to the
+        # end of the JSON object, serializing them in chunks as they come.
+        serialized = ujson.dumps(self.to_simple(data, options), ensure_ascii=False)
+        assert serialized.endswith('}'), serialized
+        if serialized == '{}':
+            yield '{"datapoints":['
+        else:
+            yield serialized[:-1] + ',"datapoints":['
+
+        if hasattr(datapoints, '__json__'):
+            # Datapoints are already serialized.
+            yield datapoints.__json__()[1:-1]
+            yield ']}'
+            return
+
+        first = True
+        for chunk in self._chunks(datapoints, STREAMING_CHUNK_SIZE, options):
+            serialized = ujson.dumps([self.to_simple(d, options) for d in chunk], ensure_ascii=False)[1:-1]
+            if first:
+                first = False
+                yield serialized
+            else:
+                yield ',' + serialized
+
+        yield ']}'
+
+    def to_xml_stream(self, data, options=None):
+        # Same XML as to_xml, but datapoints are written incrementally as they are read
+        # from the backend, instead of building the whole tree in the memory first.
+        options = options or {}
+
+        if lxml_etree is None:
+            raise django_exceptions.ImproperlyConfigured("Usage of the XML aspects requires lxml and defusedxml.")
+
+        if not isinstance(data, tastypie_bundle.Bundle) or data.data.get('datapoints', None) is None:
+            yield self.to_xml(data, options)
+            return
+
+        datapoints, data = self._split_datapoints(data)
+        element = self.to_etree(tastypie_bundle.Bundle(data=data), options)
+
+        # Children are sorted by their tags, datapoints have to be written at their place.
+        children = list(element)
+        index = len([child for child in children if child.tag < 'datapoints'])
+
+        buffer = io.BytesIO()
+        with lxml_etree.xmlfile(buffer, encoding='utf-8') as xml:
+            xml.write_declaration()
+            with xml.element(element.tag, element.attrib):
+                for child in children[:index]:
+                    xml.write(child)
+
+                with xml.element('datapoints', type='list'):
+                    for chunk in self._chunks(datapoints, STREAMING_CHUNK_SIZE, options):
+                        for datapoint in chunk:
+                            xml.write(self.to_etree(self.to_simple(datapoint, options), options, depth=2))
+
+                        xml.flush()
+                        yield buffer.getvalue()
+                        buffer.seek(0)
+                        buffer.truncate()
+
+                for child in children[index:]:
+                    xml.write(child)
+
+        yield buffer.getvalue()
+
+    def _csv_value(self, value, options):
+        if value is None:
+            return ''
+        elif isinstance(value, datetime.datetime):
+            return str(self.format_timestamp(value, options))
+        elif isinstance(value, float):
+            # To not lose precision.
+            return repr(value)
+        elif isinstance(value, unicode):
+            return value.encode('utf-8')
+        elif isinstance(value, (dict, list, tuple)):
+            return ujson.dumps(self.to_simple(value, options), ensure_ascii=False).encode('utf-8')
+        else:
+            return str(value)
+
+    def to_csv_stream(self, data, options=None):
+        # Datapoints are written one row per datapoint, with a column per time and value
+        # downsampler. Rows are generated in chunks as datapoints are read from the backend.
+        options = options or {}
+        writer = csv.writer(EchoBuffer())
+
+        if not isinstance(data, tastypie_bundle.Bundle) or data.data.get('datapoints', None) is None:
+            # Other data (lists of streams, errors) is written as one row per field.
+            data = self.to_simple(data, options)
+            if not isinstance(data, dict):
+                data = {'objects': data}
+            yield ''.join(writer.writerow([self._csv_value(key, options), self._csv_value(value, options)]) for key, value in sorted(data.items()))
+            return
+
+        datapoints, data = self._split_datapoints(data)
+        datapoints = iter(datapoints)
+
+        try:
+            first = next(datapoints)
+        except StopIteration:
+            yield writer.writerow(['t', 'v'])
+            return
+
+        columns = self._datapoint_columns(first)
+        yield writer.writerow([name for name, field, key in columns])
+
+        for chunk in self._chunks(itertools.chain([first], datapoints), STREAMING_CHUNK_SIZE, options):
+            yield ''.join(writer.writerow([self._csv_value(self._datapoint_value(datapoint, field, key), options) for name, field, key in columns]) for datapoint in chunk)
+
+    def to_csv(self, data, options=None):
+        return ''.join(self.to_csv_stream(data, options))
+
     def to_json(self, data, options=None):
         options = options or {}
         # We set options so that we know in to_simple that we are calling it from to_json and not
@@ -22,6 +271,151 @@ class DatastreamSerializer(serializers.Serializer):
     def from_json(self, content):
         return ujson.loads(content)
 
+    def from_ndjson(self, content):
+        # Newline-delimited JSON, one value per line, returned as a list.
+        data = []
+        for number, line in enumerate(content.splitlines(), 1):
+            if not line.strip():
+                continue
+
+            try:
+                data.append(ujson.loads(line))
+            except ValueError, exception:
+                raise exceptions.BadRequest("Invalid JSON on line %d: %s" % (number, exception))
+
+        return data
+
+    def _datapoint_columns(self, datapoint):
+        # Columns are determined from the (first) datapoint. At the highest granularity
+        # they are "t" and "v", otherwise one column per time and value downsampler.
+        # Returns a list of (name, field, downsampler key) tuples.
+        time_downsamplers = dict((key, name) for name, key in datastream.TIME_DOWNSAMPLERS.items())
+        value_downsamplers = dict((key, name) for name, key in datastream.VALUE_DOWNSAMPLERS.items())
+
+        columns = []
+        for field, downsamplers in (('t', time_downsamplers), ('v', value_downsamplers)):
+            value = datapoint[field]
+            if isinstance(value, dict):
+                for key in sorted(value.keys(), key=lambda k: downsamplers.get(k, k)):
+                    columns.append(('%s.%s' % (field, downsamplers.get(key, key)), field, key))
+            else:
+                columns.append((field, field, None))
+
+        return columns
+
+    def _datapoint_value(self, datapoint, field, key):
+        value = datapoint[field]
+        if key is not None:
+            value = value.get(key, None) if isinstance(value, dict) else None
+        return value
+
+    def _binary_dtype(self, value):
+        if isinstance(value, datetime.datetime):
+            return BINARY_TIME_DTYPE
+        elif value is None or (isinstance(value, numbers.Real) and not isinstance(value, bool)):
+            return BINARY_VALUE_DTYPE
+        else:
+            raise UnsupportedValue("Binary format supports only numeric values.")
+
+    def _binary_value(self, dtype, value):
+        if dtype == BINARY_TIME_DTYPE:
+            if not isinstance(value, datetime.datetime):
+                raise UnsupportedValue("Binary format supports only numeric values.")
+            # Milliseconds since UNIX epoch.
+            return calendar.timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000
+        elif value is None:
+            return float('nan')
+        elif isinstance(value, numbers.Real) and not isinstance(value, bool):
+            return float(value)
+        else:
+            raise UnsupportedValue("Binary format supports only numeric values.")
+
+    def to_binary_stream(self, data, options=None):
+        # Datapoints are serialized as blocks of packed columns: timestamps as int64 milliseconds since
+        # UNIX epoch and values as float64 (missing values are NaN), so that clients can load them
+        # directly into arrays (for example, with numpy.frombuffer). All other data is in the JSON
+        # header, together with a list of columns in the order they follow in every block. Every
+        # block starts with the number of its datapoints as uint64, the last block is empty.
+        options = options or {}
+
+        if isinstance(data, tastypie_bundle.Bundle) and data.data.get('datapoints', None) is not None:
+            datapoints, data = self._split_datapoints(data)
+            datapoints = iter(datapoints)
+        else:
+            datapoints = iter([])
+
+        # The first datapoint is read before anything is returned, so that unsupported
+        # values are reported as an error response and not in the middle of the stream.
+        try:
+            first = [next(datapoints)]
+        except StopIteration:
+            first = []
+
+        columns = []
+        if first:
+            for name, field, key in self._datapoint_columns(first[0]):
+                columns.append((name, field, key, self._binary_dtype(self._datapoint_value(first[0], field, key))))
+
+        header = self.to_simple(data, {})
+        header['columns'] = [{'name': name, 'dtype': dtype} for name, field, key, dtype in columns]
+        header = ujson.dumps(header, ensure_ascii=True)
+
+        # We pad the header so that columns are aligned to 8 bytes.
+        header += ' ' * (-(len(BINARY_MAGIC) + 4 + len(header)) % 8)
+
+        return self._binary_blocks(BINARY_MAGIC + struct.pack('<I', len(header)) + header, columns, itertools.chain(first, datapoints), options)
+
+    def _binary_blocks(self, header, columns, datapoints, options):
+        yield header
+
+        for chunk in self._chunks(datapoints, STREAMING_CHUNK_SIZE, options):
+            block = [struct.pack('<Q', len(chunk))]
+            for name, field, key, dtype in columns:
+                values = [self._binary_value(dtype, self._datapoint_value(datapoint, field, key)) for datapoint in chunk]
+                block.append(struct.pack('<%d%s' % (len(values), BINARY_STRUCT_FORMATS[dtype]), *values))
+            yield ''.join(block)
+
+        yield struct.pack('<Q', 0)
+
+    def to_binary(self, data, options=None):
+        return ''.join(self.to_binary_stream(data, options))
+
+    def from_binary(self, content):
+        # Returns the JSON header with "datapoints" as a dict of columns and their "count".
+        if content[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+            raise exceptions.BadRequest("Invalid binary content.")
+
+        header_start = len(BINARY_MAGIC) + 4
+        header_length = struct.unpack('<I', content[len(BINARY_MAGIC):header_start])[0]
+        data = ujson.loads(content[header_start:header_start + header_length])
+
+        offset = header_start + header_length
+        columns = data.pop('columns')
+        datapoints = dict((column['name'], []) for column in columns)
+        data['count'] = 0
+        while True:
+            if offset + 8 > len(content):
+                raise exceptions.BadRequest("Truncated binary content.")
+
+            count = struct.unpack('<Q', content[offset:offset + 8])[0]
+            offset += 8
+            if not count:
+                break
+
+            for column in columns:
+                column_format = '<%d%s' % (count, BINARY_STRUCT_FORMATS[column['dtype']])
+                size = struct.calcsize(column_format)
+                if offset + size > len(content):
+                    raise exceptions.BadRequest("Truncated binary content.")
+                datapoints[column['name']].extend(struct.unpack(column_format, content[offset:offset + size]))
+                offset += size
+
+            data['count'] += count
+
+        data['datapoints'] = datapoints
+
+        return data
+
     def to_simple(self, data, options):
         # In our ujson fork we allow data to have a special
         # __json__ method which outputs raw JSON to be directly
@@ -34,6 +428,9 @@ class DatastreamSerializer(serializers.Serializer):
         if isinstance(data, datastream.Datapoints):
             return itertools.imap(lambda d: self.to_simple(d, options), data)
 
+        if isinstance(data, datetime.datetime):
+            return self.format_timestamp(data, options)
+
         return super(DatastreamSerializer, self).to_simple(data, options)
 
     def to_etree(self, data, options=None, name=None, depth=0):
@@ -42,6 +439,17 @@ class DatastreamSerializer(serializers.Serializer):
 
         return super(DatastreamSerializer, self).to_etree(data, options, name, depth)
 
+    def format_timestamp(self, data, options):
+        # Epoch time formats skip timezone handling and formatting of datetimes completely.
+        time_format = options.get('time_format', None) or self.time_format
+
+        if time_format == 'epoch':
+            return calendar.timegm(data.utctimetuple())
+        elif time_format == 'epoch_ms':
+            return calendar.timegm(data.utctimetuple()) * 1000 + data.microsecond // 1000
+        else:
+            return self.format_datetime(data)
+
     # We want to keep timezone information (Tastypie removes it).
     def format_datetime(self, data):
         data = self._make_aware(data)
@@ -5,7 +5,7 @@ from django.test import runner
 
 from tastypie import test
 
-from django_datastream import datastream
+from django_datastream import datastream, dirty
 
 
 class DatastreamSuiteRunner(runner.DiscoverRunner):
@@ -19,6 +19,10 @@ class DatastreamSuiteRunner(runner.DiscoverRunner):
     def teardown_databases(self, old_config, **kwargs):
         datastream.delete_streams()
 
+        # Tests can enable dirty tracking for themselves, so the collection is dropped whenever it can exist.
+        if dirty.is_supported(datastream.backend):
+            dirty.get_collection().drop()
+
 
 class ResourceTestCase(test.ResourceTestCase):
     api_name = 'v1'
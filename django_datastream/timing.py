@@ -0,0 +1,77 @@
+import collections
+import contextlib
+import threading
+import time
+
+from django.conf import settings
+from django.utils import crypto
+
+# Report durations of request phases in the Server-Timing header of every response.
+SERVER_TIMING = getattr(settings, 'DATASTREAM_SERVER_TIMING', False)
+
+# If set, the header is reported only for requests with "server_timing" query parameter
+# equal to this key, so that it can be enabled in production for trusted clients.
+SERVER_TIMING_KEY = getattr(settings, 'DATASTREAM_SERVER_TIMING_KEY', None)
+
+QUERY_SERVER_TIMING = 'server_timing'
+
+_local = threading.local()
+
+
+class Timing(object):
+    # Durations (in seconds) and numbers of calls of request phases. Phases can
+    # be recorded from multiple threads and they can overlap.
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, name, duration):
+        with self.lock:
+            total, calls = self.phases.get(name, (0.0, 0))
+            self.phases[name] = (total + duration, calls + 1)
+
+    def header(self):
+        return ', '.join(
+            '%s;dur=%.3f;desc="%d call%s"' % (name, total * 1000, calls, '' if calls == 1 else 's')
+            for name, (total, calls) in self.phases.items()
+        )
+
+
+def is_enabled(request):
+    if SERVER_TIMING:
+        return True
+
+    if SERVER_TIMING_KEY is None:
+        return False
+
+    return crypto.constant_time_compare(request.GET.get(QUERY_SERVER_TIMING, ''), SERVER_TIMING_KEY)
+
+
+def get_current():
+    return getattr(_local, 'timing', None)
+
+
+@contextlib.contextmanager
+def activate(timing):
+    # Phases in this thread are recorded into the given timing (if not None).
+    previous = get_current()
+    _local.timing = timing
+    try:
+        yield timing
+    finally:
+        _local.timing = previous
+
+
+@contextlib.contextmanager
+def phase(name):
+    timing = get_current()
+    if timing is None:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        timing.add(name, time.time() - start)
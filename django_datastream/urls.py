@@ -2,11 +2,12 @@ from django.conf import urls
 
 from tastypie import api
 
-from . import resources
+from . import resources, views
 
 v1_api = api.Api(api_name='v1')
 v1_api.register(resources.StreamResource())
 
 urlpatterns = [
+    urls.url(r'^metrics/$', views.metrics, name='datastream_metrics'),
     urls.url(r'^', urls.include(v1_api.urls)),
 ]
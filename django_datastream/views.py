@@ -0,0 +1,13 @@
+from django import http
+
+from . import metrics as datastream_metrics
+
+
+def metrics(request):
+    if not datastream_metrics.METRICS:
+        raise http.Http404("Metrics are not enabled.")
+
+    if not datastream_metrics.is_authorized(request):
+        return http.HttpResponseForbidden("Not authorized to fetch metrics.")
+
+    return http.HttpResponse(datastream_metrics.render(), content_type=datastream_metrics.CONTENT_TYPE)
@@ -0,0 +1,229 @@
+import calendar
+import numbers
+
+from tastypie import exceptions
+
+from datastream import api as datastream_api
+
+import datastream
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Time downsamplers used as the time of a downsampled datapoint, in the order of preference.
+TIME_DOWNSAMPLERS = ('mean', 'first', 'last')
+
+# Value downsamplers used as the value of a downsampled datapoint, in the order of preference.
+VALUE_DOWNSAMPLERS = ('mean', 'median', 'min', 'max', 'sum', 'count')
+
+
+class NonNumericDatapoints(exceptions.BadRequest):
+    pass
+
+
+class TooManyDatapoints(exceptions.BadRequest):
+    pass
+
+
+class DatapointsList(datastream_api.ResultsBase):
+    # Datapoints which have already been read and reduced, with the same
+    # interface as datastream.api.Datapoints, so that they can be paginated.
+
+    def __init__(self, datapoints):
+        self.datapoints = datapoints
+
+    def count(self):
+        return len(self.datapoints)
+
+    def __len__(self):
+        return len(self.datapoints)
+
+    def __iter__(self):
+        return iter(self.datapoints)
+
+    def __getitem__(self, key):
+        return self.datapoints[key]
+
+
+def _timestamp(datapoint):
+    timestamp = datapoint['t']
+
+    if isinstance(timestamp, dict):
+        for downsampler in TIME_DOWNSAMPLERS:
+            if datastream.TIME_DOWNSAMPLERS[downsampler] in timestamp:
+                timestamp = timestamp[datastream.TIME_DOWNSAMPLERS[downsampler]]
+                break
+        else:
+            raise NonNumericDatapoints("Visual downsampling requires one of time downsamplers: %s" % ', '.join(TIME_DOWNSAMPLERS))
+
+    return calendar.timegm(timestamp.utctimetuple()) + timestamp.microsecond / 1e6
+
+
+def _numeric(value):
+    if value is None:
+        return None
+    elif isinstance(value, numbers.Real) and not isinstance(value, bool):
+        return float(value)
+    else:
+        raise NonNumericDatapoints("Visual downsampling supports only numeric values.")
+
+
+def _values(datapoint):
+    # Returns the value, the lowest value, and the highest value of the datapoint.
+    value = datapoint['v']
+
+    if not isinstance(value, dict):
+        value = _numeric(value)
+        return value, value, value
+
+    for downsampler in VALUE_DOWNSAMPLERS:
+        if datastream.VALUE_DOWNSAMPLERS[downsampler] in value:
+            representative = _numeric(value[datastream.VALUE_DOWNSAMPLERS[downsampler]])
+            break
+    else:
+        raise NonNumericDatapoints("Visual downsampling requires one of value downsamplers: %s" % ', '.join(VALUE_DOWNSAMPLERS))
+
+    low = _numeric(value.get(datastream.VALUE_DOWNSAMPLERS['min'], representative))
+    high = _numeric(value.get(datastream.VALUE_DOWNSAMPLERS['max'], representative))
+
+    return representative, low, high
+
+
+def lttb(x, y, points):
+    # Largest-Triangle-Three-Buckets algorithm. Returns indices of selected points.
+    # See http://skemman.is/stream/get/1946/15343/37285/3/SS_MSthesis.pdf
+
+    length = len(x)
+
+    if points >= length:
+        return numpy.arange(length)
+    if points < 3:
+        return numpy.array([0, length - 1])[:points]
+
+    # The first and the last points are always selected, other
+    # points are split into buckets, one point selected per bucket.
+    edges = numpy.linspace(1, length - 1, points - 1).astype(int)
+    starts, ends = edges[:-1], edges[1:]
+
+    # Averages of all buckets, computed at once.
+    x_sums = numpy.concatenate(([0.0], numpy.cumsum(x)))
+    y_sums = numpy.concatenate(([0.0], numpy.cumsum(y)))
+    sizes = ends - starts
+    x_averages = numpy.append((x_sums[ends] - x_sums[starts]) / sizes, x[-1])
+    y_averages = numpy.append((y_sums[ends] - y_sums[starts]) / sizes, y[-1])
+
+    indices = numpy.empty(points, dtype=int)
+    indices[0] = 0
+    indices[-1] = length - 1
+
+    selected = 0
+    for bucket, (start, end) in enumerate(zip(starts, ends)):
+        # Area of triangles between the previously selected point, candidate
+        # points in the bucket, and the average point of the next bucket.
+        areas = numpy.abs(
+            (x[selected] - x_averages[bucket + 1]) * (y[start:end] - y[selected]) -
+            (x[selected] - x[start:end]) * (y_averages[bucket + 1] - y[selected])
+        )
+        selected = start + areas.argmax()
+        indices[bucket + 1] = selected
+
+    return indices
+
+
+def minmax(x, low, high, points):
+    # Selects points with the lowest and the highest value in each of points / 2 time
+    # buckets (like pixels), so that no peaks are lost. Returns indices of selected points.
+
+    length = len(x)
+
+    if points >= length:
+        return numpy.arange(length)
+    if points < 2:
+        return numpy.array([high.argmax()])[:points]
+
+    buckets = points // 2
+
+    span = x[-1] - x[0]
+    if span:
+        bucket_ids = numpy.minimum(((x - x[0]) / span * buckets).astype(int), buckets - 1)
+    else:
+        bucket_ids = numpy.arange(length) * buckets // length
+
+    # Starts and ends of non-empty buckets. Bucket ids are non-decreasing.
+    starts = numpy.unique(bucket_ids, return_index=True)[1]
+    ends = numpy.append(starts[1:], length) - 1
+
+    # Sorted by bucket and then by value, the first point in each bucket has the lowest
+    # value and the last point the highest.
+    lowest = numpy.lexsort((low, bucket_ids))[starts]
+    highest = numpy.lexsort((high, bucket_ids))[ends]
+
+    return numpy.unique(numpy.concatenate((lowest, highest)))
+
+
+def _collapse_gaps(gaps):
+    # Consecutive datapoints without a value mark the same gap, only the first one is kept.
+    return [i for j, i in enumerate(gaps) if j == 0 or gaps[j - 1] != i - 1]
+
+
+def downsample(datapoints, method, points, max_datapoints=None):
+    # Reduces datapoints to at most the given number of points, preserving the visual shape.
+    # Datapoints without a value mark gaps in the data, one datapoint per gap is kept and
+    # counted against points. If there are more than max_datapoints datapoints, they are
+    # not read and TooManyDatapoints is raised.
+
+    if numpy is None:
+        raise exceptions.BadRequest("Visual downsampling requires NumPy.")
+
+    if max_datapoints is None:
+        datapoints = list(datapoints)
+    else:
+        datapoints = list(datapoints[0:max_datapoints + 1])
+
+        if len(datapoints) > max_datapoints:
+            raise TooManyDatapoints("Too many datapoints to visually downsample, more than %s. Use a coarser granularity or a shorter time range." % max_datapoints)
+
+    if len(datapoints) <= points:
+        return DatapointsList(datapoints)
+
+    x = []
+    values = []
+    gaps = []
+    numeric = []
+    for i, datapoint in enumerate(datapoints):
+        datapoint_values = _values(datapoint)
+        if datapoint_values[0] is None:
+            gaps.append(i)
+            continue
+
+        numeric.append(i)
+        x.append(_timestamp(datapoint))
+        values.append(datapoint_values)
+
+    gaps = _collapse_gaps(gaps)
+    if len(gaps) > points:
+        gaps = [gaps[i] for i in numpy.linspace(0, len(gaps) - 1, points).astype(int)]
+
+    numeric_points = min(points - len(gaps), len(numeric))
+
+    numeric = numpy.array(numeric, dtype=int)
+    x = numpy.array(x, dtype=float)
+    values = numpy.array(values, dtype=float).reshape(-1, 3)
+    # If min or max is missing we use the value.
+    values[:, 1] = numpy.where(numpy.isnan(values[:, 1]), values[:, 0], values[:, 1])
+    values[:, 2] = numpy.where(numpy.isnan(values[:, 2]), values[:, 0], values[:, 2])
+
+    if numeric_points <= 0:
+        selected = numpy.array([], dtype=int)
+    elif method == 'lttb':
+        selected = lttb(x, values[:, 0], numeric_points)
+    elif method == 'minmax':
+        selected = minmax(x, values[:, 1], values[:, 2], numeric_points)
+    else:
+        raise ValueError(method)
+
+    indices = sorted(numeric[selected].tolist() + gaps)
+
+    return DatapointsList([datapoints[i] for i in indices])
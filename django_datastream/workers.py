@@ -0,0 +1,45 @@
+import multiprocessing
+import zlib
+
+try:
+    import mongoengine
+    from datastream.backends import mongodb
+except ImportError:
+    mongoengine = None
+    mongodb = None
+
+from . import datastream
+
+
+def is_supported():
+    return datastream is not None and mongodb is not None and isinstance(datastream.backend, mongodb.Backend)
+
+
+def get_partition(stream_id, workers):
+    # Streams are partitioned between workers by their ID.
+    return (zlib.crc32(stream_id) & 0xffffffff) % workers
+
+
+def init_worker(database_name):
+    # Every worker process has its own connection to the database.
+    datastream._switch_database(database_name)
+
+
+def map(function, iterable, workers):
+    # Like multiprocessing.Pool.map, but worker processes have their own connections to the database
+    # this process is using. Only the MongoDB backend is supported, see is_supported.
+
+    database_name = mongoengine.connection.get_db(mongodb.DATABASE_ALIAS).name
+
+    # Connections cannot be shared with worker processes, so we close them before
+    # forking. Workers and then this process afterwards connect again.
+    mongoengine.connection.disconnect(mongodb.DATABASE_ALIAS)
+
+    pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(database_name,))
+    try:
+        return pool.map(function, iterable, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+
+        datastream._switch_database(database_name)
@@ -46,5 +46,10 @@ if __name__ == '__main__':
             'pytz>=2012h',
             'mimeparse>=0.1.3',
         ],
+        extras_require={
+            'visualization': [
+                'numpy',
+            ],
+        },
         test_suite='tests.runtests.runtests',
     )
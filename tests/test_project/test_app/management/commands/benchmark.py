@@ -0,0 +1,367 @@
+import datetime
+import json
+import multiprocessing
+import optparse
+import os
+import resource
+import sys
+import time
+
+from django.core import management, urlresolvers
+from django.core.management import base
+from django.test import client
+
+import pkg_resources
+
+try:
+    import mongoengine
+    from datastream.backends import mongodb
+except ImportError:
+    mongoengine = None
+    mongodb = None
+
+from django_datastream import datastream, resources, workers as datastream_workers
+
+DEFAULT_DATABASE = 'django_datastream_benchmark'
+DEFAULT_OUTPUT = 'benchmarks.json'
+DEFAULT_STREAMS = 10
+DEFAULT_INTERVAL = 60 # seconds
+# Absolute time span, so that the same dataset is generated every time.
+DEFAULT_SPAN = '2016-01-01T00:00:00 2016-01-08T00:00:00'
+DEFAULT_SHAPE = 'walk,bursts,gaps'
+DEFAULT_SEED = 0
+DEFAULT_DURATION = 5 # seconds
+
+PAGE_LIMIT = 100
+SERIALIZER_DATAPOINTS = 1000
+
+LIST_TAGS = {
+    'tags__visualization__type': 'line',
+    'tags__title__icontains': 'stream',
+}
+
+
+def get_version():
+    try:
+        return pkg_resources.get_distribution('django-datastream').version
+    except pkg_resources.DistributionNotFound:
+        return 'unknown'
+
+
+def get_database_name():
+    return mongoengine.connection.get_db(mongodb.DATABASE_ALIAS).name
+
+
+def get_peak_memory():
+    # In MB. Peak memory of the whole process, so benchmarks are run in their own processes.
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_memory /= 1024.0
+    return peak_memory / 1024.0
+
+
+class Command(base.BaseCommand):
+    option_list = base.BaseCommand.option_list + (
+        optparse.make_option(
+            '--benchmarks', '-b', action='store', type='string', dest='benchmarks',
+            help="Comma-separated names of benchmarks to run (default: all).",
+        ),
+        optparse.make_option(
+            '--duration', action='store', type='float', dest='duration', default=DEFAULT_DURATION,
+            help="Seconds to run every benchmark for (default: %s)." % DEFAULT_DURATION,
+        ),
+        optparse.make_option(
+            '--database', action='store', type='string', dest='database', default=DEFAULT_DATABASE,
+            help="Database used for benchmark data (default: %s)." % DEFAULT_DATABASE,
+        ),
+        optparse.make_option(
+            '--reuse', action='store_true', dest='reuse', default=False,
+            help="Reuse benchmark data from a previous run, if it exists, and keep it afterwards.",
+        ),
+        optparse.make_option(
+            '--streams', '-n', action='store', type='int', dest='nstreams', default=DEFAULT_STREAMS,
+            help="Number of streams generated with dummystream (default: %s)." % DEFAULT_STREAMS,
+        ),
+        optparse.make_option(
+            '--interval', '-i', action='store', type='int', dest='interval', default=DEFAULT_INTERVAL,
+            help="Interval between generated datapoints in seconds (default: %s)." % DEFAULT_INTERVAL,
+        ),
+        optparse.make_option(
+            '--span', '-s', action='store', type='string', dest='span', default=DEFAULT_SPAN,
+            help="Time span of generated datapoints (default: '%s')." % DEFAULT_SPAN,
+        ),
+        optparse.make_option(
+            '--workers', '-w', action='store', type='int', dest='workers', default=1,
+            help="Number of worker processes generating datapoints (default: 1).",
+        ),
+        optparse.make_option(
+            '--output', '-o', action='store', type='string', dest='output', default=DEFAULT_OUTPUT,
+            help="File to which results are appended and with which they are compared (default: %s)." % DEFAULT_OUTPUT,
+        ),
+        optparse.make_option(
+            '--label', '-l', action='store', type='string', dest='label',
+            help="Label of results (default: installed version of django-datastream).",
+        ),
+    )
+
+    help = "Benchmark HTTP API and serializer with datapoints generated by dummystream."
+
+    def handle(self, *args, **options):
+        verbose = int(options.get('verbosity'))
+        duration = options.get('duration')
+        output = options.get('output')
+
+        if mongodb is None or not isinstance(datastream.backend, mongodb.Backend):
+            raise base.CommandError("Benchmarks are supported only with the MongoDB backend.")
+
+        benchmarks = self.get_benchmarks()
+        if options.get('benchmarks'):
+            names = options.get('benchmarks').split(',')
+            for name in names:
+                if name not in benchmarks:
+                    raise base.CommandError("Unknown benchmark '%s'." % name)
+            benchmarks = [(name, benchmarks[name]) for name in names]
+        else:
+            benchmarks = sorted(benchmarks.items())
+
+        parameters = {
+            'streams': options.get('nstreams'),
+            'interval': options.get('interval'),
+            'span': options.get('span'),
+            'shape': DEFAULT_SHAPE,
+            'seed': DEFAULT_SEED,
+        }
+
+        previous_database = get_database_name()
+        datastream._switch_database(options.get('database'))
+        try:
+            if not options.get('reuse') or not datastream.find_streams().count():
+                datastream.delete_streams()
+
+                if verbose > 1:
+                    self.stdout.write("Generating datapoints.\n")
+
+                management.call_command(
+                    'dummystream',
+                    nstreams=parameters['streams'],
+                    interval=parameters['interval'],
+                    span=parameters['span'],
+                    shape=parameters['shape'],
+                    seed=parameters['seed'],
+                    bulk=True,
+                    workers=options.get('workers'),
+                    norealtime=True,
+                    verbosity=verbose,
+                    stdout=self.stdout,
+                )
+
+            self.client = client.Client()
+            self.streams = [datastream.Stream(stream) for stream in datastream.find_streams()]
+
+            results = {}
+            for name, benchmark in benchmarks:
+                if verbose > 1:
+                    self.stdout.write("Running '%s'.\n" % name)
+
+                results[name] = self.run(name, benchmark, duration)
+        finally:
+            if not options.get('reuse'):
+                datastream.delete_streams()
+
+            datastream._switch_database(previous_database)
+
+        run = {
+            'label': options.get('label') or get_version(),
+            'timestamp': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+            'parameters': parameters,
+            'results': results,
+        }
+
+        runs = []
+        if os.path.exists(output):
+            with open(output, 'r') as f:
+                runs = json.load(f)
+
+        # Results are compared with the latest previous run with the same parameters.
+        previous = None
+        for previous_run in reversed(runs):
+            if previous_run['parameters'] == parameters:
+                previous = previous_run
+                break
+
+        self.write_results(run, previous)
+
+        runs.append(run)
+        with open(output, 'w') as f:
+            json.dump(runs, f, indent=2, sort_keys=True)
+
+    def write_results(self, run, previous):
+        if previous is not None:
+            self.stdout.write("Compared with '%s' from %s.\n" % (previous['label'], previous['timestamp']))
+
+        self.stdout.write("%-30s %14s %16s %10s\n" % ("benchmark", "ops/sec", "peak memory (MB)", "change"))
+        for name, result in sorted(run['results'].items()):
+            change = ''
+            if previous is not None and previous['results'].get(name, {}).get('ops_per_sec'):
+                change = '%+.1f%%' % (100.0 * (result['ops_per_sec'] / previous['results'][name]['ops_per_sec'] - 1))
+
+            self.stdout.write("%-30s %14.1f %16.1f %10s\n" % (name, result['ops_per_sec'], result['peak_memory'], change))
+
+    def run(self, name, benchmark, duration):
+        # Every benchmark is run in a forked process, so that its peak memory does not include
+        # memory used by generating datapoints or by previous benchmarks.
+
+        database_name = get_database_name()
+
+        # Connections cannot be shared with the forked process, so we close them before
+        # forking, as in django_datastream.workers.map.
+        mongoengine.connection.disconnect(mongodb.DATABASE_ALIAS)
+
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+
+        def run_benchmark():
+            datastream_workers.init_worker(database_name)
+
+            try:
+                result = {
+                    'ops_per_sec': self.measure(benchmark(), duration),
+                    'peak_memory': get_peak_memory(),
+                }
+            except Exception, exception:
+                result = {'error': str(exception)}
+
+            sender.send(result)
+
+        process = multiprocessing.Process(target=run_benchmark)
+        process.start()
+        try:
+            # So that we get EOFError if the process exits without sending a result.
+            sender.close()
+
+            try:
+                result = receiver.recv()
+            except EOFError:
+                result = None
+        finally:
+            process.join()
+
+            datastream._switch_database(database_name)
+
+        if result is None:
+            raise base.CommandError("Benchmark '%s' failed: process exited with code %s." % (name, process.exitcode))
+        elif 'error' in result:
+            raise base.CommandError("Benchmark '%s' failed: %s" % (name, result['error']))
+
+        return result
+
+    def measure(self, function, duration):
+        # Returns operations per second. Function is called once before measuring to warm up caches.
+        function()
+
+        count = 0
+        start = time.time()
+        while True:
+            function()
+            count += 1
+
+            elapsed = time.time() - start
+            if elapsed >= duration and elapsed > 0:
+                return count / elapsed
+
+    def get(self, path, data):
+        response = self.client.get(path, data)
+        if response.status_code != 200:
+            raise base.CommandError("Request to '%s' failed with status %s." % (path, response.status_code))
+
+        # Streamed responses have to be consumed.
+        if response.streaming:
+            return ''.join(response.streaming_content)
+
+        return response.content
+
+    def list_uri(self):
+        return urlresolvers.reverse('api_dispatch_list', kwargs={'api_name': 'v1', 'resource_name': 'stream'})
+
+    def detail_uri(self, stream):
+        return urlresolvers.reverse('api_dispatch_detail', kwargs={'api_name': 'v1', 'resource_name': 'stream', 'pk': stream.id})
+
+    def get_benchmarks(self):
+        # Benchmarks are functions which prepare and return the function to be measured.
+        benchmarks = {
+            'list_tags': self.benchmark_list_tags,
+            'detail_deep_offset': self.benchmark_detail_deep_offset,
+            'detail_cursor': self.benchmark_detail_cursor,
+            'serializer_to_json': self.make_benchmark_serializer_to_json('datetime'),
+            'serializer_to_json_epoch': self.make_benchmark_serializer_to_json('epoch'),
+        }
+
+        for granularity in datastream.Granularity.values:
+            benchmarks['detail_%s' % granularity.name] = self.make_benchmark_detail(granularity)
+
+        return benchmarks
+
+    def benchmark_list_tags(self):
+        data = dict(LIST_TAGS, limit=PAGE_LIMIT, format='json')
+
+        def list_tags():
+            self.get(self.list_uri(), data)
+
+        return list_tags
+
+    def make_benchmark_detail(self, granularity):
+        def benchmark_detail():
+            stream = self.streams[0]
+            data = {
+                'granularity': granularity.name,
+                # From the beginning, in seconds since the epoch.
+                'start': 0,
+                'limit': PAGE_LIMIT,
+                'format': 'json',
+            }
+
+            def detail():
+                self.get(self.detail_uri(stream), data)
+
+            return detail
+
+        return benchmark_detail
+
+    def benchmark_detail_deep_offset(self):
+        stream = self.streams[0]
+        count = datastream.get_data(stream.id, stream.highest_granularity, start=datetime.datetime.min).count()
+        data = {
+            'start': 0,
+            'offset': max(count - PAGE_LIMIT, 0),
+            'limit': PAGE_LIMIT,
+            'format': 'json',
+        }
+
+        def detail_deep_offset():
+            self.get(self.detail_uri(stream), data)
+
+        return detail_deep_offset
+
+    def benchmark_detail_cursor(self):
+        # Every call fetches the next page, starting again after the last page.
+        stream = self.streams[0]
+        first = '%s?%s' % (self.detail_uri(stream), 'start=0&limit=%d&cursor=&format=json' % PAGE_LIMIT)
+        state = {'next': first}
+
+        def detail_cursor():
+            content = self.get(state['next'], {})
+            state['next'] = json.loads(content)['meta']['next'] or first
+
+        return detail_cursor
+
+    def make_benchmark_serializer_to_json(self, time_format):
+        def benchmark_serializer_to_json():
+            serializer = resources.StreamResource._meta.serializer
+            datapoints = list(datastream.get_data(self.streams[0].id, self.streams[0].highest_granularity, start=datetime.datetime.min)[:SERIALIZER_DATAPOINTS])
+
+            def serializer_to_json():
+                serializer.to_json({'datapoints': datapoints}, {'time_format': time_format})
+
+            return serializer_to_json
+
+        return benchmark_serializer_to_json
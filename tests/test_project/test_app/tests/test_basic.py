@@ -1,20 +1,32 @@
 import calendar
 import collections
+import csv
 import datetime
 import decimal
+import json
 import os
+import StringIO
 import sys
+import tempfile
+import threading
+import time
 import unittest
 import urllib
+import urlparse
+import uuid
 
-from django.core import management
+from django import test
+from django.core import cache, exceptions as django_exceptions, management, urlresolvers
 from django.utils import dateparse, timezone, translation
 
+import pytz
 import ujson
 
-from tastypie import serializers as tastypie_serializers
+from tastypie import authorization as tastypie_authorization, exceptions as tastypie_exceptions, serializers as tastypie_serializers
 
-from django_datastream import datastream, resources, serializers, test_runner
+import django_datastream
+from django_datastream import datastream, dirty, executor, materialize, metrics, resources, serializers, test_runner, timing, views, visualization
+from django_datastream.management.commands import downsample, dummystream
 
 try:
     # Available since Django 1.7.
@@ -119,6 +131,149 @@ class BasicTest(test_runner.ResourceTestCase):
         self.assertHttpMethodNotAllowed(self.api_client.patch(stream_uri, format='json', data={}))
         self.assertHttpMethodNotAllowed(self.api_client.delete(stream_uri, format='json'))
 
+    def test_append(self):
+        append_uri = '%sappend/' % self.resource_list_uri('stream')
+
+        # By default appending is not authorized.
+        self.assertHttpUnauthorized(self.api_client.post(append_uri, format='json', data=[]))
+
+        stream_id = datastream.ensure_stream({'title': 'Append stream'}, {}, self.value_downsamplers, datastream.Granularity.Seconds)
+
+        authorization = resources.StreamResource._meta.authorization
+        resources.StreamResource._meta.authorization = tastypie_authorization.Authorization()
+
+        try:
+            now = int(time.time())
+
+            response = self.api_client.post(append_uri, format='json', data=[
+                [stream_id, now - 10, 1],
+                {'stream_id': stream_id, 'timestamp': now - 20, 'value': 2},
+                [stream_id, now - 5, 'foo'],
+                [str(uuid.uuid4()), now - 5, 3],
+                [stream_id, 'foo', 4],
+                [stream_id],
+            ])
+            self.assertValidJSONResponse(response)
+
+            data = self.deserialize(response)
+            self.assertEqual(data['appended'], 2)
+            self.assertEqual([error['index'] for error in data['errors']], [2, 3, 4, 5])
+
+            response = self.api_client.client.post(append_uri, data='\n'.join(ujson.dumps([stream_id, now - 2 + i, i]) for i in range(2)), content_type='application/x-ndjson')
+            self.assertValidJSONResponse(response)
+            self.assertEqual(self.deserialize(response), {'appended': 2, 'errors': []})
+
+            datapoints = datastream.get_data(stream_id, datastream.Granularity.Seconds, start=datetime.datetime.utcfromtimestamp(0))
+            self.assertEqual([datapoint['v'] for datapoint in datapoints], [2, 1, 0, 1])
+
+            self.assertHttpBadRequest(self.api_client.client.post(append_uri, data='[1, 2, 3]\n[', content_type='application/x-ndjson'))
+            self.assertHttpBadRequest(self.api_client.post(append_uri, format='json', data={}))
+        finally:
+            resources.StreamResource._meta.authorization = authorization
+            datastream.delete_streams({'title': 'Append stream'})
+
+    @test.override_settings(DATASTREAM_DIRTY_TRACKING=True)
+    def test_append_dirty(self):
+        append_uri = '%sappend/' % self.resource_list_uri('stream')
+
+        stream_id = datastream.ensure_stream({'title': 'Append dirty stream'}, {}, self.value_downsamplers, datastream.Granularity.Seconds)
+
+        marked = []
+
+        def mark(stream_id):
+            marked.append(stream_id)
+            prev_mark(stream_id)
+
+        authorization = resources.StreamResource._meta.authorization
+        resources.StreamResource._meta.authorization = tastypie_authorization.Authorization()
+        prev_mark = dirty.mark
+        dirty.mark = mark
+
+        try:
+            now = int(time.time())
+
+            # Every stream is marked once per request, not once per datapoint.
+            response = self.api_client.post(append_uri, format='json', data=[[stream_id, now - 30 + i, i] for i in range(3)])
+            self.assertValidJSONResponse(response)
+            self.assertEqual(self.deserialize(response), {'appended': 3, 'errors': []})
+            self.assertEqual(marked, [stream_id])
+
+            del marked[:]
+
+            datastream.append_multiple([{'stream_id': stream_id, 'value': i, 'timestamp': datetime.datetime.fromtimestamp(now - 20 + i, pytz.utc)} for i in range(3)])
+            self.assertEqual(marked, [stream_id])
+
+            del marked[:]
+
+            datastream.append_multiple([{'stream_id': stream_id, 'value': 3}], mark_dirty=False)
+            self.assertEqual(marked, [])
+
+            datapoints = datastream.get_data(stream_id, datastream.Granularity.Seconds, start=datetime.datetime.utcfromtimestamp(0))
+            self.assertEqual([datapoint['v'] for datapoint in datapoints], [0, 1, 2, 0, 1, 2, 3])
+            self.assertIn(stream_id, dirty.get_due(datetime.datetime.now(pytz.utc)))
+        finally:
+            dirty.mark = prev_mark
+            resources.StreamResource._meta.authorization = authorization
+            datastream.delete_streams({'title': 'Append dirty stream'})
+            dirty.remove(stream_id)
+
+    def test_backend_threads(self):
+        stream = self.streams[0]
+
+        data = self.get_detail('stream', stream.id, limit=10, offset=5)
+        list_data = self.get_list('stream', offset=1, limit=2)
+        estimate_data = self.get_list('stream', offset=1, limit=2, count='estimate')
+
+        threads = []
+
+        def call_in_pool(function, args, kwargs):
+            threads.append(threading.current_thread())
+            return prev_call_in_pool(function, args, kwargs)
+
+        prev_threads = executor.BACKEND_THREADS
+        prev_call_in_pool = executor._call_in_pool
+        executor.BACKEND_THREADS = 2
+        executor._call_in_pool = call_in_pool
+
+        try:
+            # Backend is queried in the pool, with the same results.
+            self.assertEqual(data, self.get_detail('stream', stream.id, limit=10, offset=5))
+            self.assertTrue(threads)
+            self.assertNotIn(threading.current_thread(), threads)
+
+            del threads[:]
+
+            self.assertEqual(list_data, self.get_list('stream', offset=1, limit=2))
+            self.assertEqual(estimate_data, self.get_list('stream', offset=1, limit=2, count='estimate'))
+            self.assertTrue(threads)
+            self.assertNotIn(threading.current_thread(), threads)
+
+            # At most BACKEND_THREADS calls are made at once.
+            lock = threading.Lock()
+            concurrent = {'current': 0, 'max': 0}
+
+            def query():
+                with lock:
+                    concurrent['current'] += 1
+                    concurrent['max'] = max(concurrent['max'], concurrent['current'])
+                time.sleep(0.05)
+                with lock:
+                    concurrent['current'] -= 1
+
+            callers = [threading.Thread(target=executor.call, args=(query,)) for i in range(6)]
+            for caller in callers:
+                caller.start()
+            for caller in callers:
+                caller.join()
+
+            self.assertEqual(concurrent['max'], 2)
+        finally:
+            executor._call_in_pool = prev_call_in_pool
+            executor.BACKEND_THREADS = prev_threads
+            if executor._pool is not None:
+                executor._pool.terminate()
+                executor._pool = None
+
     def test_get_list_all(self):
         serializer = serializers.DatastreamSerializer()
 
@@ -290,6 +445,280 @@ class BasicTest(test_runner.ResourceTestCase):
                         u'previous': u'%s?%s&format=json&limit=%s&offset=%s' % (self.resource_list_uri('stream'), uri_filter, previous_limit, offset - previous_limit) if offset != 0 else None,
                     }, data['meta'])
 
+    @test.override_settings(DATASTREAM_DIRTY_TRACKING=True)
+    def test_downsample_daemon(self):
+        stream_id = datastream.ensure_stream({'title': 'Daemon stream'}, {}, self.value_downsamplers, datastream.Granularity.Seconds)
+
+        try:
+            start = datastream.Granularity.Minutes.round_timestamp(datetime.datetime.now(pytz.utc) - datetime.timedelta(hours=1))
+            for i in range(30):
+                datastream.append(stream_id, i, start + datetime.timedelta(seconds=i))
+
+            # Appended stream is dirty.
+            self.assertIn(stream_id, dirty.get_due(datetime.datetime.now(pytz.utc)))
+
+            prev = datastream.backend._time_offset
+            datastream.backend._time_offset = datetime.timedelta(minutes=10)
+            try:
+                self.assertTrue(downsample.Command().downsample_dirty() >= 1)
+            finally:
+                datastream.backend._time_offset = prev
+
+            datapoints = datastream.get_data(stream_id, datastream.Granularity.Seconds10, start=datetime.datetime.min)
+            self.assertEqual([datapoint['v'][datastream.VALUE_DOWNSAMPLERS['count']] for datapoint in datapoints], [10, 10, 10])
+
+            # Stream is not due until coarser granularities can be downsampled.
+            self.assertNotIn(stream_id, dirty.get_due(datetime.datetime.now(pytz.utc)))
+            self.assertEqual(dirty.get_collection().find_one({'_id': stream_id})['due'], dirty.get_due_time(datastream.Stream(datastream.get_tags(stream_id))))
+
+            datastream.append(stream_id, 30, start + datetime.timedelta(seconds=30))
+            self.assertIn(stream_id, dirty.get_due(datetime.datetime.now(pytz.utc)))
+        finally:
+            datastream.delete_streams({'title': 'Daemon stream'})
+            dirty.remove(stream_id)
+
+    def test_downsample_stats(self):
+        stream = self.streams[3]
+
+        until = (stream.latest_datapoint + datetime.timedelta(minutes=10)).strftime('%Y-%m-%dT%H:%M:%S')
+
+        output = StringIO.StringIO()
+        prev = datastream.backend._time_offset
+        datastream.backend._time_offset = datetime.timedelta(minutes=10)
+        try:
+            # Counts of datapoints are collected only when requested.
+            management.call_command('downsample', until=until, streams=stream.id, stats='json', count_datapoints=True, stdout=output)
+        finally:
+            datastream.backend._time_offset = prev
+
+        stats = json.loads(output.getvalue())
+
+        self.assertEqual([stream_stats['stream_id'] for stream_stats in stats['streams']], [stream.id])
+
+        stream_stats = stats['streams'][0]
+        # Everything has been downsampled.
+        self.assertEqual(stream_stats['lag'], 0)
+        self.assertEqual(stats['total']['max_lag'], 0)
+
+        for granularity, granularity_stats in stream_stats['granularities'].items():
+            self.assertIn(granularity, [g.name for g in datastream.Granularity.values[1:]])
+            self.assertGreaterEqual(granularity_stats['time'], 0)
+            self.assertGreaterEqual(granularity_stats['read'], 0)
+            self.assertGreaterEqual(granularity_stats['written'], 0)
+
+        self.assertEqual(stream_stats['read'], sum(granularity_stats['read'] for granularity_stats in stream_stats['granularities'].values()))
+        self.assertEqual(stats['total']['written'], stream_stats['written'])
+
+        output = StringIO.StringIO()
+        management.call_command('downsample', until=until, streams=stream.id, stats='json', stdout=output)
+
+        stats = json.loads(output.getvalue())
+
+        # Keys are always present, but without counts.
+        self.assertIsNone(stats['total']['read'])
+        self.assertIsNone(stats['total']['written'])
+        for stream_stats in stats['streams']:
+            self.assertIsNone(stream_stats['read'])
+            self.assertIsNone(stream_stats['written'])
+            for granularity_stats in stream_stats['granularities'].values():
+                self.assertIsNone(granularity_stats['read'])
+                self.assertIsNone(granularity_stats['written'])
+
+        with self.assertRaises(management.CommandError):
+            management.call_command('downsample', count_datapoints=True)
+
+    def test_downsample_workers(self):
+        streams = self.streams[3:5]
+
+        until = (max(stream.latest_datapoint for stream in streams) + datetime.timedelta(minutes=10)).strftime('%Y-%m-%dT%H:%M:%S')
+
+        prev = datastream.backend._time_offset
+        datastream.backend._time_offset = datetime.timedelta(minutes=10)
+        try:
+            management.execute_from_command_line([sys.argv[0], 'downsample', '--until=%s' % until, '--workers=2', '--streams=%s' % ','.join(stream.id for stream in streams)])
+        finally:
+            datastream.backend._time_offset = prev
+
+        for stream in streams:
+            datapoints = datastream.get_data(
+                stream_id=stream.id,
+                granularity=datastream.Granularity.Minutes,
+                start=datetime.datetime.min,
+            )
+
+            # All datapoints of the stream have been downsampled.
+            self.assertEqual(sum(datapoint['v'][datastream.VALUE_DOWNSAMPLERS['count']] for datapoint in datapoints), len(datastream.get_data(
+                stream_id=stream.id,
+                granularity=datastream.Granularity.Seconds,
+                start=datetime.datetime.min,
+            )))
+
+        with self.assertRaises(management.CommandError):
+            management.call_command('downsample', workers=0)
+
+    @test.override_settings(DATASTREAM_DIRTY_TRACKING=True)
+    def test_dummystream_bulk(self):
+        span_from = datetime.datetime(2016, 1, 1, tzinfo=pytz.utc)
+        span_to = span_from + datetime.timedelta(days=1)
+        shapes = ['walk', 'bursts', 'gaps', 'late']
+
+        datapoints = list(dummystream.generate_datapoints(42, 0, 'int', '0,100', shapes, span_from, span_to, 60))
+
+        # Same seed generates the same datapoints.
+        self.assertEqual(datapoints, list(dummystream.generate_datapoints(42, 0, 'int', '0,100', shapes, span_from, span_to, 60)))
+        self.assertNotEqual(datapoints, list(dummystream.generate_datapoints(43, 0, 'int', '0,100', shapes, span_from, span_to, 60)))
+        self.assertNotEqual(datapoints, list(dummystream.generate_datapoints(42, 1, 'int', '0,100', shapes, span_from, span_to, 60)))
+
+        # Random generators do not depend on hash randomization or the platform.
+        self.assertAlmostEqual(0.323054088172, dummystream.make_rng(42, 0).random())
+
+        timestamps = [timestamp for timestamp, value, late in datapoints]
+        self.assertEqual(len(timestamps), len(set(timestamps)))
+
+        latest = None
+        for timestamp, value, late in datapoints:
+            self.assertTrue(span_from <= timestamp <= span_to)
+            self.assertTrue(0 <= value <= 100)
+            self.assertIsInstance(value, int)
+
+            if late:
+                self.assertLess(timestamp, latest)
+            else:
+                if latest is not None:
+                    self.assertGreater(timestamp, latest)
+                latest = timestamp
+
+        # The last appended datapoint is never late, so the latest datapoint of the stream is correct.
+        self.assertFalse(datapoints[-1][2])
+
+        stream_id = datastream.ensure_stream({'title': 'Bulk stream'}, {}, ['mean'], datastream.Granularity.Seconds)
+        try:
+            # A batch size which does not divide the number of datapoints.
+            self.assertEqual(len(datapoints), dummystream.append_bulk((stream_id, 0, 'int', '0,100', shapes, 42, span_from, span_to, 60, 100)))
+
+            # Streams are downsampled right away, so they are not marked as dirty.
+            self.assertIsNone(dirty.get_collection().find_one({'_id': stream_id}))
+
+            stream = datastream.Stream(datastream.get_tags(stream_id))
+            self.assertEqual(max(timestamps), stream.latest_datapoint.replace(tzinfo=pytz.utc))
+            self.assertEqual(min(timestamps), stream.earliest_datapoint.replace(tzinfo=pytz.utc))
+
+            stored = list(datastream.get_data(stream_id, datastream.Granularity.Seconds, datetime.datetime.min))
+            self.assertEqual(sorted(timestamps), [datapoint['t'] for datapoint in stored])
+            self.assertEqual([value for timestamp, value, late in sorted(datapoints)], [datapoint['v'] for datapoint in stored])
+
+            # The whole day has been downsampled.
+            self.assertEqual(1, len(list(datastream.get_data(stream_id, datastream.Granularity.Days, datetime.datetime.min))))
+        finally:
+            datastream.delete_streams({'title': 'Bulk stream'})
+
+        with self.assertRaises(management.CommandError):
+            management.call_command('dummystream', shape='sine', norealtime=True)
+
+        with self.assertRaises(management.CommandError):
+            management.call_command('dummystream', bulk=True, norealtime=True)
+
+        with self.assertRaises(management.CommandError):
+            management.call_command('dummystream', bulk=True, batch_size=0, span='1h', norealtime=True)
+
+    def test_benchmark(self):
+        count = datastream.find_streams().count()
+
+        with tempfile.NamedTemporaryFile(suffix='.json') as results:
+            for label in ('first', 'second'):
+                output = StringIO.StringIO()
+                management.call_command(
+                    'benchmark',
+                    benchmarks='list_tags,detail_seconds,detail_cursor,serializer_to_json',
+                    database='django_datastream_benchmark_testing',
+                    nstreams=1,
+                    span='2016-01-01T00:00:00 2016-01-01T01:00:00',
+                    duration=0,
+                    output=results.name,
+                    label=label,
+                    stdout=output,
+                )
+
+            runs = json.load(results)
+
+        self.assertEqual([run['label'] for run in runs], ['first', 'second'])
+        self.assertEqual(sorted(runs[1]['results'].keys()), ['detail_cursor', 'detail_seconds', 'list_tags', 'serializer_to_json'])
+        for result in runs[1]['results'].values():
+            self.assertGreater(result['ops_per_sec'], 0)
+            self.assertGreater(result['peak_memory'], 0)
+
+        # Second run is compared with the first one.
+        self.assertIn("Compared with 'first'", output.getvalue())
+
+        # Benchmark data is in its own database.
+        self.assertEqual(datastream.find_streams().count(), count)
+
+    def test_fields(self):
+        for fields, expected in (
+            ('id', lambda stream: {u'id': stream.id}),
+            ('id,tags__title', lambda stream: {u'id': stream.id, u'tags': {u'title': stream.tags['title']}}),
+            (['id', 'tags__title'], lambda stream: {u'id': stream.id, u'tags': {u'title': stream.tags['title']}}),
+            ('tags__visualization__value_downsamplers,tags__missing', lambda stream: {u'tags': {u'visualization': {u'value_downsamplers': stream.tags['visualization']['value_downsamplers']}}}),
+            ('id,tags', lambda stream: {u'id': stream.id, u'tags': stream.tags}),
+            ('highest_granularity,value_type', lambda stream: {u'highest_granularity': stream.highest_granularity, u'value_type': stream.value_type}),
+        ):
+            data = self.get_list('stream', offset=0, limit=0, fields=fields)
+
+            self.assertEqual([expected(stream) for stream in self.streams], data['objects'], fields)
+
+        for fields in ('foobar', 'id__foobar', 'tags__'):
+            self.assertHttpBadRequest(self.api_client.get(self.resource_list_uri('stream'), data={'fields': fields}))
+
+    def test_lazy_datastream(self):
+        import mongoengine
+        from datastream.backends import mongodb
+
+        self.assertIsInstance(datastream, django_datastream.LazyDatastream)
+
+        connection = mongoengine.connection.get_connection(mongodb.DATABASE_ALIAS)
+        database_name = mongoengine.connection.get_db(mongodb.DATABASE_ALIAS).name
+        count = datastream.find_streams().count()
+
+        # Pretend we are in a forked process, which should connect again to the same database.
+        datastream._pid = None
+        self.assertEqual(count, datastream.find_streams().count())
+
+        self.assertIsNot(connection, mongoengine.connection.get_connection(mongodb.DATABASE_ALIAS))
+        self.assertEqual(database_name, mongoengine.connection.get_db(mongodb.DATABASE_ALIAS).name)
+
+        self.assertEqual(
+            {'maxPoolSize': 10, 'connectTimeoutMS': 500, 'tz_aware': True},
+            django_datastream.get_backend_settings(mongodb.Backend, {'pool_size': 10, 'connect_timeout': 0.5, 'tz_aware': True}),
+        )
+
+        with self.assertRaises(django_exceptions.ImproperlyConfigured):
+            django_datastream.get_backend_settings(object, {'pool_size': 10})
+
+    def test_indexes(self):
+        from datastream.backends import mongodb
+
+        with tempfile.NamedTemporaryFile() as log:
+            log.write('127.0.0.1 - - "GET %s?tags__visualization__type=line&format=json HTTP/1.1" 200\n' % self.resource_list_uri('stream'))
+            log.write('127.0.0.1 - - "GET %s?tags__title__icontains=stream HTTP/1.1" 200\n' % self.resource_list_uri('stream'))
+            log.flush()
+
+            output = StringIO.StringIO()
+            management.call_command('datastream_indexes', paths='stream_number', logs=[log.name], stdout=output)
+
+        indexed = [index['key'][0][0] for index in mongodb.Stream._get_collection().index_information().values()]
+
+        self.assertIn('tags.stream_number', indexed)
+        self.assertIn('tags.visualization.type', indexed)
+        self.assertIn('tags.title', indexed)
+
+        # Case-insensitive match cannot use an index.
+        self.assertIn('tags__title__icontains (1 requests)', output.getvalue())
+        self.assertNotIn('tags__visualization__type (1 requests)', output.getvalue())
+
+        # Filters still work.
+        data = self.get_list('stream', tags__stream_number=1)
+        self.assertEqual([stream.id for stream in self.streams if stream.tags['stream_number'] == 1], [stream['id'] for stream in data['objects']])
+
     @unittest.skipUnless(apps, "Skipping for Django < 1.7")
     def test_schema(self):
         # We need Django 1.7+ for apps.
@@ -531,6 +960,787 @@ class BasicTest(test_runner.ResourceTestCase):
                                         sys.stdout.write('?')
                                         sys.stdout.flush()
 
+    def get_meta_uri(self, uri):
+        uri = urlparse.urlparse(uri)
+        return self.get_uri(uri.path, **dict(urlparse.parse_qsl(uri.query)))
+
+    def test_get_stream_cursor(self):
+        stream = self.streams[0]
+
+        for reverse in (False, True):
+            kwargs = {
+                'limit': 100,
+                'cursor': '',
+            }
+            if reverse:
+                kwargs['reverse'] = True
+
+            data = self.get_detail('stream', stream.id, **kwargs)
+            self.assertEqual(None, data['meta']['previous'])
+            self.assertItemsEqual(['limit', 'next', 'previous'], data['meta'].keys())
+
+            pages = [data['datapoints']]
+            while data['meta']['next']:
+                data = self.get_meta_uri(data['meta']['next'])
+                pages.append(data['datapoints'])
+
+            # Going back should return the same pages.
+            previous_pages = [data['datapoints']]
+            while data['meta']['previous']:
+                data = self.get_meta_uri(data['meta']['previous'])
+                previous_pages.insert(0, data['datapoints'])
+
+            self.assertEqual(pages, previous_pages)
+            self.assertEqual([100] * 7 + [21], [len(page) for page in pages])
+
+            stream_datapoints = datastream.get_data(
+                stream_id=stream.id,
+                granularity=datastream.Granularity.Seconds,
+                start=datetime.datetime.min,
+                reverse=reverse,
+            )
+            datapoints = sum(pages, [])
+            self.assertEqualDatapoints(stream_datapoints, 0, len(datapoints), datapoints, 'reverse=%s' % reverse)
+
+    def test_get_stream_cursor_same_second(self):
+        stream_id = datastream.ensure_stream({'title': 'Cursor stream'}, {}, self.value_downsamplers, datastream.Granularity.Seconds)
+
+        try:
+            # Several datapoints in the same second, across page boundaries.
+            timestamp = datetime.datetime(2016, 1, 1, tzinfo=pytz.utc)
+            values = []
+            for second, count in enumerate((1, 5, 2, 7, 1)):
+                for i in range(count):
+                    values.append(len(values))
+                    datastream.append(stream_id, values[-1], timestamp + datetime.timedelta(seconds=second))
+
+            for reverse in (False, True):
+                for limit in (1, 2, 3, 4):
+                    kwargs = {
+                        'limit': limit,
+                        'cursor': '',
+                    }
+                    if reverse:
+                        kwargs['reverse'] = True
+
+                    data = self.get_detail('stream', stream_id, **kwargs)
+
+                    pages = [data['datapoints']]
+                    while data['meta']['next']:
+                        data = self.get_meta_uri(data['meta']['next'])
+                        pages.append(data['datapoints'])
+
+                    previous_pages = [data['datapoints']]
+                    while data['meta']['previous']:
+                        data = self.get_meta_uri(data['meta']['previous'])
+                        previous_pages.insert(0, data['datapoints'])
+
+                    message = 'reverse=%s, limit=%s' % (reverse, limit)
+                    self.assertEqual(pages, previous_pages, message)
+                    self.assertEqual(list(reversed(values)) if reverse else values, [datapoint['v'] for page in pages for datapoint in page], message)
+        finally:
+            datastream.delete_streams({'title': 'Cursor stream'})
+
+    def test_get_stream_streaming(self):
+        stream = self.streams[0]
+
+        for kwargs in ({'limit': 1000}, {'limit': 0}, {'limit': 40, 'offset': 700, 'reverse': True}):
+            data = self.get_detail('stream', stream.id, **kwargs)
+
+            kwargs.update({
+                'format': 'json',
+                'streaming': True,
+            })
+            response = self.api_client.get(self.resource_detail_uri('stream', stream.id), data=kwargs)
+
+            self.assertEqual(200, response.status_code)
+            self.assertTrue(response.streaming)
+            self.assertTrue(response['Content-Type'].startswith('application/json'))
+
+            streamed_data = ujson.loads(''.join(response.streaming_content))
+
+            self.assertEqual(data, streamed_data, kwargs)
+
+        # Formats without streaming serialization are not streamed and have the usual page limit.
+        max_detail_limit = resources.StreamResource._meta.max_detail_limit
+        response = self.api_client.get(self.resource_detail_uri('stream', stream.id), data={'format': 'jsonp', 'callback': 'foo', 'limit': max_detail_limit + 1, 'streaming': True})
+
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(response.streaming)
+        self.assertTrue(response.content.startswith('foo('))
+        self.assertEqual(max_detail_limit, ujson.loads(response.content[4:-1])['meta']['limit'])
+
+    @unittest.skipUnless(serializers.lxml_etree, "Skipping without lxml")
+    def test_get_stream_streaming_xml(self):
+        stream = self.streams[0]
+        serializer = serializers.DatastreamSerializer()
+
+        for kwargs in ({'limit': 1000}, {'limit': 0}, {'limit': 40, 'offset': 700, 'reverse': True}):
+            data = self.get_detail('stream', stream.id, format='xml', **kwargs)
+
+            kwargs.update({
+                'format': 'xml',
+                'streaming': True,
+            })
+            response = self.api_client.get(self.resource_detail_uri('stream', stream.id), data=kwargs)
+
+            self.assertEqual(200, response.status_code)
+            self.assertTrue(response.streaming)
+            self.assertTrue(response['Content-Type'].startswith('application/xml'))
+
+            streamed_data = serializer.from_xml(''.join(response.streaming_content))
+
+            self.assertEqual(data, streamed_data, kwargs)
+
+    def test_get_stream_binary(self):
+        serializer = serializers.DatastreamSerializer()
+
+        for stream, kwargs in (
+            (self.streams[0], {'limit': 40, 'offset': 11}),
+            # More datapoints than in one block.
+            (self.streams[0], {'limit': serializers.STREAMING_CHUNK_SIZE + 100}),
+            (self.streams[1], {'limit': 40, 'reverse': True, 'granularity': 'minutes', 'value_downsamplers': 'mean,min', 'time_downsamplers': 'first'}),
+        ):
+            data = self.get_detail('stream', stream.id, **kwargs)
+
+            kwargs.update({
+                'format': 'binary',
+            })
+            response = self.api_client.get(self.resource_detail_uri('stream', stream.id), data=kwargs)
+
+            self.assertEqual(200, response.status_code)
+            self.assertTrue(response['Content-Type'].startswith('application/octet-stream'))
+
+            # Binary responses are always streamed.
+            self.assertTrue(response.streaming)
+            content = ''.join(response.streaming_content)
+
+            # The last block is empty, so truncated content is detected.
+            with self.assertRaises(tastypie_exceptions.BadRequest):
+                serializer.from_binary(content[:-8])
+
+            binary_data = serializer.from_binary(content)
+            columns = binary_data.pop('datapoints')
+
+            self.assertEqual(len(data['datapoints']), binary_data.pop('count'))
+
+            for i, datapoint in enumerate(data.pop('datapoints')):
+                for field in ('t', 'v'):
+                    values = datapoint[field] if isinstance(datapoint[field], dict) else {None: datapoint[field]}
+                    for key, value in values.items():
+                        if key is None:
+                            name = field
+                        else:
+                            downsamplers = datastream.TIME_DOWNSAMPLERS if field == 't' else datastream.VALUE_DOWNSAMPLERS
+                            name = '%s.%s' % (field, [n for n, k in downsamplers.items() if k == key][0])
+
+                        if field == 't':
+                            value = calendar.timegm(dateparse.parse_datetime(value).utctimetuple()) * 1000
+
+                        self.assertAlmostEqual(float(value), columns[name][i])
+
+            self.assertEqual(data, binary_data)
+
+        # Binary format supports only numeric streams.
+        stream = [stream for stream in self.streams if stream.value_type == 'nominal'][0]
+        response = self.api_client.get(self.resource_detail_uri('stream', stream.id), data={'format': 'binary', 'limit': 5})
+        self.assertHttpBadRequest(response)
+
+    def test_get_stream_csv(self):
+        for stream in self.streams[:2]:
+            for kwargs in ({'limit': 1000}, {'limit': 40, 'offset': 11, 'reverse': True}):
+                data = self.get_detail('stream', stream.id, **kwargs)
+
+                kwargs.update({
+                    'format': 'csv',
+                })
+                response = self.api_client.get(self.resource_detail_uri('stream', stream.id), data=kwargs)
+
+                self.assertEqual(200, response.status_code)
+                # CSV is always streamed.
+                self.assertTrue(response.streaming)
+                self.assertTrue(response['Content-Type'].startswith('text/csv'))
+
+                rows = list(csv.reader(''.join(response.streaming_content).splitlines()))
+
+                self.assertEqual(['t', 'v'], rows.pop(0))
+                self.assertEqual(len(data['datapoints']), len(rows))
+
+                for datapoint, (t, v) in zip(data['datapoints'], rows):
+                    self.assertEqual(datapoint['t'], t)
+                    self.assertAlmostEqual(datapoint['v'], float(v))
+
+    def test_get_stream_time_format(self):
+        def to_epoch(value, scale):
+            value = dateparse.parse_datetime(value)
+            return calendar.timegm(value.utctimetuple()) * scale + value.microsecond * scale // 1000000
+
+        for stream, kwargs in (
+            (self.streams[0], {'limit': 40, 'offset': 11}),
+            (self.streams[1], {'limit': 40, 'reverse': True, 'granularity': 'minutes'}),
+        ):
+            data = self.get_detail('stream', stream.id, **kwargs)
+
+            for time_format, scale in (('epoch', 1), ('epoch_ms', 1000)):
+                response = self.api_client.get(self.resource_detail_uri('stream', stream.id), data=dict(kwargs, format='json', time_format=time_format, streaming=True))
+                self.assertEqual(200, response.status_code)
+
+                for epoch_data in (self.get_detail('stream', stream.id, time_format=time_format, **kwargs), ujson.loads(''.join(response.streaming_content))):
+                    self.assertEqual(to_epoch(data['earliest_datapoint'], scale), epoch_data['earliest_datapoint'])
+                    self.assertEqual(len(data['datapoints']), len(epoch_data['datapoints']))
+
+                    for datapoint, epoch_datapoint in zip(data['datapoints'], epoch_data['datapoints']):
+                        self.assertEqual(datapoint['v'], epoch_datapoint['v'])
+
+                        if isinstance(datapoint['t'], dict):
+                            self.assertEqual(dict((key, to_epoch(value, scale)) for key, value in datapoint['t'].items()), epoch_datapoint['t'])
+                        else:
+                            self.assertEqual(to_epoch(datapoint['t'], scale), epoch_datapoint['t'])
+
+        response = self.api_client.get(self.resource_detail_uri('stream', self.streams[0].id), data={'format': 'json', 'time_format': 'foobar'})
+        self.assertHttpBadRequest(response)
+
+    def test_server_timing(self):
+        stream = self.streams[0]
+
+        response = self.api_client.get(self.resource_detail_uri('stream', stream.id), data={'format': 'json', 'limit': 10})
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+        prev = timing.SERVER_TIMING_KEY
+        timing.SERVER_TIMING_KEY = 'secret'
+        try:
+            for kwargs, phases in (
+                ({'limit': 10}, ['tags', 'data', 'count', 'serialize', 'total']),
+                ({'limit': 10, 'count': 'false'}, ['tags', 'data', 'serialize', 'total']),
+            ):
+                response = self.api_client.get(self.resource_detail_uri('stream', stream.id), data=dict(kwargs, format='json', server_timing='secret'))
+                self.assertEqual(200, response.status_code)
+
+                header = [metric.split(';') for metric in response['Server-Timing'].split(', ')]
+                self.assertEqual(sorted(phases), sorted(metric[0] for metric in header), kwargs)
+
+                for name, duration, description in header:
+                    self.assertTrue(duration.startswith('dur='))
+                    self.assertGreaterEqual(float(duration[4:]), 0)
+
+            # Phases are recorded where the backend is queried, which for datapoints and
+            # streams is when they are read, not when their (lazy) queries are created.
+            reads = []
+
+            def call(function, *args, **kwargs):
+                start = time.time()
+                try:
+                    return prev_call(function, *args, **kwargs)
+                finally:
+                    if function is list:
+                        reads.append(time.time() - start)
+
+            prev_call = executor.call
+            executor.call = call
+            try:
+                for uri, kwargs, phase in (
+                    (self.resource_detail_uri('stream', stream.id), {'limit': 10}, 'data'),
+                    (self.resource_detail_uri('stream', stream.id), {'limit': 10, 'count': 'false'}, 'data'),
+                    (self.resource_list_uri('stream'), {'limit': 2}, 'tags'),
+                ):
+                    del reads[:]
+
+                    response = self.api_client.get(uri, data=dict(kwargs, format='json', server_timing='secret'))
+                    self.assertEqual(200, response.status_code)
+
+                    header = dict((metric.split(';')[0], metric.split(';')[1:]) for metric in response['Server-Timing'].split(', '))
+                    duration, description = header[phase]
+
+                    self.assertEqual(len(reads), 1, kwargs)
+                    self.assertEqual(description, 'desc="1 call"')
+                    self.assertGreater(reads[0], 0)
+                    # Durations are in milliseconds, rounded.
+                    self.assertGreaterEqual(float(duration[4:]), reads[0] * 1000 - 0.001)
+            finally:
+                executor.call = prev_call
+
+            # Without the right key there is no header.
+            response = self.api_client.get(self.resource_detail_uri('stream', stream.id), data={'format': 'json', 'limit': 10, 'server_timing': 'foobar'})
+            self.assertEqual(200, response.status_code)
+            self.assertFalse(response.has_header('Server-Timing'))
+        finally:
+            timing.SERVER_TIMING_KEY = prev
+
+    def test_metrics(self):
+        stream = self.streams[0]
+
+        # Metrics are disabled by default.
+        self.assertEqual(404, self.api_client.get(urlresolvers.reverse('datastream_metrics')).status_code)
+
+        increments = []
+
+        def incr(store, key, delta=1):
+            increments.append(key)
+            prev_incr(store, key, delta)
+
+        prev_metrics = metrics.METRICS
+        prev_cache = metrics.METRICS_CACHE
+        prev_flush_interval = metrics.FLUSH_INTERVAL
+        prev_incr = metrics.CacheStore.incr
+        metrics.METRICS = True
+        metrics.METRICS_CACHE = 'default'
+        metrics.FLUSH_INTERVAL = 60 * 60
+        metrics.CacheStore.incr = incr
+        cache.caches['default'].clear()
+        metrics.flush()
+        try:
+            for i in range(2):
+                response = self.api_client.get(self.resource_detail_uri('stream', stream.id), data={'format': 'json', 'granularity': 'seconds', 'limit': 10})
+                self.assertEqual(200, response.status_code)
+
+            # Datapoints are counted also without the total count and when streamed.
+            response = self.api_client.get(self.resource_detail_uri('stream', stream.id), data={'format': 'json', 'granularity': 'seconds', 'limit': 10, 'count': 'false'})
+            self.assertEqual(200, response.status_code)
+
+            response = self.api_client.get(self.resource_detail_uri('stream', stream.id), data={'format': 'json', 'granularity': 'seconds', 'limit': 10, 'streaming': True})
+            self.assertEqual(200, response.status_code)
+            self.assertTrue(response.streaming)
+            self.assertEqual(10, len(ujson.loads(''.join(response.streaming_content))['datapoints']))
+
+            response = self.api_client.get('%sset/%s;%s/' % (self.resource_list_uri('stream'), stream.id, stream.id), data={'format': 'json', 'granularity': 'seconds', 'limit': 5})
+            self.assertEqual(200, response.status_code)
+
+            metrics.set_downsample_run(1000.5, 2.5, 3, 60.0)
+
+            # Counters are accumulated in the process and not added to the cache on every request.
+            self.assertEqual(increments, [])
+
+            response = self.api_client.get(urlresolvers.reverse('datastream_metrics'))
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(metrics.CONTENT_TYPE, response['Content-Type'])
+
+            lines = response.content.splitlines()
+
+            self.assertIn('datastream_http_request_duration_seconds_bucket{endpoint="detail",granularity="seconds",le="+Inf"} 4', lines)
+            self.assertIn('datastream_http_request_duration_seconds_count{endpoint="detail",granularity="seconds"} 4', lines)
+            self.assertIn('datastream_http_request_duration_seconds_count{endpoint="multiple",granularity="seconds"} 1', lines)
+            self.assertIn('datastream_datapoints_served_total{endpoint="detail",granularity="seconds"} 40', lines)
+            self.assertIn('datastream_datapoints_served_total{endpoint="multiple",granularity="seconds"} 10', lines)
+            for phase in ('tags', 'data'):
+                self.assertTrue(any(line.startswith('datastream_backend_calls_total{phase="%s"} ' % phase) for line in lines), phase)
+            self.assertIn('datastream_downsample_last_run_timestamp_seconds 1000.5', lines)
+            self.assertIn('datastream_downsample_last_run_duration_seconds 2.5', lines)
+            self.assertIn('datastream_downsample_last_run_streams 3', lines)
+            self.assertIn('datastream_downsample_max_lag_seconds 60.0', lines)
+
+            # Buckets are cumulative.
+            buckets = [int(line.split()[-1]) for line in lines if line.startswith('datastream_http_request_duration_seconds_bucket{endpoint="detail",granularity="seconds",')]
+            self.assertEqual(len(metrics.LATENCY_BUCKETS) + 1, len(buckets))
+            self.assertEqual(sorted(buckets), buckets)
+
+            # Fetching metrics added accumulated counters to the cache, every one of them once.
+            self.assertTrue(increments)
+            self.assertEqual(len(increments), len(set(increments)))
+
+            del increments[:]
+
+            # With no flush interval, counters are added after every request.
+            metrics.FLUSH_INTERVAL = 0
+            response = self.api_client.get(self.resource_detail_uri('stream', stream.id), data={'format': 'json', 'granularity': 'seconds', 'limit': 10})
+            self.assertEqual(200, response.status_code)
+            self.assertIn('datastream_http_request_duration_seconds_sum{endpoint="detail",granularity="seconds"}', increments)
+        finally:
+            metrics.CacheStore.incr = prev_incr
+            metrics.FLUSH_INTERVAL = prev_flush_interval
+            metrics.flush()
+            metrics.METRICS = prev_metrics
+            metrics.METRICS_CACHE = prev_cache
+
+    def test_metrics_access(self):
+        User = collections.namedtuple('User', ('is_active', 'is_staff'))
+        request_factory = test.RequestFactory()
+
+        def get_status(user=None, **headers):
+            request = request_factory.get(urlresolvers.reverse('datastream_metrics'), **headers)
+            if user is not None:
+                request.user = user
+            return views.metrics(request).status_code
+
+        prev_metrics = metrics.METRICS
+        prev_cache = metrics.METRICS_CACHE
+        prev_token = metrics.METRICS_TOKEN
+        prev_staff_only = metrics.METRICS_STAFF_ONLY
+        metrics.METRICS = True
+        metrics.METRICS_CACHE = 'default'
+        try:
+            # By default anyone can fetch metrics.
+            self.assertEqual(200, get_status())
+
+            metrics.METRICS_TOKEN = 'secret'
+            self.assertEqual(403, get_status())
+            self.assertEqual(403, get_status(HTTP_AUTHORIZATION='Bearer foobar'))
+            self.assertEqual(403, get_status(User(True, True)))
+            self.assertEqual(200, get_status(HTTP_AUTHORIZATION='Bearer secret'))
+
+            metrics.METRICS_STAFF_ONLY = True
+            self.assertEqual(200, get_status(HTTP_AUTHORIZATION='Bearer secret'))
+            self.assertEqual(200, get_status(User(True, True)))
+
+            metrics.METRICS_TOKEN = None
+            self.assertEqual(403, get_status())
+            self.assertEqual(403, get_status(User(True, False)))
+            self.assertEqual(403, get_status(User(False, True)))
+            self.assertEqual(403, get_status(HTTP_AUTHORIZATION='Bearer secret'))
+            self.assertEqual(200, get_status(User(True, True)))
+        finally:
+            metrics.METRICS = prev_metrics
+            metrics.METRICS_CACHE = prev_cache
+            metrics.METRICS_TOKEN = prev_token
+            metrics.METRICS_STAFF_ONLY = prev_staff_only
+
+    def test_get_stream_max_points(self):
+        stream = self.streams[0]
+
+        # Stream has datapoints for one hour.
+        middle_time = calendar.timegm((stream.earliest_datapoint + (stream.latest_datapoint - stream.earliest_datapoint) / 2).utctimetuple())
+
+        for kwargs, granularity in (
+            ({'max_points': 10000}, u'seconds'),
+            ({'max_points': 1000}, u'10seconds'),
+            ({'max_points': 100}, u'minutes'),
+            ({'max_points': 10}, u'10minutes'),
+            ({'max_points': 1}, u'6hours'),
+            ({'max_points': 2000, 'start': middle_time}, u'seconds'),
+            ({'max_points': 1000, 'start': middle_time}, u'10seconds'),
+            ({'max_points': 10000, 'granularity': 'minutes'}, u'minutes'),
+            ({'max_points': 10, 'granularity': 'minutes'}, u'10minutes'),
+        ):
+            kwargs['limit'] = 0
+            data = self.get_detail('stream', stream.id, **kwargs)
+            self.assertEqual(granularity, data['query_params']['granularity'], kwargs)
+
+        for max_points in ('0', '-1', 'foo'):
+            response = self.api_client.get(self.resource_detail_uri('stream', stream.id), data={'max_points': max_points})
+            self.assertHttpBadRequest(response)
+
+    @unittest.skipUnless(visualization.numpy, "Skipping without NumPy")
+    def test_get_stream_visual_downsample(self):
+        stream = self.streams[1]
+
+        all_datapoints = self.get_detail('stream', stream.id, limit=10000)['datapoints']
+        self.assertTrue(len(all_datapoints) > 100)
+
+        for method in ('lttb', 'minmax'):
+            data = self.get_detail('stream', stream.id, limit=10000, visual_downsample=method, points=100)
+            datapoints = data['datapoints']
+
+            self.assertTrue(0 < len(datapoints) <= 100, method)
+            self.assertEqual(len(datapoints), data['meta']['total_count'])
+
+            # Selected datapoints are original datapoints, in the same order.
+            indices = [all_datapoints.index(datapoint) for datapoint in datapoints]
+            self.assertEqual(sorted(indices), indices)
+
+            # The first and the last datapoint are always selected with LTTB, and peaks with min-max.
+            if method == 'lttb':
+                self.assertEqual(all_datapoints[0], datapoints[0])
+                self.assertEqual(all_datapoints[-1], datapoints[-1])
+            else:
+                self.assertIn(max(all_datapoints, key=lambda d: d['v']), datapoints)
+                self.assertIn(min(all_datapoints, key=lambda d: d['v']), datapoints)
+
+        # Visual downsampling supports only numeric streams.
+        stream = [stream for stream in self.streams if stream.value_type == 'nominal'][0]
+        self.assertHttpBadRequest(self.api_client.get(self.resource_detail_uri('stream', stream.id), data={'visual_downsample': 'lttb', 'points': 5}))
+
+        for kwargs in ({'visual_downsample': 'foo', 'points': 5}, {'visual_downsample': 'lttb'}, {'visual_downsample': 'lttb', 'points': 0}):
+            self.assertHttpBadRequest(self.api_client.get(self.resource_detail_uri('stream', self.streams[1].id), data=kwargs))
+
+        # A coarser granularity is selected so that not too many datapoints are read.
+        prev = resources.StreamResource._meta.max_visual_downsample_datapoints
+        resources.StreamResource._meta.max_visual_downsample_datapoints = 100
+        try:
+            data = self.get_detail('stream', self.streams[1].id, limit=10000, visual_downsample='lttb', points=10)
+            self.assertNotEqual(u'seconds', data['query_params']['granularity'])
+            self.assertTrue(0 < len(data['datapoints']) <= 10)
+        finally:
+            resources.StreamResource._meta.max_visual_downsample_datapoints = prev
+
+        datapoints = [{'t': datetime.datetime(2000, 1, 1, 0, 0, i, tzinfo=pytz.utc), 'v': i if i % 10 else None} for i in range(60)]
+
+        with self.assertRaises(visualization.TooManyDatapoints):
+            visualization.downsample(datapoints, 'lttb', 5, max_datapoints=59)
+
+        # Gaps are counted against points, consecutive gaps are kept as one.
+        for method in ('lttb', 'minmax'):
+            for points in (1, 2, 5, 10):
+                reduced = list(visualization.downsample(datapoints, method, points, max_datapoints=60))
+                self.assertTrue(0 < len(reduced) <= points, (method, points))
+
+        datapoints[1]['v'] = None
+        reduced = list(visualization.downsample(datapoints, 'lttb', 10))
+        self.assertIn(datapoints[0], reduced)
+        self.assertNotIn(datapoints[1], reduced)
+
+    def test_count(self):
+        stream = self.streams[0]
+
+        for offset in (0, 11, 715):
+            data = self.get_detail('stream', stream.id, offset=offset, limit=10)
+
+            for count in ('false', 'estimate'):
+                count_data = self.get_detail('stream', stream.id, offset=offset, limit=10, count=count)
+
+                self.assertEqual(data['datapoints'], count_data['datapoints'])
+                self.assertEqual(data['meta']['next'] is None, count_data['meta']['next'] is None)
+                self.assertEqual(data['meta']['previous'] is None, count_data['meta']['previous'] is None)
+
+                if count == 'false':
+                    self.assertNotIn('total_count', count_data['meta'])
+                elif count_data['meta']['next'] is None:
+                    # At the end, count is exact.
+                    self.assertEqual(data['meta']['total_count'], count_data['meta']['total_count'])
+                else:
+                    # For the highest granularity the estimate is an upper bound.
+                    self.assertTrue(count_data['meta']['total_count'] >= data['meta']['total_count'])
+
+        data = self.get_list('stream', offset=0, limit=2, count='false')
+        self.assertEqual(2, len(data['objects']))
+        self.assertNotIn('total_count', data['meta'])
+        self.assertTrue(data['meta']['next'])
+
+        # For streams estimate is exact.
+        data = self.get_list('stream', offset=0, limit=2, count='estimate')
+        self.assertEqual(len(self.streams), data['meta']['total_count'])
+
+        self.assertHttpBadRequest(self.api_client.get(self.resource_detail_uri('stream', stream.id), data={'count': 'foo'}))
+
+    def test_get_multiple(self):
+        missing_stream_id = 'caa88489-fa0f-4458-bc0b-0d52c7a31715'
+
+        for kwargs in ({'limit': 5}, {'limit': 40, 'offset': 11, 'reverse': True}):
+            data = self.get_uri('%sset/%s/' % (self.resource_list_uri('stream'), ';'.join([stream.id for stream in self.streams] + [missing_stream_id])), **kwargs)
+
+            self.assertEqual([missing_stream_id], data['not_found'])
+            self.assertEqual(len(self.streams), len(data['objects']))
+
+            for stream, stream_data in zip(self.streams, data['objects']):
+                self.assertEqual(self.get_detail('stream', stream.id, **kwargs), stream_data)
+
+    def test_conditional_get(self):
+        stream = self.streams[0]
+        uri = self.resource_detail_uri('stream', stream.id)
+
+        response = self.api_client.get(uri, data={'limit': 5})
+        self.assertHttpOK(response)
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        get_data_calls = []
+
+        def get_data(*args, **kwargs):
+            get_data_calls.append(kwargs)
+            return prev_get_data(*args, **kwargs)
+
+        prev_get_data = datastream.get_data
+        datastream.get_data = get_data
+        try:
+            self.assertEqual(304, self.api_client.get(uri, data={'limit': 5}, HTTP_IF_NONE_MATCH=etag).status_code)
+            self.assertEqual(304, self.api_client.get(uri, data={'limit': 5}, HTTP_IF_NONE_MATCH='"foobar", %s' % etag).status_code)
+            self.assertEqual(304, self.api_client.get(uri, data={'limit': 5}, HTTP_IF_MODIFIED_SINCE=last_modified).status_code)
+
+            # Parameters which do not change datapoints do not change the ETag.
+            self.assertEqual(304, self.api_client.get(uri, data={'limit': 5, 'count': 'false', 'server_timing': 1}, HTTP_IF_NONE_MATCH=etag).status_code)
+
+            # Datapoints are not queried for not modified responses.
+            self.assertEqual(get_data_calls, [])
+        finally:
+            del datastream.get_data
+
+        # Different query parameters.
+        response = self.api_client.get(uri, data={'limit': 6}, HTTP_IF_NONE_MATCH=etag)
+        self.assertHttpOK(response)
+        self.assertNotEqual(etag, response['ETag'])
+
+        # Last modification time is known only for the highest granularity.
+        response = self.api_client.get(uri, data={'limit': 5, 'granularity': 'minutes'}, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertHttpOK(response)
+        self.assertFalse(response.has_header('Last-Modified'))
+
+    @test.override_settings(DATASTREAM_RESPONSE_CACHE='default')
+    def test_get_downsampled_cached(self):
+        stream = self.streams[1]
+
+        # First make sure everything is downsampled.
+        until = (stream.latest_datapoint + datetime.timedelta(minutes=10)).strftime('%Y-%m-%dT%H:%M:%S')
+
+        prev = datastream.backend._time_offset
+        datastream.backend._time_offset = datetime.timedelta(minutes=10)
+        try:
+            management.execute_from_command_line([sys.argv[0], 'downsample', '--until=%s' % until])
+        finally:
+            datastream.backend._time_offset = prev
+
+        middle_time = calendar.timegm((stream.earliest_datapoint + (stream.latest_datapoint - stream.earliest_datapoint) / 2).utctimetuple())
+
+        cache.caches['default'].clear()
+
+        get_data_calls = []
+
+        def get_data(*args, **kwargs):
+            get_data_calls.append(kwargs)
+            return prev_get_data(*args, **kwargs)
+
+        for kwargs in ({'limit': 40, 'offset': 11}, {'limit': 40, 'offset': 11, 'reverse': True, 'value_downsamplers': 'mean,min'}):
+            kwargs.update({
+                'granularity': '10seconds',
+                'end': middle_time,
+            })
+
+            prev_get_data = datastream.get_data
+            datastream.get_data = get_data
+            try:
+                # First response is not cached yet, so datapoints are queried.
+                del get_data_calls[:]
+                data = self.get_detail('stream', stream.id, **kwargs)
+                self.assertEqual(len(get_data_calls), 1)
+
+                # Second response should be from the cache, without querying datapoints.
+                del get_data_calls[:]
+                self.assertEqual(data, self.get_detail('stream', stream.id, **kwargs))
+                self.assertEqual(len(get_data_calls), 0)
+
+                # Parameters which do not change datapoints use the same cache entry, and it has the exact count.
+                self.assertEqual(data, self.get_detail('stream', stream.id, count='false', **kwargs))
+                self.assertEqual(len(get_data_calls), 0)
+            finally:
+                del datastream.get_data
+
+            stream_datapoints = datastream.get_data(
+                stream_id=stream.id,
+                granularity=datastream.Granularity.Seconds10,
+                start=datetime.datetime.min,
+                end=datetime.datetime.utcfromtimestamp(middle_time),
+                reverse=kwargs.get('reverse', False),
+                value_downsamplers=kwargs.get('value_downsamplers', '').split(',') if 'value_downsamplers' in kwargs else None,
+            )
+
+            self.assertEqual(len(stream_datapoints), data['meta']['total_count'])
+            self.assertEqualDatapoints(stream_datapoints, 11, 40, data['datapoints'], kwargs)
+
+    @test.override_settings(DATASTREAM_MATERIALIZE_CACHE='default')
+    def test_get_downsampled_materialized(self):
+        stream = self.streams[2]
+
+        until = (stream.latest_datapoint + datetime.timedelta(minutes=10)).strftime('%Y-%m-%dT%H:%M:%S')
+
+        prev = datastream.backend._time_offset
+        datastream.backend._time_offset = datetime.timedelta(minutes=10)
+        try:
+            management.execute_from_command_line([sys.argv[0], 'downsample', '--until=%s' % until, '--materialize'])
+        finally:
+            datastream.backend._time_offset = prev
+
+        stream = datastream.Stream(datastream.get_tags(stream.id))
+        start_time = calendar.timegm(stream.earliest_datapoint.utctimetuple())
+        middle_time = calendar.timegm((stream.earliest_datapoint + (stream.latest_datapoint - stream.earliest_datapoint) / 2).utctimetuple())
+
+        for kwargs in (
+            {'limit': 40, 'offset': 11},
+            {'limit': 40, 'offset': 11, 'reverse': True},
+            {'limit': 1000, 'start_exclusive': start_time + 15},
+            {'limit': 1000, 'start': start_time + 15, 'reverse': True},
+        ):
+            kwargs.update({
+                'granularity': '10seconds',
+                'end_exclusive': middle_time,
+            })
+
+            data = self.get_detail('stream', stream.id, **kwargs)
+
+            if 'start_exclusive' in kwargs:
+                start, start_exclusive = None, datetime.datetime.utcfromtimestamp(kwargs['start_exclusive'])
+            elif 'start' in kwargs:
+                start, start_exclusive = datetime.datetime.utcfromtimestamp(kwargs['start']), None
+            else:
+                start, start_exclusive = datetime.datetime.min, None
+
+            stream_datapoints = datastream.get_data(
+                stream_id=stream.id,
+                granularity=datastream.Granularity.Seconds10,
+                start=start,
+                start_exclusive=start_exclusive,
+                end_exclusive=datetime.datetime.utcfromtimestamp(middle_time),
+                reverse=kwargs.get('reverse', False),
+            )
+
+            self.assertEqual(len(stream_datapoints), data['meta']['total_count'])
+            self.assertEqualDatapoints(stream_datapoints, kwargs.get('offset', 0), kwargs['limit'], data['datapoints'], kwargs)
+
+        # Without counting, one datapoint more is sliced to know if there is a next page.
+        def get_stream_datapoints():
+            return datastream.get_data(
+                stream_id=stream.id,
+                granularity=datastream.Granularity.Seconds10,
+                start=datetime.datetime.min,
+                end_exclusive=datetime.datetime.utcfromtimestamp(middle_time),
+            )
+
+        total_count = len(get_stream_datapoints())
+
+        for count in ('false', 'estimate'):
+            for offset in (0, 11, total_count - 5):
+                kwargs = {
+                    'granularity': '10seconds',
+                    'end_exclusive': middle_time,
+                    'limit': 40,
+                    'offset': offset,
+                    'count': count,
+                }
+
+                data = self.get_detail('stream', stream.id, **kwargs)
+
+                self.assertEqualDatapoints(get_stream_datapoints(), offset, 40, data['datapoints'], kwargs)
+                self.assertEqual(offset + 40 < total_count, data['meta']['next'] is not None, kwargs)
+
+                if count == 'estimate' and data['meta']['next'] is None:
+                    self.assertEqual(total_count, data['meta']['total_count'], kwargs)
+
+        # Blocks were materialized.
+        serializer = resources.StreamResource._meta.serializer
+        index = materialize.block_index(datastream.Granularity.Seconds10, stream.earliest_datapoint)
+        self.assertTrue(materialize.get_cache().get(materialize.get_block_key(stream.id, datastream.Granularity.Seconds10, index, serializer, serializer.time_format)))
+
+        get_data_calls = []
+
+        def get_data(*args, **kwargs):
+            get_data_calls.append(kwargs)
+            return prev_get_data(*args, **kwargs)
+
+        # Only datapoints inside the materialized block.
+        block_end_time = calendar.timegm(materialize.block_start(datastream.Granularity.Seconds10, index + 1).utctimetuple())
+        kwargs = {
+            'granularity': '10seconds',
+            'start': start_time,
+            'end_exclusive': min(middle_time, block_end_time),
+            'limit': 1000,
+        }
+
+        prev_get_data = datastream.get_data
+        datastream.get_data = get_data
+        try:
+            # Datapoints are read from the block, without querying them.
+            data = self.get_detail('stream', stream.id, **kwargs)
+            self.assertEqual(len(get_data_calls), 0)
+
+            # Missing blocks are built from queried datapoints.
+            materialize.get_cache().clear()
+            self.assertEqual(data, self.get_detail('stream', stream.id, **kwargs))
+            self.assertTrue(get_data_calls)
+
+            # And stored again.
+            del get_data_calls[:]
+            self.assertEqual(data, self.get_detail('stream', stream.id, **kwargs))
+            self.assertEqual(len(get_data_calls), 0)
+        finally:
+            del datastream.get_data
+
     def test_ujson(self):
         # We are using a ujson fork which allows data to have a special __json__ method which
         # outputs raw JSON to be directly included in the output. This can speedup serialization